@@ -1,13 +1,26 @@
-from flask import Flask, render_template, jsonify, Response
-from utilities.BatchInserter import InsertTask, ActionLock
+from flask import Flask, render_template, jsonify, Response, request
+from utilities.BatchInserter import InsertTask, ActionLock, LOAD_MODES
+from utilities.FigureSnapshots import FigureSnapshots, ENCODINGS
+from utilities.IngestMetrics import IngestMetrics
 from utilities.PostgreSQLManager import PostgreSQLManager
+from utilities.ResultCache import ResultCache
+from utilities.TileRenderer import TileRenderer
 import json
 import time
 import threading
 from dash import html, dcc, Dash
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output
-from utilities.QueryPlotter import QueryPlotter, GRAPH_CONFIG
+from utilities.QueryPlotter import GRAPH_CONFIG
+from config.app_config import app_config
+
+
+# Deepest zoom level of the maps
+MAX_ZOOM = 20
+
+# Default and largest number of rows of a page of counts
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 
 def create_app():
@@ -16,6 +29,8 @@ def create_app():
     app.template_folder = 'templates'
     action_lock = ActionLock()
     task = InsertTask()
+    snapshots = FigureSnapshots.get_instance()
+    tiles = TileRenderer.get_instance()
 
     @app.route('/')
     def index():
@@ -33,20 +48,60 @@ def create_app():
             "message": "Currently, another database process is being executed"
         }), 503
 
+    def insert_batches(**kwargs):
+        task.run(**kwargs)
+        snapshots.render_all()
+        if app_config['tile_pregenerate_zoom'] >= 0:
+            tiles.pregenerate(app_config['tile_pregenerate_zoom'])
+
     @app.route('/insert_batches', methods=['POST'])
     def handle_insert_batches():
         """
         Handle requests to start batch insertion into the database.
 
-        If no other task is currently running, this function starts a new thread for batch insertion into the database.
+        If no other task is currently running, this function starts a new thread for batch insertion into the database,
+        which renders the snapshots of the figures and the density tiles up to the configured zoom level once
+        the insertion has finished.
+        The optional 'mode' query parameter selects how rows are written ('orm' or 'copy'),
+        'incremental=true' appends only the records that are new or changed since the last load,
+        'resume=true' continues an interrupted load from its last committed batch, 'workers' sets the
+        number of processes that load partitions of the source in parallel, and 'bulk=true' builds the
+        constraints and indexes of the incidents table after the load instead of maintaining them per row.
 
         :return: JSON response with a success message and HTTP status 202 if batch insertion has started,
+                 JSON response with an error message and HTTP status 400 if the load mode, the number
+                 of workers or the combination of options is not supported,
+                 JSON response with an error message and HTTP status 409 if a full load is requested while
+                 the incidents table holds rows, or an incremental load while incidents have no row_id,
                  or JSON response with an error message and HTTP status 503 if another task is running.
         """
-        if not action_lock.is_locked() and not task.running:
-            action_lock.perform(lambda: threading.Thread(target=task.run).start())
-            return jsonify({"message": "Batch Insertion started"}), 202
-        return another_db_process_msg()
+        load_mode = request.args.get('mode')
+        if load_mode is not None and load_mode not in LOAD_MODES:
+            return jsonify({"message": f"Unsupported load mode, expected one of {list(LOAD_MODES)}"}), 400
+        incremental = request.args.get('incremental', 'false').lower() == 'true'
+        resume = request.args.get('resume', 'false').lower() == 'true'
+        workers = request.args.get('workers', type=int)
+        if workers is not None and workers < 1:
+            return jsonify({"message": "The number of workers must be a positive integer"}), 400
+        bulk_load = request.args.get('bulk', 'false').lower() == 'true'
+        if bulk_load and incremental:
+            return jsonify({"message": "An incremental load cannot be a bulk load"}), 400
+        if action_lock.is_locked() or task.running:
+            return another_db_process_msg()
+        db_manager = PostgreSQLManager.get_instance()
+        if not incremental and not resume and db_manager.has_incidents():
+            return jsonify({"message": "A full load needs an empty incidents table, "
+                                       "recreate the tables or load incrementally"}), 409
+        if incremental and db_manager.has_unkeyed_incidents():
+            return jsonify({"message": "Incidents migrated from the old schema have no row_id, "
+                                       "recreate the tables and load them in full"}), 409
+        action_lock.perform(
+            lambda: threading.Thread(target=insert_batches, kwargs={'load_mode': load_mode,
+                                                                    'incremental': incremental,
+                                                                    'resume': resume,
+                                                                    'workers': workers,
+                                                                    'bulk_load': bulk_load}).start())
+        return jsonify({"message": "Batch Insertion started"}), 202
 
     @app.route('/create_database', methods=['POST'])
     def handle_create_database():
@@ -70,13 +125,16 @@ def create_app():
         Handle requests to start recreating the tables in the database.
 
         If no other task is currently running, this function starts the tables recreation in the database.
+        With 'bulk=true' the incidents table is created without its constraints and secondary indexes, which
+        are built by the next batch insertion.
 
         :return: JSON response with a success message and HTTP status 202 if table recreation has started,
                  or JSON response with an error message and HTTP status 503 if another task is running.
         """
+        bulk_load = request.args.get('bulk', 'false').lower() == 'true'
         if not action_lock.is_locked() and not task.running:
             action_lock.perform(
-                lambda: PostgreSQLManager.get_instance().recreate_tables())
+                lambda: PostgreSQLManager.get_instance().recreate_tables(bulk_load))
             return jsonify({"message": "Table recreation started"}), 202
         return another_db_process_msg()
 
@@ -86,19 +144,146 @@ def create_app():
         Stream updates about the task progress to the client.
 
         This function generates a server-sent event stream that sends updates about the task progress to the client.
+        Each update also carries a summary of the ingest metrics: throughput, time per stage, batches and peak memory.
 
         :return: Server-sent event stream response.
         """
 
         def generate():
             while True:
-                yield f"data:{json.dumps({'total_rows_added': task.total_rows_added, 'progress': task.progress})}\n\n"
+                update = {'total_rows_added': task.total_rows_added, 'progress': task.progress,
+                          'metrics': IngestMetrics.get_instance().get_summary()}
+                yield f"data:{json.dumps(update)}\n\n"
                 if not task.running:
                     break
                 time.sleep(1)
 
         return Response(generate(), mimetype='text/event-stream')
 
+    @app.route('/metrics')
+    def metrics():
+        """
+        Expose the ingest metrics for Prometheus.
+
+        This function renders the timings, counters and batch latency histograms of the current or last
+        batch insertion, and the hit and miss counters of the result caches, in the Prometheus text
+        exposition format.
+
+        :return: Plain text response with the metrics.
+        """
+        text = IngestMetrics.get_instance().render(task.running, task.progress) + ResultCache.render_metrics()
+        return Response(text, mimetype='text/plain; version=0.0.4')
+
+    @app.route('/figures/<graph_type>.json')
+    def figure_snapshot(graph_type):
+        """
+        Serve the snapshot of a figure.
+
+        The snapshot is sent in the preferred content coding the client accepts, with an entity tag that
+        changes only when the figure does, so a client revalidating an unchanged figure gets a 304.
+        Zoomable graphs take the zoom level of the map in the 'zoom' query parameter, and the visible area
+        in 'bounds', as west,south,east,north in degrees.
+
+        :param graph_type: Key of the graph in GRAPH_CONFIG.
+        :return: Response with the JSON of the figure, an empty response with HTTP status 304 if the client
+                 holds the current snapshot, JSON response with an error message and HTTP status 400 if the
+                 zoom level or bounds are invalid, or JSON response with an error message and HTTP status 404
+                 if the graph does not exist.
+        """
+        if graph_type not in GRAPH_CONFIG:
+            return jsonify({"message": f"Unknown graph, expected one of {list(GRAPH_CONFIG)}"}), 404
+        query_params = {}
+        if GRAPH_CONFIG[graph_type].get('zoomable', False):
+            zoom = request.args.get('zoom', type=float)
+            if zoom is not None:
+                query_params['zoom'] = min(max(round(zoom), 0), MAX_ZOOM)
+            if 'bounds' in request.args:
+                try:
+                    west, south, east, north = (float(value) for value in request.args['bounds'].split(','))
+                except ValueError:
+                    return jsonify({"message": "The bounds must be west,south,east,north in degrees"}), 400
+                if not (west < east and south < north):
+                    return jsonify({"message": "The bounds must be west,south,east,north in degrees"}), 400
+                query_params['bounds'] = (west, south, east, north)
+        snapshot = snapshots.get(graph_type, **query_params)
+        encoding = next((encoding for encoding in ENCODINGS if request.accept_encodings[encoding]), None)
+
+        response = Response(status=304) if request.if_none_match.contains_weak(snapshot.etag) \
+            else Response(snapshot.get_body(encoding), mimetype='application/json')
+        # Every coding of a snapshot shares its tag, which makes it a weak one
+        response.set_etag(snapshot.etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding and response.status_code == 200:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    @app.route('/counts/<graph_type>')
+    def counts_page(graph_type):
+        """
+        Page through the counts behind a graph, including the tail that the graph sums up.
+
+        Rows are sorted by count, highest first. The 'limit' query parameter sets the number of rows of a page,
+        and 'after' takes the 'next' value of the previous page, a JSON array of a count and labels.
+
+        :param graph_type: Key of the graph in GRAPH_CONFIG.
+        :return: JSON response with the rows of the page and the 'next' value, null on the last page,
+                 JSON response with an error message and HTTP status 400 if the limit or 'after' is invalid,
+                 or JSON response with an error message and HTTP status 404 if the graph does not exist or
+                 cannot be paged.
+        """
+        if not GRAPH_CONFIG.get(graph_type, {}).get('pageable', False):
+            return jsonify({"message": "Unknown graph, or the counts of the graph cannot be paged"}), 404
+        limit = request.args.get('limit', PAGE_SIZE, type=int)
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            return jsonify({"message": f"The limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+        after = None
+        if 'after' in request.args:
+            try:
+                after = json.loads(request.args['after'])
+            except ValueError:
+                after = None
+            if not isinstance(after, list):
+                return jsonify({"message": "'after' must be the 'next' value of the previous page"}), 400
+
+        try:
+            df = getattr(PostgreSQLManager.get_instance(), GRAPH_CONFIG[graph_type]['query_func'])(after=after,
+                                                                                                   limit=limit)
+        except ValueError:
+            # The count and labels of 'after' do not match the columns of the graph
+            return jsonify({"message": "'after' must be the 'next' value of the previous page"}), 400
+        rows = df.to_dict(orient='records')
+        next_after = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_after = [last['num_of_incidents']] + [last[column] for column in df.columns
+                                                       if column != 'num_of_incidents']
+        return jsonify({"rows": rows, "next": next_after})
+
+    @app.route('/tiles/<int:zoom>/<int:x>/<int:y>.png')
+    def density_tile(zoom, x, y):
+        """
+        Serve a raster tile of the incident density.
+
+        Tiles are addressed like the tiles of the base map, by zoom level, column and row. Their entity tag
+        changes with the data, so a client revalidating a tile that did not change gets a 304.
+
+        :param zoom: Zoom level.
+        :param x: Column of the tile.
+        :param y: Row of the tile.
+        :return: Response with the PNG image of the tile, an empty response with HTTP status 304 if the client
+                 holds the current tile, or JSON response with an error message and HTTP status 404 if the
+                 tile does not exist.
+        """
+        if zoom > MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+            return jsonify({"message": "Tile out of range"}), 404
+        etag = f"{tiles.get_version()}-{zoom}-{x}-{y}"
+        response = Response(status=304) if request.if_none_match.contains(etag) \
+            else Response(tiles.get_tile(zoom, x, y), mimetype='image/png')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     # Dash app layout
     dash_app.layout = dbc.Container([
         dbc.Row([
@@ -136,21 +321,36 @@ def create_app():
         ])
     ], fluid=True)
 
-    @dash_app.callback(
+    # Update the graph based on the dropdown selection, from the snapshot of its figure. The browser revalidates
+    # the snapshot with its entity tag, so switching back to an unchanged graph does not transfer it again.
+    # Zooming or panning the hotspot map fetches the hotspots of the visible area at the new zoom level.
+    dash_app.clientside_callback(
+        """
+        function(graphType, relayoutData) {
+            var triggered = dash_clientside.callback_context.triggered.map(function(t) { return t.prop_id; });
+            var url = '/figures/' + encodeURIComponent(graphType) + '.json';
+            if (triggered.indexOf('incident-graph.relayoutData') !== -1) {
+                if (graphType !== 'crime_hotspots' || !relayoutData || relayoutData['mapbox.zoom'] === undefined) {
+                    return dash_clientside.no_update;
+                }
+                url += '?zoom=' + Math.round(relayoutData['mapbox.zoom']);
+                var derived = relayoutData['mapbox._derived'];
+                if (derived && derived.coordinates) {
+                    var lons = derived.coordinates.map(function(c) { return c[0]; });
+                    var lats = derived.coordinates.map(function(c) { return c[1]; });
+                    // Rounded outwards, so small moves of the map reuse the cached snapshot
+                    url += '&bounds=' + [Math.floor(Math.min.apply(null, lons) * 100) / 100,
+                                         Math.floor(Math.min.apply(null, lats) * 100) / 100,
+                                         Math.ceil(Math.max.apply(null, lons) * 100) / 100,
+                                         Math.ceil(Math.max.apply(null, lats) * 100) / 100].join(',');
+                }
+            }
+            return fetch(url).then(function(response) { return response.json(); });
+        }
+        """,
         Output('incident-graph', 'figure'),
-        Input('graph-dropdown', 'value')
+        Input('graph-dropdown', 'value'),
+        Input('incident-graph', 'relayoutData')
     )
-    def update_graph(graph_type):
-        """
-        Update the graph based on the dropdown selection.
-
-        This function is a Dash callback that gets triggered when the value of the dropdown changes. It updates the
-        graph based on the selected value.
-
-        :param graph_type: Type of graph selected in the dropdown.
-        :return: Plotly figure object for the selected graph type.
-        """
-        query_plotter = QueryPlotter(graph_type)
-        return query_plotter.plot_graph()
 
     return app
@@ -1,5 +1,18 @@
 import os
 
 app_config = {
-    "port": os.environ.get("APP_PORT", 8050)
+    "port": os.environ.get("APP_PORT", 8050),
+    "result_cache_ttl_seconds": float(os.environ.get("APP_RESULT_CACHE_TTL_SECONDS", 600)),
+    "result_cache_max_entries": int(os.environ.get("APP_RESULT_CACHE_MAX_ENTRIES", 64)),
+    # Size of a cell of the hotspot grid on screen, and the most cells the hotspot map shows
+    "hotspot_cell_pixels": int(os.environ.get("APP_HOTSPOT_CELL_PIXELS", 8)),
+    "hotspot_max_cells": int(os.environ.get("APP_HOTSPOT_MAX_CELLS", 4000)),
+    # Draw the hotspot map from the density tiles instead of sending the grid cells to the browser
+    "hotspot_raster_tiles": os.environ.get("APP_HOTSPOT_RASTER_TILES", "false").lower() == "true",
+    # Relative paths are resolved against the utilities directory
+    "tile_cache_path": os.environ.get("APP_TILE_CACHE_PATH", "../data/.cache/tiles"),
+    # Tiles up to this zoom level are rendered after each load, -1 disables
+    "tile_pregenerate_zoom": int(os.environ.get("APP_TILE_PREGENERATE_ZOOM", 12)),
+    # Radius of the blur that spreads the incidents of a location over the pixels around it
+    "tile_blur_pixels": int(os.environ.get("APP_TILE_BLUR_PIXELS", 4))
 }
@@ -0,0 +1,28 @@
+"""
+    Ingest configuration
+"""
+import os
+
+ingest_config = {
+    # Relative paths are resolved against the utilities directory
+    "source_path": os.environ.get("INGEST_SOURCE_PATH", "../data/crime_sf.csv"),
+    "load_mode": os.environ.get("INGEST_LOAD_MODE", "copy"),
+    "pipeline_queue_size": int(os.environ.get("INGEST_PIPELINE_QUEUE_SIZE", 2)),
+    "batch_size": int(os.environ.get("INGEST_BATCH_SIZE", 10000)),
+    "adaptive_batching": os.environ.get("INGEST_ADAPTIVE_BATCHING", "true").lower() == "true",
+    "batch_size_min": int(os.environ.get("INGEST_BATCH_SIZE_MIN", 2000)),
+    "batch_size_max": int(os.environ.get("INGEST_BATCH_SIZE_MAX", 200000)),
+    "batch_max_memory_mb": int(os.environ.get("INGEST_BATCH_MAX_MEMORY_MB", 256)),
+    "batch_max_commit_seconds": float(os.environ.get("INGEST_BATCH_MAX_COMMIT_SECONDS", 10)),
+    "watermark_column": os.environ.get("INGEST_WATERMARK_COLUMN", "report_datetime"),
+    "watermark_lookback_days": int(os.environ.get("INGEST_WATERMARK_LOOKBACK_DAYS", 7)),
+    "key_cache_max_mb": int(os.environ.get("INGEST_KEY_CACHE_MAX_MB", 64)),
+    "key_cache_persist": os.environ.get("INGEST_KEY_CACHE_PERSIST", "true").lower() == "true",
+    "key_cache_path": os.environ.get("INGEST_KEY_CACHE_PATH", "../data/.cache/dimension_keys.pkl"),
+    "columnar_cache": os.environ.get("INGEST_COLUMNAR_CACHE", "true").lower() == "true",
+    "workers": int(os.environ.get("INGEST_WORKERS", 1)),
+    "partition_rows": int(os.environ.get("INGEST_PARTITION_ROWS", 100000)),
+    "bulk_load_unlogged": os.environ.get("INGEST_BULK_LOAD_UNLOGGED", "false").lower() == "true",
+    "bulk_load_index_workers": int(os.environ.get("INGEST_BULK_LOAD_INDEX_WORKERS", 4)),
+    "bulk_load_maintenance_work_mem": os.environ.get("INGEST_BULK_LOAD_MAINTENANCE_WORK_MEM", "256MB")
+}
@@ -0,0 +1,48 @@
+-- Migrate incidents from the per-incident date_dimension and incident_details_dimension
+-- to the deduplicated calendar, time-of-day and description dimensions.
+-- Expects calendar_dimension, time_of_day_dimension and description_dimension to exist.
+INSERT INTO calendar_dimension (key, incident_date, incident_year, incident_month, incident_day, incident_day_of_week)
+SELECT CAST(to_char(day, 'YYYYMMDD') AS INTEGER), day, EXTRACT(YEAR FROM day), EXTRACT(MONTH FROM day),
+       EXTRACT(DAY FROM day), to_char(day, 'FMDay')
+FROM (SELECT DISTINCT CAST(incident_datetime AS DATE) AS day FROM date_dimension) AS days
+ON CONFLICT DO NOTHING;
+
+INSERT INTO description_dimension (incident_description)
+SELECT DISTINCT details.incident_description
+FROM incident_details_dimension AS details
+WHERE details.incident_description IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM description_dimension AS description
+                  WHERE description.incident_description = details.incident_description);
+
+-- The old schema has no Row ID of the source, row_id stays NULL until the incidents are reloaded in full
+ALTER TABLE incidents
+    ADD COLUMN row_id BIGINT UNIQUE,
+    ADD COLUMN incident_number INTEGER,
+    ADD COLUMN incident_datetime TIMESTAMP,
+    ADD COLUMN report_datetime TIMESTAMP,
+    ADD COLUMN calendar_key INTEGER REFERENCES calendar_dimension (key),
+    ADD COLUMN time_key INTEGER REFERENCES time_of_day_dimension (key),
+    ADD COLUMN description_key INTEGER REFERENCES description_dimension (key);
+
+UPDATE incidents
+SET incident_number = details.incident_number,
+    incident_datetime = dates.incident_datetime,
+    report_datetime = dates.report_datetime,
+    calendar_key = CAST(to_char(dates.incident_datetime, 'YYYYMMDD') AS INTEGER),
+    time_key = CAST(EXTRACT(HOUR FROM dates.incident_datetime) * 60 + EXTRACT(MINUTE FROM dates.incident_datetime) AS INTEGER),
+    description_key = description.key
+FROM date_dimension AS dates,
+     incident_details_dimension AS details
+     LEFT JOIN description_dimension AS description ON description.incident_description = details.incident_description
+WHERE dates.key = incidents.date_key
+  AND details.key = incidents.incident_details_key;
+
+-- Dropping the old key columns also drops the old idx_incidents_keys index
+ALTER TABLE incidents
+    ALTER COLUMN incident_number SET NOT NULL,
+    ALTER COLUMN incident_datetime SET NOT NULL,
+    ALTER COLUMN report_datetime SET NOT NULL,
+    DROP COLUMN date_key,
+    DROP COLUMN incident_details_key;
+
+DROP TABLE date_dimension, incident_details_dimension;
@@ -1,9 +1,46 @@
-from sqlalchemy.orm import declarative_base, DeclarativeMeta, relationship
-from sqlalchemy import Column, Integer, String, TIMESTAMP, DATE, TIME, FLOAT, ForeignKey, INT, TEXT, inspect, Index
+from sqlalchemy.orm import declarative_base, DeclarativeMeta, relationship, declared_attr
+from sqlalchemy import Column, Integer, String, TIMESTAMP, DATE, TIME, FLOAT, ForeignKey, INT, TEXT, inspect, Index, DDL, \
+    event, BigInteger, Float, func, literal_column
 from abc import ABCMeta
 
 Base = declarative_base()
 
+# Values NULLs are replaced with in the natural key of a dimension, by column type; they are rendered inline,
+# so that ON CONFLICT clauses match the expressions of the unique index
+NULL_SENTINELS = [(String, "''"), (Float, "'NaN'::float8"), (Integer, '-1')]
+
+
+def coalesce_null(expression, column):
+    """
+    Replace NULL with the sentinel of the column's type, so that rows with missing values compare as equal.
+
+    :param expression: Column expression to coalesce.
+    :param column: Column of the dimension the expression stands for.
+    :return: The expression, coalesced if the column is nullable.
+    """
+    if not column.nullable:
+        return expression
+    sentinel = next(value for column_type, value in NULL_SENTINELS if isinstance(column.type, column_type))
+    return func.coalesce(expression, literal_column(sentinel))
+
+
+def foreign_key_indexes(table_name, columns):
+    """
+    Create a B-tree index on each foreign key column of a table.
+
+    :param table_name: Name of the table.
+    :param columns: Names of the foreign key columns.
+    :return: List of indexes named idx_<table>_<column>.
+    """
+    return [Index(f'idx_{table_name}_{column}', column) for column in columns]
+
+
+# Indexes that earlier versions of the model created and that are dropped from existing databases
+OBSOLETE_INDEXES = ['idx_incidents_keys']
+
+# Per-incident dimensions of the schema before the star schema migration (see PostgreSQLManager.migrate_star_schema)
+LEGACY_TABLES = ['date_dimension', 'incident_details_dimension']
+
 
 class ABCWithSQLAlchemy(ABCMeta, DeclarativeMeta):
     pass
@@ -13,20 +50,64 @@ class Dimension(Base, metaclass=ABCWithSQLAlchemy):
     __abstract__ = True
     key = Column(Integer, primary_key=True, autoincrement=True)
 
+    # Dimensions with a smart key compute their keys from the data and have no natural key index
+    smart_key = False
+
+    @declared_attr
+    def __table_args__(cls):
+        if cls.smart_key:
+            return ()
+        columns = [column for name, column in cls.__dict__.items() if isinstance(column, Column) and name != 'key']
+        return (Index(f'uq_{cls.__tablename__}_natural_key', *[coalesce_null(column, column) for column in columns],
+                      unique=True),)
+
     @classmethod
     def get_columns(cls):
         return [column.name for column in inspect(cls).c if column.name != 'key']
 
+    @classmethod
+    def get_natural_key(cls, table=None):
+        """
+        Get the expressions of the unique natural key index, over the columns of this dimension or of another table.
 
-class DateDimension(Dimension):
-    __tablename__ = 'date_dimension'
+        :param table: Table with the same column names, such as a staging table. Defaults to the dimension table.
+        :return: List of column expressions.
+        """
+        table = table if table is not None else cls.__table__
+        return [coalesce_null(table.c[name], cls.__table__.c[name]) for name in cls.get_columns()]
 
-    incident_datetime = Column(TIMESTAMP, nullable=False)
-    incident_date = Column(DATE, nullable=False)
-    incident_time = Column(TIME, nullable=False)
+
+class CalendarDimension(Dimension):
+    __tablename__ = 'calendar_dimension'
+    smart_key = True
+
+    # Smart key: the date as a YYYYMMDD integer, so the key can be computed from the data without a lookup
+    key = Column(Integer, primary_key=True, autoincrement=False)
+    incident_date = Column(DATE, nullable=False, unique=True)
     incident_year = Column(Integer, nullable=False)
+    incident_month = Column(Integer, nullable=False)
+    incident_day = Column(Integer, nullable=False)
     incident_day_of_week = Column(String(255), nullable=False)
-    report_datetime = Column(TIMESTAMP, nullable=False)
+
+
+class TimeOfDayDimension(Dimension):
+    __tablename__ = 'time_of_day_dimension'
+    smart_key = True
+
+    # Smart key: the minute of the day, 0 to 1439
+    key = Column(Integer, primary_key=True, autoincrement=False)
+    incident_time = Column(TIME, nullable=False, unique=True)
+    incident_hour = Column(Integer, nullable=False)
+    incident_minute = Column(Integer, nullable=False)
+
+
+event.listen(
+    TimeOfDayDimension.__table__,
+    'after_create',
+    DDL("INSERT INTO time_of_day_dimension (key, incident_time, incident_hour, incident_minute) "
+        "SELECT minute, make_time(minute / 60, minute %% 60, 0), minute / 60, minute %% 60 "
+        "FROM generate_series(0, 1439) AS minute")
+)
 
 
 class CategoryDimension(Dimension):
@@ -44,10 +125,9 @@ class DistrictDimension(Dimension):
     analysis_neighborhood = Column(String(255))
 
 
-class IncidentDetailsDimension(Dimension):
-    __tablename__ = 'incident_details_dimension'
+class DescriptionDimension(Dimension):
+    __tablename__ = 'description_dimension'
 
-    incident_number = Column(INT, nullable=False)
     incident_description = Column(TEXT)
 
 
@@ -66,21 +146,176 @@ class ResolutionDimension(Dimension):
 
 class Incidents(Base):
     __tablename__ = 'incidents'
+    __table_args__ = (
+        # Joins and filters on a single dimension, and the foreign key checks of deleted dimension rows
+        *foreign_key_indexes('incidents', ["time_key", "category_key", "district_key", "resolution_key",
+                                           "location_key", "description_key"]),
+        # Dates are filtered by range. A BRIN index keeps the bounds of every block range, a few pages for the
+        # whole table, and skips the blocks outside the range as long as rows are appended in date order
+        Index('idx_incidents_calendar_key_brin', "calendar_key", postgresql_using='brin'),
+        Index('idx_incidents_incident_datetime_brin', "incident_datetime", postgresql_using='brin'),
+        Index('idx_incidents_report_datetime_brin', "report_datetime", postgresql_using='brin'),
+    )
 
     incident_id = Column(Integer, primary_key=True, autoincrement=True)
-    date_key = Column(Integer, ForeignKey('date_dimension.key'))
+    # Row ID of the source data, identifies a record across loads
+    row_id = Column(BigInteger, unique=True)
+    incident_number = Column(INT, nullable=False)
+    incident_datetime = Column(TIMESTAMP, nullable=False)
+    report_datetime = Column(TIMESTAMP, nullable=False)
+    calendar_key = Column(Integer, ForeignKey('calendar_dimension.key'))
+    time_key = Column(Integer, ForeignKey('time_of_day_dimension.key'))
     category_key = Column(Integer, ForeignKey('category_dimension.key'))
     district_key = Column(Integer, ForeignKey('district_dimension.key'))
     resolution_key = Column(Integer, ForeignKey('resolution_dimension.key'))
     location_key = Column(Integer, ForeignKey('location_dimension.key'))
-    incident_details_key = Column(Integer, ForeignKey('incident_details_dimension.key'))
+    description_key = Column(Integer, ForeignKey('description_dimension.key'))
 
-    date_dimension = relationship('DateDimension')
+    calendar_dimension = relationship('CalendarDimension')
+    time_of_day_dimension = relationship('TimeOfDayDimension')
     category_dimension = relationship('CategoryDimension')
     district_dimension = relationship('DistrictDimension')
     resolution_dimension = relationship('ResolutionDimension')
     location_dimension = relationship('LocationDimension')
-    incident_details_dimension = relationship('IncidentDetailsDimension')
+    description_dimension = relationship('DescriptionDimension')
+
+
+class IncidentRevision(Base):
+    """
+    Version of an incident as it was before it was updated in place, as by an incremental load.
+
+    Only the first version since the aggregates were last refreshed is kept, which is the version they count;
+    the refresh subtracts it, adds the current version and removes the revision.
+    """
+    __tablename__ = 'incident_revision'
+
+    incident_id = Column(Integer, primary_key=True, autoincrement=False)
+    row_id = Column(BigInteger)
+    incident_number = Column(INT, nullable=False)
+    incident_datetime = Column(TIMESTAMP, nullable=False)
+    report_datetime = Column(TIMESTAMP, nullable=False)
+    calendar_key = Column(Integer)
+    time_key = Column(Integer)
+    category_key = Column(Integer)
+    district_key = Column(Integer)
+    resolution_key = Column(Integer)
+    location_key = Column(Integer)
+    description_key = Column(Integer)
+
+
+INCIDENT_REVISION_TRIGGER = 'incidents_save_revisions'
+
+_revision_columns = ', '.join(column.name for column in IncidentRevision.__table__.columns)
+
+# Statements that make every update of the incidents table save the old versions of the updated rows. The
+# statement-level trigger reads them from the transition table, in one insert per update statement.
+INCIDENT_REVISION_DDL = [
+    DDL("CREATE OR REPLACE FUNCTION save_incident_revisions() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN "
+        f"INSERT INTO incident_revision ({_revision_columns}) SELECT {_revision_columns} FROM old_incidents "
+        "ON CONFLICT (incident_id) DO NOTHING; RETURN NULL; END $$"),
+    DDL(f"CREATE TRIGGER {INCIDENT_REVISION_TRIGGER} AFTER UPDATE ON incidents REFERENCING OLD TABLE AS "
+        "old_incidents FOR EACH STATEMENT EXECUTE FUNCTION save_incident_revisions()")
+]
+
+for statement in INCIDENT_REVISION_DDL:
+    event.listen(Incidents.__table__, 'after_create', statement)
+
+
+class IngestWatermark(Base):
+    __tablename__ = 'ingest_watermark'
+
+    source = Column(String(255), primary_key=True)
+    watermark_column = Column(String(255), nullable=False)
+    high_water_mark = Column(TIMESTAMP, nullable=False)
+
+
+class IngestCheckpoint(Base):
+    __tablename__ = 'ingest_checkpoint'
+
+    source = Column(String(255), primary_key=True)
+    # Size and modification time of the source file the checkpoint belongs to
+    source_signature = Column(String(255), nullable=False)
+    # Number of source rows covered by committed batches
+    rows_done = Column(BigInteger, nullable=False)
+    updated_at = Column(TIMESTAMP, nullable=False)
+
+
+class Aggregate(Base, metaclass=ABCWithSQLAlchemy):
+    """
+    Summary table with the number of incidents per combination of its primary key columns.
+
+    Columns named like a column of the incidents table are grouped on that column, other columns on the column
+    of the calendar or time-of-day dimension with the same name. Incidents with a missing key are not counted, as they are not
+    counted by the inner joins of the dashboard queries.
+    """
+    __abstract__ = True
+    num_of_incidents = Column(BigInteger, nullable=False)
+
+
+class CategoryAggregate(Aggregate):
+    __tablename__ = 'agg_category'
+
+    category_key = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class CategoryResolutionAggregate(Aggregate):
+    __tablename__ = 'agg_category_resolution'
+
+    category_key = Column(Integer, primary_key=True)
+    resolution_key = Column(Integer, primary_key=True)
+
+
+class CalendarCategoryAggregate(Aggregate):
+    __tablename__ = 'agg_calendar_category'
+    __table_args__ = (
+        # Covers the date range of fetch_most_frequent_crimes, which is then answered without reading the table
+        Index('idx_agg_calendar_category_covering', "calendar_key", "category_key",
+              postgresql_include=["num_of_incidents"]),
+    )
+
+    calendar_key = Column(Integer, primary_key=True)
+    category_key = Column(Integer, primary_key=True)
+
+
+class LocationAggregate(Aggregate):
+    __tablename__ = 'agg_location'
+
+    location_key = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class HourWeekdayMonthCategoryAggregate(Aggregate):
+    __tablename__ = 'agg_hour_weekday_month_category'
+
+    incident_hour = Column(Integer, primary_key=True)
+    incident_day_of_week = Column(String(255), primary_key=True)
+    incident_month = Column(Integer, primary_key=True)
+    category_key = Column(Integer, primary_key=True)
+
+
+class DistrictCategoryAggregate(Aggregate):
+    __tablename__ = 'agg_district_category'
+
+    district_key = Column(Integer, primary_key=True)
+    category_key = Column(Integer, primary_key=True)
+
+
+class DescriptionAggregate(Aggregate):
+    __tablename__ = 'agg_description'
+
+    description_key = Column(Integer, primary_key=True, autoincrement=False)
+
+
+AGGREGATE_CLASSES = [CategoryAggregate, CategoryResolutionAggregate, CalendarCategoryAggregate, LocationAggregate,
+                     HourWeekdayMonthCategoryAggregate, DistrictCategoryAggregate, DescriptionAggregate]
+
+# Aggregates that earlier versions of the model created and that are dropped from existing databases
+OBSOLETE_AGGREGATES = ['agg_time_weekday_category']
+
+
+class AggregateRefresh(Base):
+    __tablename__ = 'aggregate_refresh'
 
-    index = Index('idx_incidents_keys', "date_key", "category_key",
-                  "district_key", "resolution_key", "location_key", "incident_details_key")
+    aggregate = Column(String(255), primary_key=True)
+    # Highest incident_id counted in the aggregate
+    last_incident_id = Column(BigInteger, nullable=False)
+    refreshed_at = Column(TIMESTAMP, nullable=False)
@@ -1,12 +1,25 @@
+import datetime
+import multiprocessing
 import threading
-from concurrent.futures import ThreadPoolExecutor
-
-from model.SQLAlchemy import (DateDimension, CategoryDimension, DistrictDimension,
-                              IncidentDetailsDimension, LocationDimension,
-                              ResolutionDimension, Incidents)
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from config.ingest_config import ingest_config
+from model.SQLAlchemy import (CalendarDimension, CategoryDimension, DistrictDimension,
+                              DescriptionDimension, LocationDimension,
+                              ResolutionDimension, Incidents, IngestWatermark, IngestCheckpoint)
+from utilities.BatchSizer import BatchSizer
+from utilities.CopyWriter import CopyWriter
 from utilities.DataLoader import DataLoader
 from utilities.DimensionMapper import DimensionMapper
+from utilities.IngestMetrics import IngestMetrics
+from utilities.IngestPipeline import IngestPipeline
 from utilities.PostgreSQLManager import PostgreSQLManager
+from utilities.ResultCache import ResultCache
 
 
 class Singleton(type):
@@ -31,72 +44,377 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+LOAD_MODES = ('orm', 'copy')
+
+INCIDENT_ATTRIBUTES = ['row_id', 'incident_number', 'incident_datetime', 'report_datetime']
+
+KEY_NAME_MAP = {
+    DistrictDimension: 'district_key',
+    ResolutionDimension: 'resolution_key',
+    CategoryDimension: 'category_key',
+    LocationDimension: 'location_key',
+    DescriptionDimension: 'description_key'
+}
+
+
 class BatchInserter:
     """
     Handles the insertion of data in batches.
 
-    :param df: A Pandas DataFrame containing the data to be inserted.
-    :param session: SQLAlchemy session object.
+    The data is consumed one DataFrame at a time, so a stream of chunks (see DataLoader.iter_chunks)
+    is loaded without ever holding the whole source in memory. Rows are written either through
+    SQLAlchemy bulk inserts ('orm') or streamed through PostgreSQL COPY ('copy'), which is considerably
+    faster on large loads.
+
+    Dimension rows and fact rows can be written through separate sessions, so that IngestPipeline can
+    run both writes concurrently on their own connections.
+
+    In incremental mode rows whose watermark column is not later than 'since' are skipped, the remaining
+    rows are upserted on their row_id, and the high-water mark of the source is advanced in the same
+    transaction as each fact batch.
+
+    When a source signature is given, a checkpoint with the number of source rows covered so far is
+    committed together with each fact batch, so an interrupted load can be resumed from the last committed
+    batch. This relies on the index of the chunks holding the position of the rows in the source, as in
+    DataLoader.iter_chunks.
+
+    With a BatchSizer the chunks are split into batches of its current size, and every committed fact batch is
+    reported to it, so the size adapts to the measured throughput. Read the chunks with the sizer's get_size as
+    chunk size to avoid splitting them.
+
+    :param chunks: An iterable of Pandas DataFrames containing the data to be inserted.
+    :param session: SQLAlchemy session object used for the dimension rows.
+    :param load_mode: How rows are written, one of LOAD_MODES. Defaults to 'orm'.
+    :param fact_session: SQLAlchemy session object used for the fact rows. Defaults to session.
+    :param incremental: Whether to append only new or changed records. Defaults to False.
+    :param source: Name of the data source the watermark is kept for. Required in incremental mode.
+    :param since: Timestamp before which rows are skipped in incremental mode. Defaults to None (no rows skipped).
+    :param source_signature: Signature of the source the checkpoints belong to. Defaults to None (no checkpoints).
+    :param batch_sizer: BatchSizer that sets the number of rows per batch. Defaults to None (fixed batch size).
+    :param key_cache: KeyCache of the dimension keys. Defaults to None (see DimensionMapper).
+    :raises ValueError: If the load mode is not supported.
     """
 
-    def __init__(self, df, session):
-        self.df = df
+    def __init__(self, chunks, session, load_mode='orm', fact_session=None, incremental=False, source=None,
+                 since=None, source_signature=None, batch_sizer=None, key_cache=None):
+        if load_mode not in LOAD_MODES:
+            raise ValueError(f"Unsupported load mode '{load_mode}', expected one of {LOAD_MODES}")
+        self.chunks = chunks
         self.session = session
+        self.fact_session = fact_session or session
+        self.load_mode = load_mode
+        self.incremental = incremental
+        self.source = source
+        self.since = since
+        self.source_signature = source_signature
+        self.batch_sizer = batch_sizer
+        self.metrics = IngestMetrics.get_instance()
+        self.watermark_column = ingest_config['watermark_column']
+        self._calendar_keys = set()
         self.batches = self._create_batches()
+        self.dimension_mapper = DimensionMapper(session, KEY_NAME_MAP, key_cache)
 
-        key_name_map = {
-            DistrictDimension: 'district_key',
-            ResolutionDimension: 'resolution_key',
-            CategoryDimension: 'category_key',
-            LocationDimension: 'location_key'
-        }
+    def _get_calendar_keys(self, incident_datetimes):
+        """
+        Returns calendar keys for the given datetimes, inserting the days missing from the calendar dimension
 
-        self.dimension_mapper = DimensionMapper(session, df, key_name_map)
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        Calendar keys are the dates as YYYYMMDD integers, so they are computed from the data. Only days
+        not seen before by this inserter are sent to the database, and ON CONFLICT makes the insert safe
+        when another load has added the same day meanwhile. The days are inserted in key order, so concurrent
+        loads lock them in the same order and do not deadlock.
 
-    def _get_keys(self, dimension_class, num_of_values):
+        :param incident_datetimes: A Pandas Series of incident datetimes.
+        :return: A nullable integer array of calendar keys, one per datetime.
         """
-        Returns keys for the given dimension class
 
-        :param dimension_class: SQLAlchemy declarative base class.
-        :param num_of_values: Number of values to retrieve.
-        :return: List of keys.
+        dates = incident_datetimes.dt.normalize()
+        keys = (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
+
+        new_dates = dates[keys.notna() & ~keys.isin(self._calendar_keys)].drop_duplicates().sort_values()
+        if len(new_dates):
+            values = pd.DataFrame({
+                'key': new_dates.dt.year * 10000 + new_dates.dt.month * 100 + new_dates.dt.day,
+                'incident_date': new_dates.dt.date,
+                'incident_year': new_dates.dt.year,
+                'incident_month': new_dates.dt.month,
+                'incident_day': new_dates.dt.day,
+                'incident_day_of_week': new_dates.dt.day_name()
+            }).to_dict('records')
+            started = time.perf_counter()
+            self.session.execute(insert(CalendarDimension).values(values).on_conflict_do_nothing())
+            self.metrics.record_dimension_insert(CalendarDimension.__tablename__, len(values),
+                                                 time.perf_counter() - started)
+            self._calendar_keys.update(value['key'] for value in values)
+
+        return keys.array
+
+    @staticmethod
+    def _get_time_keys(incident_datetimes):
         """
+        Returns time-of-day keys for the given datetimes
 
-        last_key = self.session.query(dimension_class.key).order_by(dimension_class.key.desc()).first()[0]
-        keys = range(last_key - num_of_values + 1, last_key + 1)
-        return keys
+        Time-of-day keys are the minutes of the day; the dimension is fully populated when it is created.
 
-    def _bulk_insert_and_get_keys(self, batch_df, dimension_class):
+        :param incident_datetimes: A Pandas Series of incident datetimes.
+        :return: A nullable integer array of time-of-day keys, one per datetime.
         """
-        Inserts batch data and returns keys
 
-        :param batch_df: A Pandas DataFrame containing the data to be inserted.
-        :param dimension_class: SQLAlchemy declarative base class.
-        :return: List of keys.
+        return (incident_datetimes.dt.hour * 60 + incident_datetimes.dt.minute).astype('Int64').array
+
+    @staticmethod
+    def get_watermark(session, source):
         """
+        Returns the high-water mark of a data source
 
-        values = batch_df[dimension_class.get_columns()].to_dict('records')
-        self.session.bulk_insert_mappings(dimension_class, values)
-        keys = self._get_keys(dimension_class, len(values))
-        return keys
+        :param session: SQLAlchemy session object.
+        :param source: Name of the data source.
+        :return: The latest value of the watermark column loaded from the source, or None if nothing was loaded.
+        """
 
-    def _create_batches(self, batch_size=10000):
+        watermark = session.get(IngestWatermark, source)
+        return watermark.high_water_mark if watermark is not None else None
+
+    @staticmethod
+    def _raise_watermark(session, source, watermark_column, high_water_mark):
+        """
+        Raises the high-water mark of a data source, leaving a later mark as it is
+
+        :param session: SQLAlchemy session object.
+        :param source: Name of the data source.
+        :param watermark_column: Name of the column the mark is a value of.
+        :param high_water_mark: Datetime of the latest record loaded.
+        """
+
+        stmt = insert(IngestWatermark).values(source=source, watermark_column=watermark_column,
+                                              high_water_mark=high_water_mark)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IngestWatermark.source],
+            set_={'watermark_column': stmt.excluded.watermark_column,
+                  'high_water_mark': func.greatest(IngestWatermark.high_water_mark, stmt.excluded.high_water_mark)}
+        )
+        session.execute(stmt)
+
+    def _advance_watermark(self, fact_df):
+        """
+        Raises the high-water mark of the source to the latest watermark value of a fact batch
+
+        :param fact_df: A Pandas DataFrame with one row of incident attributes and dimension keys per incident.
+        """
+
+        high_water_mark = fact_df[self.watermark_column].max()
+        if not pd.isnull(high_water_mark):
+            self._raise_watermark(self.fact_session, self.source, self.watermark_column,
+                                  high_water_mark.to_pydatetime())
+
+    @staticmethod
+    def record_watermark(session, source):
+        """
+        Raises the high-water mark of a data source to the latest watermark value of the incidents table
+
+        Called once a full load has completed, when the incidents table holds the rows of the whole source, so
+        the first incremental load after it only upserts the records reported since.
+
+        :param session: SQLAlchemy session object.
+        :param source: Name of the data source.
+        """
+
+        watermark_column = ingest_config['watermark_column']
+        high_water_mark = session.query(func.max(Incidents.__table__.c[watermark_column])).scalar()
+        if high_water_mark is not None:
+            BatchInserter._raise_watermark(session, source, watermark_column, high_water_mark)
+
+    @staticmethod
+    def get_checkpoint(session, source):
+        """
+        Returns the last committed checkpoint of a data source
+
+        :param session: SQLAlchemy session object.
+        :param source: Name of the data source.
+        :return: IngestCheckpoint object, or None if no batch of the source was committed yet.
+        """
+
+        return session.get(IngestCheckpoint, source)
+
+    @staticmethod
+    def clear_checkpoint(session, source):
+        """
+        Removes the checkpoint of a data source, so the next load starts from the beginning
+
+        :param session: SQLAlchemy session object.
+        :param source: Name of the data source.
+        """
+
+        session.query(IngestCheckpoint).filter(IngestCheckpoint.source == source).delete()
+        session.commit()
+
+    def _save_checkpoint(self, rows_done):
+        """
+        Records the source rows covered by a fact batch, in the transaction of the fact session
+
+        :param rows_done: Number of source rows covered once the batch is committed.
+        """
+
+        stmt = insert(IngestCheckpoint).values(source=self.source, source_signature=self.source_signature,
+                                               rows_done=rows_done, updated_at=func.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IngestCheckpoint.source],
+            set_={'source_signature': stmt.excluded.source_signature, 'rows_done': stmt.excluded.rows_done,
+                  'updated_at': stmt.excluded.updated_at}
+        )
+        self.fact_session.execute(stmt)
+
+    @staticmethod
+    def get_rows_done(batch_df):
+        """
+        Returns the number of source rows covered once a batch is committed
+
+        :param batch_df: A Pandas DataFrame indexed by the position of its rows in the source.
+        :return: Position after the last row of the batch.
+        """
+
+        return int(batch_df.index.max()) + 1
+
+    def _upsert_rows(self, model_class, df, session):
+        """
+        Inserts the rows of a DataFrame, updating rows with the same row_id, using the configured load mode.
+
+        :param model_class: SQLAlchemy declarative base class with a unique row_id column.
+        :param df: A Pandas DataFrame whose columns match the columns of the table.
+        :param session: SQLAlchemy session object the rows are written through.
+        :return: Number of rows inserted or updated.
+        """
+
+        if self.load_mode == 'copy':
+            return CopyWriter(session).upsert(model_class, df, 'row_id')
+
+        values = df.astype(object).where(pd.notnull(df), None).to_dict('records')
+        if not values:
+            return 0
+        stmt = insert(model_class).values(values)
+        updated_columns = [column for column in df.columns if column != 'row_id']
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[model_class.row_id],
+            set_={column: stmt.excluded[column] for column in updated_columns},
+            where=tuple_(*[model_class.__table__.c[column] for column in updated_columns]).is_distinct_from(
+                tuple_(*[stmt.excluded[column] for column in updated_columns]))
+        )
+        return session.execute(stmt).rowcount
+
+    def _write_rows(self, model_class, df, session):
+        """
+        Writes the rows of a DataFrame into the table of a model class using the configured load mode.
+
+        :param model_class: SQLAlchemy declarative base class.
+        :param df: A Pandas DataFrame whose columns match the columns of the table.
+        :param session: SQLAlchemy session object the rows are written through.
+        :return: Number of rows written.
+        """
+
+        if self.load_mode == 'copy':
+            return CopyWriter(session).write(model_class, df)
+
+        values = df.astype(object).where(pd.notnull(df), None).to_dict('records')
+        session.bulk_insert_mappings(model_class, values)
+        return len(values)
+
+    def _create_batches(self, batch_size=None):
         """
         Yields data in batches
 
-        :param batch_size: Size of each batch. Defaults to 10000.
+        Chunks larger than the batch size are split, smaller chunks are passed through as they are. The time
+        spent reading the chunks is recorded as the read_source stage of the ingest metrics.
+
+        :param batch_size: Size of each batch, unless set by the batch sizer. Defaults to the configured batch size.
         :return: A batch of data.
         """
 
-        for start_idx in range(0, len(self.df), batch_size):
-            yield self.df.iloc[start_idx:start_idx + batch_size]
+        batch_size = batch_size or ingest_config['batch_size']
+        chunks = iter(self.chunks)
+        while True:
+            with self.metrics.time_stage('read_source'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            if self.batch_sizer is not None:
+                self.batch_sizer.observe(chunk)
+                batch_size = self.batch_sizer.get_size()
+            self.metrics.set_batch_size(batch_size)
+            for start_idx in range(0, len(chunk), batch_size):
+                yield chunk.iloc[start_idx:start_idx + batch_size]
+
+    def insert_dimensions(self, batch_df, commit=True):
+        """
+        Inserts the dimension rows of one batch and resolves the keys of its fact rows
+
+        In incremental mode rows that are not later than 'since' are dropped from the batch first.
+
+        :param batch_df: A Pandas DataFrame containing one batch of data.
+        :param commit: Whether to commit the dimension session after insertion. Defaults to True.
+        :return: A Pandas DataFrame with one row of incident attributes and dimension keys per incident.
+        """
+
+        started = time.perf_counter()
+        self.session.autoflush = False
+
+        if self.incremental and self.since is not None:
+            batch_df = batch_df[batch_df[self.watermark_column] > self.since]
+
+        fact_df = batch_df[INCIDENT_ATTRIBUTES].assign(
+            calendar_key=self._get_calendar_keys(batch_df['incident_datetime']),
+            time_key=self._get_time_keys(batch_df['incident_datetime']),
+            **self.dimension_mapper.get_key_arrays(batch_df)
+        )
+
+        if commit:
+            with self.metrics.time_stage('commit'):
+                self.session.commit()
+
+        self.metrics.record_batch('dimensions', time.perf_counter() - started)
+        return fact_df
+
+    def insert_facts(self, fact_df, commit=True, source_rows=None, rows_done=None):
+        """
+        Inserts the fact rows of one batch
+
+        :param fact_df: A Pandas DataFrame with one row of incident attributes and dimension keys per incident.
+        :param commit: Whether to commit the fact session after insertion. Defaults to True.
+        :param source_rows: Number of rows of the batch before incremental filtering. Defaults to the rows of fact_df.
+        :param rows_done: Position after the last source row of the batch before incremental filtering, see
+                          get_rows_done. Defaults to the position after the last row of fact_df, and no checkpoint
+                          is saved for an empty fact_df.
+        :return: Number of rows added, or in incremental mode the number of rows inserted or updated.
+        """
+
+        started = time.perf_counter()
+
+        with self.metrics.time_stage('insert_facts'):
+            if self.incremental:
+                rows_added = self._upsert_rows(Incidents, fact_df, self.fact_session)
+                self._advance_watermark(fact_df)
+            else:
+                rows_added = self._write_rows(Incidents, fact_df, self.fact_session)
+
+            if rows_done is None and not fact_df.empty:
+                rows_done = self.get_rows_done(fact_df)
+            if self.source_signature is not None and rows_done is not None:
+                self._save_checkpoint(rows_done)
+
+        if commit:
+            with self.metrics.time_stage('commit'):
+                self.fact_session.commit()
+
+        batch_seconds = time.perf_counter() - started
+        self.metrics.record_batch('facts', batch_seconds)
+        if self.batch_sizer is not None:
+            self.batch_sizer.record(len(fact_df) if source_rows is None else source_rows, batch_seconds)
+
+        return rows_added
 
     def insert_one_batch(self, commit=True):
         """
         Inserts one batch of data
 
-        :param commit: Whether to commit the session after insertion. Defaults to True.
+        :param commit: Whether to commit the sessions after insertion. Defaults to True.
         :return: A tuple containing a boolean indicating whether insertion was successful, and the number of rows added.
         """
 
@@ -105,27 +423,81 @@ class BatchInserter:
         except StopIteration:
             return False, 0
 
-        self.session.autoflush = False
+        fact_df = self.insert_dimensions(batch_df, commit)
+        return True, self.insert_facts(fact_df, commit, len(batch_df), self.get_rows_done(batch_df))
+
 
-        date_keys = self.executor.submit(self._bulk_insert_and_get_keys, batch_df, DateDimension).result()
-        incident_detail_keys = self.executor.submit(self._bulk_insert_and_get_keys, batch_df,
-                                                    IncidentDetailsDimension).result()
+def create_batch_sizer():
+    """
+    Creates a BatchSizer from the ingest configuration.
+
+    :return: A BatchSizer, or None if adaptive batching is disabled.
+    """
 
-        batch_values = [
-            {
-                **self.dimension_mapper.get_keys(row),
-                'date_key': date_keys[idx],
-                'incident_details_key': incident_detail_keys[idx]
-            }
-            for idx, row in enumerate(batch_df.itertuples(index=False))
-        ]
+    if not ingest_config['adaptive_batching']:
+        return None
+    return BatchSizer(ingest_config['batch_size'], ingest_config['batch_size_min'], ingest_config['batch_size_max'],
+                      ingest_config['batch_max_memory_mb'] * 2 ** 20, ingest_config['batch_max_commit_seconds'])
 
-        self.session.bulk_insert_mappings(Incidents, batch_values)
 
-        if commit:
-            self.session.commit()
+# Key cache of a worker process of a partitioned load, shared by the partitions the worker loads
+_partition_key_cache = None
 
-        return True, len(batch_values)
+
+def init_partition_worker():
+    """
+    Prepares a worker process of a partitioned load.
+
+    The key cache snapshot is loaded once per worker process, instead of once per partition.
+    """
+
+    global _partition_key_cache
+    db_manager = PostgreSQLManager.get_instance()
+    session = db_manager.Session.session_factory()
+    try:
+        _partition_key_cache = DimensionMapper(session, KEY_NAME_MAP).key_cache
+    finally:
+        session.close()
+
+
+def insert_partition(skip_rows, num_rows, load_mode, incremental=False, source=None, since=None):
+    """
+    Loads one partition of the source, a range of consecutive rows, in a worker process.
+
+    The worker opens its own engine and session, and resolves the dimension keys of the partition itself,
+    inserting the dimension records that are missing (see DimensionMapper). The key cache of the worker
+    process is shared by its partitions, and only the keys used by this partition are returned, to be added to
+    the key cache snapshot of the next load.
+
+    :param skip_rows: Number of source rows before the partition.
+    :param num_rows: Number of rows in the partition.
+    :param load_mode: How rows are written, one of LOAD_MODES.
+    :param incremental: Whether to append only new or changed records. Defaults to False.
+    :param source: Name of the data source the watermark is kept for. Required in incremental mode.
+    :param since: Timestamp before which rows are skipped in incremental mode. Defaults to None.
+    :return: A tuple with the number of rows added, the number of source rows processed, a snapshot of the
+             ingest metrics of the partition and the key cache entries it used.
+    """
+
+    metrics = IngestMetrics.get_instance()
+    # A worker process may load several partitions, the snapshot covers only this one
+    metrics.reset()
+    db_manager = PostgreSQLManager.get_instance()
+    session = db_manager.Session.session_factory()
+    try:
+        batch_sizer = create_batch_sizer()
+        chunksize = batch_sizer.get_size if batch_sizer is not None else ingest_config['batch_size']
+        chunks = DataLoader.get_instance().iter_chunks(chunksize, skip_rows, num_rows)
+        inserter = BatchInserter(chunks, session, load_mode, incremental=incremental, source=source, since=since,
+                                 batch_sizer=batch_sizer, key_cache=_partition_key_cache)
+        rows_added = source_rows = 0
+        for batch_df in inserter.batches:
+            rows_added += inserter.insert_facts(inserter.insert_dimensions(batch_df), source_rows=len(batch_df))
+            source_rows += len(batch_df)
+        return rows_added, source_rows, metrics.snapshot(), inserter.dimension_mapper.get_used_entries()
+    finally:
+        session.close()
+        db_manager.disconnect()
 
 
 class InsertTask(metaclass=Singleton):
@@ -136,39 +508,200 @@ class InsertTask(metaclass=Singleton):
     def __init__(self):
         self.total_rows_added = 0
         self._inserter = None
-        self.df = None
-        self.total_batches = 0
+        self.rows_done = 0
+        self.total_rows = 0
         self.progress = 0
         self.running = False
+        self.stage_times = {}
+        self.metrics = IngestMetrics.get_instance()
+
+    def _on_batch_inserted(self, batch_rows_added, source_rows):
+        """
+        Updates the progress after a batch has been committed.
+
+        Progress is the share of source rows processed, so it does not depend on the size of the batches.
+
+        :param batch_rows_added: Number of rows added by the batch.
+        :param source_rows: Number of source rows the batch was built from.
+        """
 
-    def run(self):
+        self.rows_done += source_rows
+        self.total_rows_added += batch_rows_added
+        self.metrics.record_rows(batch_rows_added, source_rows)
+        self.progress = min(self.rows_done / max(self.total_rows, 1), 1) * 100
+
+    def _run_partitioned(self, data_loader, session, load_mode, workers, skip_rows, incremental, source, since):
+        """
+        Loads the source in partitions of consecutive rows processed by a pool of worker processes.
+
+        Every worker resolves the dimension keys of its own partition, so no part of the load runs serially in
+        this process. Workers that meet the same new dimension records insert them concurrently; ON CONFLICT DO
+        NOTHING on the natural key index keeps a single copy, and the records are inserted in natural key order,
+        so the workers lock them in the same order and do not deadlock. Every worker process loads the key cache
+        snapshot once, and the keys used by each partition are merged into the snapshot of the next load.
+        Progress is updated as partitions complete.
+
+        :param data_loader: DataLoader of the source.
+        :param session: SQLAlchemy session object used to save the key cache.
+        :param load_mode: How rows are written, one of LOAD_MODES.
+        :param workers: Number of worker processes.
+        :param skip_rows: Number of source rows to skip.
+        :param incremental: Whether to append only new or changed records.
+        :param source: Name of the data source.
+        :param since: Timestamp before which rows are skipped in incremental mode.
+        """
+
+        started = time.perf_counter()
+        dimension_mapper = DimensionMapper(session, KEY_NAME_MAP)
+        total_rows = data_loader.count_rows()
+        partition_rows = max(min(ingest_config['partition_rows'], -(-(total_rows - skip_rows) // workers)), 1)
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_partition_worker) as executor:
+            futures = [executor.submit(insert_partition, start, partition_rows, load_mode, incremental, source, since)
+                       for start in range(skip_rows, total_rows, partition_rows)]
+            try:
+                for future in as_completed(futures):
+                    rows_added, source_rows, metrics_snapshot, key_entries = future.result()
+                    self.metrics.merge(metrics_snapshot)
+                    dimension_mapper.key_cache.put_entries(key_entries)
+                    self._on_batch_inserted(rows_added, source_rows)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+        dimension_mapper.save_key_cache()
+        self.stage_times['partitions'] = time.perf_counter() - started
+
+    def run(self, load_mode=None, incremental=False, resume=False, workers=None, bulk_load=False):
         """
-        Loads data and runs the batch insertion task.
+        Streams data from the source file and runs the batch insertion task.
+
+        Reading, dimension writes and fact writes run as concurrent stages of an IngestPipeline, each
+        database stage on its own session and pooled connection. With more than one worker the source is
+        instead split into partitions that are loaded by a pool of processes (see _run_partitioned).
+
+        An incremental run skips the rows older than the high-water mark of the source minus the configured
+        lookback, which leaves room for records that were changed after they were first loaded, and upserts
+        the rest. Any other run inserts the rows of the whole source, which collide with loaded rows on their
+        unique row_id, so it is rejected unless the incidents table is empty or the run resumes an interrupted
+        load; once it completes, it sets the high-water mark to the latest record loaded. An incremental run is
+        rejected while incidents without a row_id, as migrated from the old schema, could not be matched.
+
+        Every fact batch commits a checkpoint of the source rows it covers. A resumed run skips the rows
+        of the last checkpoint, provided the source file has not changed since; otherwise the load starts over.
+        Partitions complete out of order, so a partitioned load does not write checkpoints.
+
+        After a successful run the aggregates of the dashboard queries are refreshed with the loaded incidents
+        (see PostgreSQLManager.refresh_aggregates), and the dimension keys it resolved are saved as a snapshot of
+        the key cache, so the next run starts warm (see DimensionMapper).
+
+        The seconds spent in each stage of the last run are kept in stage_times, and the timings of the hot path,
+        batch latencies and throughput in the ingest metrics (see IngestMetrics), which are reset when a run starts.
+
+        A bulk load drops the foreign keys, unique constraints and secondary indexes of the incidents table before
+        loading and restores them afterwards (see PostgreSQLManager.defer_fact_constraints), so they are built
+        once instead of being maintained row by row. Any other run first restores the constraints left deferred
+        by an interrupted bulk load.
+
+        :param load_mode: How rows are written, one of LOAD_MODES. Defaults to the configured load mode.
+        :param incremental: Whether to append only new or changed records. Defaults to False.
+        :param resume: Whether to continue from the last committed batch of an interrupted run. Defaults to False.
+        :param workers: Number of worker processes. Defaults to the configured number of workers.
+        :param bulk_load: Whether to load without constraints and indexes on the incidents table. Defaults to False.
+        :raises ValueError: If a bulk load is requested in incremental mode, which upserts on the unique row_id,
+                            if a full load is started while the incidents table holds rows, or if an incremental
+                            load is started while incidents have no row_id.
         """
 
+        if bulk_load and incremental:
+            raise ValueError("An incremental load cannot be a bulk load, upserts need the unique row_id constraint")
+
         self.running = True
-        self.df = DataLoader.get_instance().load_data()
+        self.metrics.reset()
+        data_loader = DataLoader.get_instance()
         db_manager = PostgreSQLManager.get_instance()
         db_manager.connect()
-        session = db_manager.Session()
-        self._inserter = BatchInserter(self.df, session)
-
-        self.total_batches = -(-len(self.df) // 10000)
-        current_batch = 0
-        self.total_rows_added = 0
-        self.progress = 0
-        success = True
-
-        while success:
-            success, batch_rows_added = self._inserter.insert_one_batch()
-            current_batch += 1
-            self.total_rows_added += batch_rows_added
-            self.progress = (current_batch / self.total_batches) * 100
+        dimension_session = db_manager.Session.session_factory()
+        fact_session = db_manager.Session.session_factory()
 
-        session.commit()
-        session.close()
-        self._inserter = None
-        self.running = False
+        try:
+            source = data_loader.get_source_name()
+            source_signature = data_loader.get_source_signature()
+            skip_rows = 0
+            if resume:
+                checkpoint = BatchInserter.get_checkpoint(fact_session, source)
+                if checkpoint is not None and checkpoint.source_signature == source_signature:
+                    skip_rows = checkpoint.rows_done
+            if not incremental and not skip_rows and db_manager.has_incidents():
+                raise ValueError("A full load needs an empty incidents table, recreate the tables or load "
+                                 "incrementally")
+            if incremental and db_manager.has_unkeyed_incidents():
+                raise ValueError("An incremental load needs the row_id of every incident, recreate the tables "
+                                 "and load them in full")
+            if not skip_rows:
+                BatchInserter.clear_checkpoint(fact_session, source)
+
+            since = None
+            if incremental:
+                high_water_mark = BatchInserter.get_watermark(fact_session, source)
+                if high_water_mark is not None:
+                    since = high_water_mark - datetime.timedelta(days=ingest_config['watermark_lookback_days'])
+
+            load_mode = load_mode or ingest_config['load_mode']
+            workers = workers or ingest_config['workers']
+
+            self.total_rows = data_loader.count_rows()
+            self.rows_done = skip_rows
+            self.total_rows_added = 0
+            self.progress = 0
+            self.stage_times = {}
+
+            started = time.perf_counter()
+            db_manager.create_indexes()
+            # Counts the incidents loaded before, so the refresh after this run only adds the new ones
+            db_manager.ensure_aggregates()
+            if bulk_load:
+                db_manager.defer_fact_constraints(ingest_config['bulk_load_unlogged'])
+            else:
+                db_manager.restore_fact_constraints()
+            self.stage_times['prepare'] = time.perf_counter() - started
+
+            try:
+                if workers > 1:
+                    self._run_partitioned(data_loader, dimension_session, load_mode, workers, skip_rows,
+                                          incremental, source, since)
+                else:
+                    batch_sizer = create_batch_sizer()
+                    chunksize = batch_sizer.get_size if batch_sizer is not None else ingest_config['batch_size']
+                    self._inserter = BatchInserter(data_loader.iter_chunks(chunksize, skip_rows), dimension_session,
+                                                   load_mode, fact_session, incremental, source, since,
+                                                   source_signature, batch_sizer)
+                    pipeline = IngestPipeline(self._inserter, ingest_config['pipeline_queue_size'])
+                    pipeline.run(self._on_batch_inserted)
+                    self.stage_times.update(pipeline.stage_times)
+                    self._inserter.dimension_mapper.save_key_cache()
+            finally:
+                if bulk_load:
+                    started = time.perf_counter()
+                    db_manager.restore_fact_constraints()
+                    self.stage_times['restore_constraints'] = time.perf_counter() - started
+
+            if not incremental:
+                BatchInserter.record_watermark(fact_session, source)
+                fact_session.commit()
+
+            started = time.perf_counter()
+            db_manager.refresh_aggregates()
+            self.stage_times['refresh_aggregates'] = time.perf_counter() - started
+        finally:
+            dimension_session.close()
+            fact_session.close()
+            self._inserter = None
+            self.metrics.finish()
+            # Committed batches change the results of the dashboard queries, even if the run failed
+            ResultCache.invalidate_all()
+            self.running = False
 
 
 class ActionLock(metaclass=Singleton):
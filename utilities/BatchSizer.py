@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pandas as pd
+
+
+class BatchSizer:
+    """
+    Adapts the number of rows per batch to the measured throughput of a load.
+
+    After each committed batch the throughput since the previous commit is compared with the throughput of the
+    previous batch size. The size keeps moving in the same direction, growing or shrinking by a constant factor,
+    while the throughput improves, and turns around when it drops, so it settles around the best size for the
+    current rows and server load. A batch whose commit takes longer than the configured latency shrinks the size
+    regardless of throughput.
+
+    The size always stays within the configured bounds, and below the number of rows that fit in the memory
+    ceiling, estimated from the memory used by the rows read so far.
+
+    Batches are read ahead of the commits, so only batches read at the current size are used to decide on the
+    next one. The sizer is shared by the threads of an IngestPipeline and is thread-safe.
+
+    :param initial_size: Number of rows of the first batches.
+    :param min_size: Smallest number of rows per batch.
+    :param max_size: Largest number of rows per batch.
+    :param max_batch_bytes: Largest amount of memory a batch may use, in bytes.
+    :param max_commit_seconds: Longest acceptable time to write and commit a batch.
+    :param growth: Factor the size is multiplied or divided by at each step. Defaults to 1.5.
+    :param tolerance: Relative drop in throughput that is still treated as noise. Defaults to 0.05.
+    """
+
+    def __init__(self, initial_size, min_size, max_size, max_batch_bytes, max_commit_seconds, growth=1.5,
+                 tolerance=0.05):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_commit_seconds = max_commit_seconds
+        self.growth = growth
+        self.tolerance = tolerance
+        self._lock = threading.Lock()
+        self._row_bytes = None
+        self._direction = 1
+        self._previous_throughput = None
+        self._last_commit = None
+        self._size = self._clamp(initial_size)
+
+    def _clamp(self, size):
+        """
+        Keep a batch size within the bounds and the memory ceiling.
+
+        :param size: Proposed number of rows.
+        :return: Number of rows to use.
+        """
+        max_size = self.max_size
+        if self._row_bytes:
+            max_size = min(max_size, int(self.max_batch_bytes / self._row_bytes))
+        return int(max(self.min_size, min(size, max_size)))
+
+    def get_size(self):
+        """
+        Get the number of rows of the next batch.
+
+        :return: Number of rows.
+        """
+        with self._lock:
+            return self._size
+
+    def observe(self, batch_df):
+        """
+        Update the estimate of the memory used per row from a batch that was read.
+
+        The categories of categorical columns are shared by all batches, so only their codes are counted.
+
+        :param batch_df: A Pandas DataFrame of source rows.
+        """
+        if batch_df.empty:
+            return
+        sample = batch_df.head(1000)
+        row_bytes = sum(column.cat.codes.dtype.itemsize if isinstance(column.dtype, pd.CategoricalDtype)
+                        else column.memory_usage(deep=True, index=False) / len(sample)
+                        for _, column in sample.items())
+        with self._lock:
+            self._row_bytes = row_bytes if self._row_bytes is None else max(self._row_bytes, row_bytes)
+            self._size = self._clamp(self._size)
+
+    def record(self, rows, commit_seconds):
+        """
+        Record a committed batch and adapt the batch size.
+
+        :param rows: Number of source rows of the batch.
+        :param commit_seconds: Time taken to write and commit the batch.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            interval = now - self._last_commit if self._last_commit is not None else commit_seconds
+            self._last_commit = now
+            if rows != self._size or interval <= 0:
+                return
+
+            throughput = rows / interval
+            if commit_seconds > self.max_commit_seconds:
+                self._direction = -1
+            elif self._previous_throughput is not None \
+                    and throughput < self._previous_throughput * (1 - self.tolerance):
+                self._direction = -self._direction
+            self._previous_throughput = throughput
+
+            size = self._size * self.growth if self._direction > 0 else self._size / self.growth
+            self._size = self._clamp(size)
@@ -0,0 +1,319 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+# Bump when the layout of the cache files or the dtypes of the cached columns change
+CACHE_FORMAT_VERSION = 2
+
+
+class ColumnarCache:
+    """
+    A typed, columnar on-disk cache of a CSV source.
+
+    Every column is stored as a raw binary file that is memory-mapped on load, so reading the cache costs
+    little more than the page faults of the columns that are used. Datetimes are stored as int64
+    nanoseconds and nullable integers as values plus a mask. Categorical columns are dictionary-encoded:
+    they hold int32 codes into the list of distinct values kept in the manifest, and load as categoricals.
+    Other string columns, whose values are mostly distinct, are stored as their UTF-8 bytes, the end offset
+    of every value and a mask, so the manifest stays small however many rows the source has.
+
+    A manifest records the signature of the source the cache was built from, so a cache is only used
+    while the source file is unchanged.
+
+    :param cache_dir: Directory holding the cache files of one source.
+    :param signature: Signature of the current source file.
+    """
+
+    def __init__(self, cache_dir, signature):
+        self.cache_dir = cache_dir
+        self.signature = signature
+        self._manifest = None
+
+    def _read_manifest(self):
+        """
+        Read the manifest of the cache if it matches the current source.
+
+        :return: Manifest dictionary, or None if there is no valid cache.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, 'manifest.json')) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != CACHE_FORMAT_VERSION or manifest.get('signature') != self.signature:
+            return None
+        return manifest
+
+    def is_valid(self):
+        """
+        Check whether the cache exists and was built from the current source.
+
+        :return: True if the cache can be used, False otherwise.
+        """
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+        return self._manifest is not None
+
+    def get_row_count(self):
+        """
+        Get the number of cached rows.
+
+        :return: Number of rows of the source.
+        """
+        return self._manifest['rows']
+
+    def writer(self):
+        """
+        Create a writer that builds a new cache from a stream of chunks.
+
+        :return: ColumnarCacheWriter object.
+        """
+        return ColumnarCacheWriter(self)
+
+    def _open_columns(self, columns=None):
+        """
+        Memory-map the files of the cached columns.
+
+        :param columns: List of column names to open. Defaults to all cached columns.
+        :return: Dictionary that maps column names to tuples of column kind and opened arrays.
+        """
+        rows = self._manifest['rows']
+        opened = {}
+        for column in self._manifest['columns']:
+            name, kind = column['name'], column['kind']
+            if columns is not None and name not in columns:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            if kind == 'category':
+                arrays = (np.memmap(f'{path}.codes', dtype=np.int32, mode='r', shape=(rows,)),
+                          pd.Index(self._manifest['categories'][name], dtype=object))
+            elif kind == 'string':
+                # An empty file cannot be memory-mapped, as when all values are missing or empty
+                data = (np.memmap(f'{path}.data', dtype=np.uint8, mode='r') if os.path.getsize(f'{path}.data')
+                        else np.zeros(0, dtype=np.uint8))
+                arrays = (np.memmap(f'{path}.offsets', dtype=np.int64, mode='r', shape=(rows,)),
+                          np.memmap(f'{path}.mask', dtype=np.bool_, mode='r', shape=(rows,)), data)
+            elif kind == 'nullable_int':
+                arrays = (np.memmap(f'{path}.values', dtype=np.int64, mode='r', shape=(rows,)),
+                          np.memmap(f'{path}.mask', dtype=np.bool_, mode='r', shape=(rows,)))
+            else:
+                dtype = np.float64 if kind == 'float' else np.int64
+                arrays = (np.memmap(f'{path}.values', dtype=dtype, mode='r', shape=(rows,)),)
+            opened[name] = (kind, arrays)
+        return opened
+
+    @staticmethod
+    def _to_column(kind, arrays, start, end):
+        """
+        Build a pandas column from a slice of memory-mapped arrays.
+
+        :param kind: Kind of the column as recorded in the manifest.
+        :param arrays: Tuple of arrays returned by _open_columns.
+        :param start: First row of the slice.
+        :param end: Row after the last row of the slice.
+        :return: Array-like column.
+        """
+        if kind == 'category':
+            codes, categories = arrays
+            return pd.Categorical.from_codes(codes[start:end], categories=categories)
+        if kind == 'nullable_int':
+            values, mask = arrays
+            return pd.arrays.IntegerArray(values[start:end], mask[start:end])
+        if kind == 'string':
+            ends, mask, data = arrays
+            begin = int(ends[start - 1]) if start else 0
+            ends = ends[start:end].tolist()
+            buffer = bytes(data[begin:ends[-1]]) if ends else b''
+            values = np.empty(end - start, dtype=object)
+            value_start = begin
+            for index, value_end in enumerate(ends):
+                values[index] = buffer[value_start - begin:value_end - begin].decode('utf-8')
+                value_start = value_end
+            values[mask[start:end]] = np.nan
+            return values
+        if kind == 'datetime':
+            return arrays[0][start:end].view('datetime64[ns]')
+        return arrays[0][start:end]
+
+    def iter_chunks(self, chunksize=10000, skip_rows=0, max_rows=None):
+        """
+        Stream the cached data as a sequence of DataFrames.
+
+        The index of each chunk holds the position of its rows in the source, counting from 0.
+
+        :param chunksize: Number of rows in each chunk, or a function returning the number of rows of the next
+                          chunk. Defaults to 10000.
+        :param skip_rows: Number of rows to skip at the start. Defaults to 0.
+        :param max_rows: Maximum number of rows to read after the skipped ones. Defaults to all rows.
+        :return: Generator of DataFrames containing consecutive rows of the source.
+        """
+        opened = self._open_columns()
+        stop = self._manifest['rows'] if max_rows is None else min(skip_rows + max_rows, self._manifest['rows'])
+        start = skip_rows
+        while start < stop:
+            end = min(start + (chunksize() if callable(chunksize) else chunksize), stop)
+            yield pd.DataFrame({name: self._to_column(kind, arrays, start, end)
+                                for name, (kind, arrays) in opened.items()},
+                               index=pd.RangeIndex(start, end))
+            start = end
+
+    def load_frame(self, columns=None):
+        """
+        Load the cached data as one DataFrame.
+
+        :param columns: List of column names to load. Defaults to all cached columns.
+        :return: DataFrame containing all rows of the source.
+        """
+        opened = self._open_columns(columns)
+        return pd.DataFrame({name: self._to_column(kind, arrays, 0, self._manifest['rows'])
+                             for name, (kind, arrays) in opened.items()})
+
+
+class ColumnarCacheWriter:
+    """
+    Builds a ColumnarCache from a stream of typed chunks.
+
+    Chunks are appended to column files in a temporary directory. The cache only replaces the previous
+    one when commit is called after the last chunk, so an interrupted stream never leaves a partial cache.
+
+    :param cache: ColumnarCache object to build.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._tmp_dir = f"{cache.cache_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(self._tmp_dir)
+        self._files = {}
+        self._columns = None
+        self._categories = {}
+        self._string_ends = {}
+        self._rows = 0
+
+    @staticmethod
+    def _column_kind(series):
+        """
+        Determine how a column is stored from its dtype.
+
+        :param series: A column of the first chunk.
+        :return: Kind of the column.
+        """
+        if pd.api.types.is_datetime64_dtype(series):
+            return 'datetime'
+        if isinstance(series.dtype, pd.Int64Dtype):
+            return 'nullable_int'
+        if pd.api.types.is_float_dtype(series):
+            return 'float'
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return 'category'
+        return 'string'
+
+    def _write(self, name, suffix, array):
+        """
+        Append an array to a column file.
+
+        :param name: Column name.
+        :param suffix: Suffix of the column file.
+        :param array: NumPy array to append.
+        """
+        key = f'{name}.{suffix}'
+        if key not in self._files:
+            self._files[key] = open(os.path.join(self._tmp_dir, key), 'wb')
+        array.tofile(self._files[key])
+
+    def _encode(self, name, series):
+        """
+        Dictionary-encode a categorical column against the distinct values seen so far.
+
+        Only the categories of the chunk are looked up, the codes are translated as an array.
+
+        :param name: Column name.
+        :param series: A categorical column of a chunk.
+        :return: NumPy array of int32 codes, -1 for missing values.
+        """
+        categories = self._categories[name]
+        lookup = np.array([categories.setdefault(value, len(categories)) for value in series.cat.categories],
+                          dtype=np.int32)
+        codes = series.cat.codes.to_numpy()
+        return np.where(codes >= 0, lookup[codes] if len(lookup) else -1, -1).astype(np.int32)
+
+    def _write_strings(self, name, series):
+        """
+        Append a string column as UTF-8 bytes, the end offset of every value and a mask of missing values.
+
+        :param name: Column name.
+        :param series: A string column of a chunk.
+        """
+        mask = series.isna().to_numpy()
+        encoded = [b'' if missing else str(value).encode('utf-8')
+                   for value, missing in zip(series.to_numpy(dtype=object), mask)]
+        ends = self._string_ends.get(name, 0) + np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64,
+                                                                       count=len(encoded)))
+        if len(ends):
+            self._string_ends[name] = int(ends[-1])
+        self._write(name, 'offsets', ends)
+        self._write(name, 'mask', mask)
+        self._write(name, 'data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def append(self, chunk):
+        """
+        Append a chunk to the cache.
+
+        :param chunk: DataFrame with the same columns and dtypes as the previous chunks.
+        """
+        if self._columns is None:
+            self._columns = [{'name': name, 'kind': self._column_kind(chunk[name])} for name in chunk.columns]
+            self._categories = {column['name']: {} for column in self._columns if column['kind'] == 'category'}
+
+        for column in self._columns:
+            name, kind = column['name'], column['kind']
+            series = chunk[name]
+            if kind == 'category':
+                self._write(name, 'codes', self._encode(name, series))
+            elif kind == 'string':
+                self._write_strings(name, series)
+            elif kind == 'nullable_int':
+                self._write(name, 'values', series.to_numpy(dtype=np.int64, na_value=0))
+                self._write(name, 'mask', series.isna().to_numpy())
+            elif kind == 'datetime':
+                self._write(name, 'values', series.to_numpy().view(np.int64))
+            else:
+                self._write(name, 'values', series.to_numpy(dtype=np.float64))
+        self._rows += len(chunk)
+
+    def _close_files(self):
+        """
+        Close all open column files.
+        """
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+    def commit(self):
+        """
+        Write the manifest and replace the previous cache with the new one.
+        """
+        self._close_files()
+        manifest = {
+            'version': CACHE_FORMAT_VERSION,
+            'signature': self.cache.signature,
+            'rows': self._rows,
+            'columns': self._columns or [],
+            'categories': {name: list(categories) for name, categories in self._categories.items()}
+        }
+        with open(os.path.join(self._tmp_dir, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file)
+
+        shutil.rmtree(self.cache.cache_dir, ignore_errors=True)
+        os.replace(self._tmp_dir, self.cache.cache_dir)
+        self.cache._manifest = manifest
+
+    def discard(self):
+        """
+        Remove the files written so far, if the cache was not committed.
+        """
+        self._close_files()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -0,0 +1,124 @@
+import io
+
+import pandas as pd
+from sqlalchemy import Integer, text
+
+
+class CopyWriter:
+    """
+    Writes DataFrames into PostgreSQL tables through ``COPY ... FROM STDIN``.
+
+    The DataFrame is serialized to CSV in memory and streamed to the server in one COPY statement,
+    which avoids building a Python dict per row and sending one INSERT per row. The COPY runs on the
+    connection of the given session, so it takes part in the session's transaction. Rows can also be
+    merged into existing data through a temporary staging table.
+
+    :param session: SQLAlchemy session object.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    @staticmethod
+    def _prepare_frame(table, columns, df):
+        """
+        Select the columns to copy and align their dtypes with the target table.
+
+        Integer columns that pandas promoted to float because of missing values are converted to the
+        nullable integer dtype, otherwise they would be written as '1.0' and rejected by PostgreSQL.
+
+        :param table: SQLAlchemy Table object the data is copied into.
+        :param columns: List of column names to copy.
+        :param df: A Pandas DataFrame containing the data to be copied.
+        :return: A Pandas DataFrame ready to be serialized.
+        """
+        frame = df[columns]
+        for column in columns:
+            if isinstance(table.c[column].type, Integer) and pd.api.types.is_float_dtype(frame[column]):
+                frame = frame.assign(**{column: frame[column].astype('Int64')})
+        return frame
+
+    def _copy(self, table_name, columns, frame):
+        """
+        Stream a prepared DataFrame into a table with COPY.
+
+        :param table_name: Name of the target table.
+        :param columns: List of column names to copy.
+        :param frame: A Pandas DataFrame with exactly the columns to copy.
+        """
+        buffer = io.StringIO()
+        frame.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        statement = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(statement, buffer)
+        finally:
+            cursor.close()
+
+    def write(self, model_class, df, columns=None):
+        """
+        Copy the rows of a DataFrame into the table of a model class.
+
+        Missing values are written as empty unquoted fields, which COPY in CSV format loads as NULL.
+
+        :param model_class: SQLAlchemy declarative base class of the target table.
+        :param df: A Pandas DataFrame containing the data to be copied.
+        :param columns: List of column names to copy. Defaults to all DataFrame columns.
+        :return: Number of rows copied.
+        """
+        table = model_class.__table__
+        columns = list(columns if columns is not None else df.columns)
+        self._copy(table.name, columns, self._prepare_frame(table, columns, df))
+        return len(df)
+
+    def stage(self, model_class, df, columns=None):
+        """
+        Copy the rows of a DataFrame into a temporary staging table shaped like the table of a model class.
+
+        The staging table lives in the session's transaction; drop it once its rows are merged.
+
+        :param model_class: SQLAlchemy declarative base class the staging table is shaped like.
+        :param df: A Pandas DataFrame containing the data to be copied.
+        :param columns: List of column names to copy. Defaults to all DataFrame columns.
+        :return: Name of the staging table.
+        """
+        table = model_class.__table__
+        columns = list(columns if columns is not None else df.columns)
+        staging_table = f"{table.name}_staging"
+
+        self.session.execute(text(f"CREATE TEMPORARY TABLE {staging_table} AS "
+                                  f"SELECT {', '.join(columns)} FROM {table.name} WITH NO DATA"))
+        self._copy(staging_table, columns, self._prepare_frame(table, columns, df))
+        return staging_table
+
+    def upsert(self, model_class, df, conflict_column, columns=None):
+        """
+        Copy the rows of a DataFrame into the table of a model class, updating rows that already exist.
+
+        The rows are copied into a temporary staging table first and then merged with
+        INSERT ... ON CONFLICT DO UPDATE. Existing rows are only updated when one of their values differs,
+        so reloading unchanged records does not rewrite them.
+
+        :param model_class: SQLAlchemy declarative base class of the target table.
+        :param df: A Pandas DataFrame containing the data to be copied.
+        :param conflict_column: Name of the uniquely indexed column that identifies existing rows.
+        :param columns: List of column names to copy. Defaults to all DataFrame columns.
+        :return: Number of rows inserted or updated.
+        """
+        table = model_class.__table__
+        columns = list(columns if columns is not None else df.columns)
+        column_list = ', '.join(columns)
+        updated_columns = [column for column in columns if column != conflict_column]
+
+        staging_table = self.stage(model_class, df, columns)
+        result = self.session.execute(text(
+            f"INSERT INTO {table.name} ({column_list}) SELECT {column_list} FROM {staging_table} "
+            f"ON CONFLICT ({conflict_column}) DO UPDATE SET "
+            f"{', '.join(f'{column} = EXCLUDED.{column}' for column in updated_columns)} "
+            f"WHERE ({', '.join(f'{table.name}.{column}' for column in updated_columns)}) IS DISTINCT FROM "
+            f"({', '.join(f'EXCLUDED.{column}' for column in updated_columns)})"
+        ))
+        self.session.execute(text(f"DROP TABLE {staging_table}"))
+        return result.rowcount
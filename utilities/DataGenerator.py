@@ -0,0 +1,204 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# Columns of the San Francisco police incident reports, in the order of the published CSV file
+COLUMNS = [
+    'Incident Datetime', 'Incident Date', 'Incident Time', 'Incident Year', 'Incident Day of Week',
+    'Report Datetime', 'Row ID', 'Incident ID', 'Incident Number', 'CAD Number', 'Report Type Code',
+    'Report Type Description', 'Filed Online', 'Incident Code', 'Incident Category', 'Incident Subcategory',
+    'Incident Description', 'Resolution', 'Intersection', 'CNN', 'Police District', 'Analysis Neighborhood',
+    'Supervisor District', 'Latitude', 'Longitude', 'Point'
+]
+
+CATEGORIES = [
+    'Larceny Theft', 'Other Miscellaneous', 'Malicious Mischief', 'Assault', 'Non-Criminal', 'Burglary',
+    'Motor Vehicle Theft', 'Recovered Vehicle', 'Fraud', 'Warrant', 'Lost Property', 'Drug Offense', 'Robbery',
+    'Missing Person', 'Suspicious Occ', 'Disorderly Conduct', 'Offences Against The Family And Children',
+    'Miscellaneous Investigation', 'Other Offenses', 'Traffic Violation Arrest', 'Weapons Carrying Etc',
+    'Stolen Property', 'Other', 'Forgery And Counterfeiting', 'Case Closure', 'Vandalism', 'Courtesy Report',
+    'Traffic Collision', 'Fire Report', 'Sex Offense', 'Prostitution', 'Arson', 'Embezzlement',
+    'Vehicle Misplaced', 'Suicide', 'Liquor Laws', 'Weapons Offense', 'Homicide', 'Rape', 'Gambling',
+    'Human Trafficking (A), Commercial Sex Acts', 'Civil Sidewalks', 'Juvenile Offenses', 'Vehicle Impounded'
+]
+
+POLICE_DISTRICTS = [
+    'Central', 'Northern', 'Mission', 'Southern', 'Tenderloin', 'Bayview', 'Ingleside', 'Taraval', 'Richmond',
+    'Park', 'Out of SF'
+]
+
+ANALYSIS_NEIGHBORHOODS = [
+    'Bayview Hunters Point', 'Bernal Heights', 'Castro/Upper Market', 'Chinatown', 'Excelsior',
+    'Financial District/South Beach', 'Glen Park', 'Golden Gate Park', 'Haight Ashbury', 'Hayes Valley',
+    'Inner Richmond', 'Inner Sunset', 'Japantown', 'Lakeshore', 'Lincoln Park', 'Lone Mountain/USF', 'Marina',
+    'McLaren Park', 'Mission', 'Mission Bay', 'Nob Hill', 'Noe Valley', 'North Beach', 'Oceanview/Merced/Ingleside',
+    'Outer Mission', 'Outer Richmond', 'Pacific Heights', 'Portola', 'Potrero Hill', 'Presidio', 'Presidio Heights',
+    'Russian Hill', 'Seacliff', 'South of Market', 'Sunset/Parkside', 'Tenderloin', 'Treasure Island',
+    'Twin Peaks', 'Visitacion Valley', 'West of Twin Peaks', 'Western Addition'
+]
+
+RESOLUTIONS = ['Open or Active', 'Cite or Arrest Adult', 'Unfounded', 'Exceptional Adult']
+RESOLUTION_WEIGHTS = [0.74, 0.21, 0.03, 0.02]
+
+REPORT_TYPES = [('II', 'Initial'), ('VI', 'Vehicle Initial'), ('IS', 'Initial Supplement'),
+                ('VS', 'Vehicle Supplement'), ('CI', 'Coplogic Initial'), ('CS', 'Coplogic Supplement')]
+REPORT_TYPE_WEIGHTS = [0.62, 0.08, 0.18, 0.03, 0.07, 0.02]
+
+# Relative frequency of incidents by hour of the day, lowest in the early morning
+HOUR_WEIGHTS = np.array([5, 4, 3, 3, 2, 2, 3, 4, 5, 6, 6, 7, 9, 7, 7, 7, 8, 8, 8, 8, 7, 6, 6, 5])
+
+# Bounding box of San Francisco
+LATITUDE_RANGE = (37.708, 37.832)
+LONGITUDE_RANGE = (-122.514, -122.357)
+
+DATETIME_FORMAT = '%Y/%m/%d %I:%M:%S %p'
+
+
+class DataGenerator:
+    """
+    Generates synthetic San Francisco incident report CSV files for benchmarks and tests.
+
+    The files have the columns and formats of the published dataset, and the cardinalities and skew of the
+    real data: a few dozen incident categories with around 850 descriptions, 11 police districts,
+    41 analysis neighborhoods, 4 resolutions and by default 20000 intersections, of which a small share
+    accounts for most incidents. Incidents happen more often in the afternoon and evening than at night,
+    and are reported from minutes to days later. About 5% of the incidents have no coordinates.
+
+    Rows are generated and written in blocks, so files of tens of millions of rows are generated in
+    bounded memory. The same seed always produces the same file.
+
+    :param seed: Seed of the random number generator. Defaults to 0.
+    :param locations: Number of distinct intersections. Defaults to 20000.
+    :param start: First day of the incidents. Defaults to 2018-01-01.
+    :param days: Number of days the incidents are spread over. Defaults to 5 years.
+    """
+
+    def __init__(self, seed=0, locations=20000, start=datetime.datetime(2018, 1, 1), days=5 * 365):
+        self.seed = seed
+        self.start = pd.Timestamp(start)
+        self.days = days
+        self._rng = np.random.default_rng(seed)
+        self._offenses = self._create_offenses()
+        self._locations = self._create_locations(locations)
+
+    @staticmethod
+    def _zipf_weights(count, exponent=1.1):
+        """
+        Create skewed weights, so the first values are far more frequent than the last ones.
+
+        :param count: Number of weights.
+        :param exponent: Skew of the weights.
+        :return: NumPy array of weights that sum to 1.
+        """
+        weights = 1 / np.arange(1, count + 1) ** exponent
+        return weights / weights.sum()
+
+    def _create_offenses(self):
+        """
+        Create the offenses: incident codes with their category, subcategory and description.
+
+        :return: DataFrame with one row per offense and a column of frequency weights.
+        """
+        rows = []
+        for category_index, category in enumerate(CATEGORIES):
+            subcategories = [category] if category_index % 3 else [category, f'{category} - Other']
+            for description_index in range(int(self._rng.integers(5, 35))):
+                code = (category_index + 1) * 1000 + description_index
+                rows.append((code, category, subcategories[description_index % len(subcategories)],
+                             f'{category}, Offense {description_index + 1}'))
+        offenses = pd.DataFrame(rows, columns=['Incident Code', 'Incident Category',
+                                               'Incident Subcategory', 'Incident Description'])
+        offenses['weight'] = self._zipf_weights(len(offenses))[self._rng.permutation(len(offenses))]
+        offenses['weight'] /= offenses['weight'].sum()
+        return offenses
+
+    def _create_locations(self, count):
+        """
+        Create the intersections with their coordinates, district and neighborhood.
+
+        :param count: Number of intersections.
+        :return: DataFrame with one row per intersection and a column of frequency weights.
+        """
+        rng = self._rng
+        streets = [f'{n}TH ST' for n in range(1, 49)] + [f'STREET {n:03d}' for n in range(1, 400)]
+        first_streets = rng.integers(0, len(streets), count)
+        second_streets = rng.integers(0, len(streets), count)
+        return pd.DataFrame({
+            'Intersection': [f'{streets[a]} \\ {streets[b]}' for a, b in zip(first_streets, second_streets)],
+            'CNN': 20000000 + np.arange(count),
+            'Police District': rng.choice(POLICE_DISTRICTS[:-1], count),
+            'Analysis Neighborhood': rng.choice(ANALYSIS_NEIGHBORHOODS, count),
+            'Supervisor District': rng.integers(1, 12, count),
+            'Latitude': rng.uniform(*LATITUDE_RANGE, count).round(6),
+            'Longitude': rng.uniform(*LONGITUDE_RANGE, count).round(6),
+            'weight': self._zipf_weights(count, 0.8)
+        })
+
+    def _generate_block(self, first_row, rows):
+        """
+        Generate a block of consecutive incidents.
+
+        :param first_row: Position of the first incident in the file, counting from 0.
+        :param rows: Number of incidents in the block.
+        :return: DataFrame with the columns of the published CSV file.
+        """
+        rng = self._rng
+        hours = rng.choice(24, rows, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+        minutes = np.where(rng.random(rows) < 0.3, 0, rng.integers(0, 60, rows))
+        incident_datetimes = self.start + pd.to_timedelta(rng.integers(0, self.days, rows), unit='D') \
+            + pd.to_timedelta(hours * 60 + minutes, unit='m')
+        report_datetimes = incident_datetimes + pd.to_timedelta(rng.exponential(600, rows).astype(int), unit='m')
+        incident_datetimes = pd.Series(incident_datetimes)
+
+        offenses = self._offenses.iloc[rng.choice(len(self._offenses), rows, p=self._offenses['weight'])]
+        locations = self._locations.iloc[rng.choice(len(self._locations), rows, p=self._locations['weight'])]
+        report_types = rng.choice(len(REPORT_TYPES), rows, p=REPORT_TYPE_WEIGHTS)
+        incident_ids = 600000 + first_row + np.arange(rows)
+        codes = offenses['Incident Code'].to_numpy()
+        has_coordinates = rng.random(rows) >= 0.05
+
+        block = pd.DataFrame({
+            'Incident Datetime': incident_datetimes.dt.strftime(DATETIME_FORMAT),
+            'Incident Date': incident_datetimes.dt.strftime('%Y/%m/%d'),
+            'Incident Time': incident_datetimes.dt.strftime('%H:%M'),
+            'Incident Year': incident_datetimes.dt.year,
+            'Incident Day of Week': incident_datetimes.dt.day_name(),
+            'Report Datetime': pd.Series(report_datetimes).dt.strftime(DATETIME_FORMAT),
+            'Row ID': incident_ids * 100000 + codes,
+            'Incident ID': incident_ids,
+            'Incident Number': 180000000 + first_row + np.arange(rows),
+            'CAD Number': np.where(rng.random(rows) < 0.8, 180000000 + rng.integers(0, 9999999, rows), None),
+            'Report Type Code': [REPORT_TYPES[index][0] for index in report_types],
+            'Report Type Description': [REPORT_TYPES[index][1] for index in report_types],
+            'Filed Online': np.where(report_types >= 4, 'TRUE', ''),
+            'Incident Code': codes,
+            'Incident Category': offenses['Incident Category'].to_numpy(),
+            'Incident Subcategory': offenses['Incident Subcategory'].to_numpy(),
+            'Incident Description': offenses['Incident Description'].to_numpy(),
+            'Resolution': rng.choice(RESOLUTIONS, rows, p=RESOLUTION_WEIGHTS)
+        })
+        for column in ['Intersection', 'CNN', 'Police District', 'Analysis Neighborhood', 'Supervisor District',
+                       'Latitude', 'Longitude']:
+            block[column] = np.where(has_coordinates, locations[column].to_numpy(), None)
+        block['Point'] = np.where(has_coordinates, 'POINT (' + locations['Longitude'].astype(str).to_numpy() + ' '
+                                  + locations['Latitude'].astype(str).to_numpy() + ')', None)
+        # A few incidents outside the city keep their district but have no neighborhood
+        block.loc[~has_coordinates, 'Police District'] = np.where(rng.random((~has_coordinates).sum()) < 0.2,
+                                                                  'Out of SF', None)
+        return block[COLUMNS]
+
+    def generate(self, path, rows, block_rows=100000):
+        """
+        Generate a CSV file of synthetic incidents.
+
+        :param path: Path of the CSV file to write.
+        :param rows: Number of incidents.
+        :param block_rows: Number of incidents generated and written at a time. Defaults to 100000.
+        :return: Path of the written file.
+        """
+        with open(path, 'w', newline='') as file:
+            for first_row in range(0, rows, block_rows):
+                block = self._generate_block(first_row, min(block_rows, rows - first_row))
+                block.to_csv(file, index=False, header=first_row == 0)
+        return path
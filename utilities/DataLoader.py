@@ -1,6 +1,46 @@
 import os
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from config.ingest_config import ingest_config
+from utilities.ColumnarCache import ColumnarCache
+
+
+COLUMN_DTYPES = {
+    'row_id': 'Int64',
+    'incident_id': 'Int64',
+    'cad_number': 'Int64',
+    'incident_year': 'Int64',
+    'incident_code': 'Int64',
+    'incident_number': 'Int64',
+    'cnn': 'Int64',
+    'latitude': 'float64',
+    'longitude': 'float64'
+}
+
+# Low-cardinality string columns, read as categoricals so repeated values are stored once per chunk
+CATEGORY_COLUMNS = [
+    'incident_date',
+    'incident_time',
+    'incident_day_of_week',
+    'report_type_code',
+    'report_type_description',
+    'filed_online',
+    'incident_category',
+    'incident_subcategory',
+    'incident_description',
+    'resolution',
+    'police_district',
+    'analysis_neighborhood',
+    'supervisor_district'
+]
+
+DATETIME_FORMATS = {
+    'incident_datetime': '%Y/%m/%d %I:%M:%S %p',
+    'report_datetime': '%Y/%m/%d %I:%M:%S %p'
+}
 
 
 class DataLoader:
@@ -8,7 +48,12 @@ class DataLoader:
     A singleton class used to load data from a CSV file into a DataFrame.
 
     This class implements the singleton pattern to ensure only one instance is created. It provides
-    a static method to get the instance of the class and a method to load the data from the CSV file.
+    a static method to get the instance of the class and methods to load the data from the CSV file,
+    either at once or as a stream of typed chunks.
+
+    Unless disabled in the ingest configuration, the first pass over the CSV file also writes a typed,
+    columnar cache of it next to the file (see ColumnarCache). Later passes read the cache instead of
+    parsing the CSV again, for as long as the size and modification time of the file are unchanged.
 
     :param file_path: relative path to the CSV file.
     """
@@ -29,7 +74,7 @@ class DataLoader:
             DataLoader()
         return DataLoader.__instance
 
-    def __init__(self, file_path='../data/crime_sf.csv'):
+    def __init__(self, file_path=None):
         """
         Virtually private constructor.
 
@@ -37,7 +82,7 @@ class DataLoader:
         the CSV file and stores the instance in a class variable. If the instance has already been
         created, it raises an exception.
 
-        :param file_path: relative path to the CSV file.
+        :param file_path: relative path to the CSV file. Defaults to the configured source path.
         :raises Exception: If the instance has already been created.
         """
         if DataLoader.__instance is not None:
@@ -46,19 +91,248 @@ class DataLoader:
             # Find the directory this script is in
             script_directory = os.path.dirname(os.path.abspath(__file__))
             # Use it to build an absolute path to the data file
-            DataLoader.__file_path = os.path.join(script_directory, file_path)
+            DataLoader.__file_path = os.path.join(script_directory, file_path or ingest_config['source_path'])
             DataLoader.__instance = self
 
     def load_data(self):
         """
         Load data from the CSV file into a DataFrame.
 
-        This method reads the CSV file into a pandas DataFrame, replaces spaces with underscores and
-        converts column names to lower case in the DataFrame, replaces null values with None in the
-        DataFrame, and returns the DataFrame.
+        This method reads the CSV file into a pandas DataFrame with the same compact dtypes as the chunks
+        of iter_chunks, replaces spaces with underscores and converts column names to lower case, and
+        returns the DataFrame. Missing values are kept as NaN/NA, so numeric columns are not boxed into
+        Python objects; convert them to None when writing the rows.
+
+        :return: DataFrame containing the data from the CSV file.
+        """
+        return self.load_frame()
+
+    @staticmethod
+    def _normalize_columns(columns):
+        """
+        Replace spaces with underscores and convert column names to lower case.
+
+        :param columns: Index of column names as found in the CSV file.
+        :return: Index of normalized column names.
+        """
+        return columns.str.replace(' ', '_').str.lower()
+
+    def get_source_name(self):
+        """
+        Get the name that identifies the CSV file as a data source.
+
+        :return: File name of the CSV file.
+        """
+        return os.path.basename(DataLoader.__file_path)
+
+    def get_source_signature(self):
+        """
+        Get a signature that changes whenever the CSV file is replaced or modified.
+
+        :return: String built from the size and modification time of the CSV file.
+        """
+        stat = os.stat(DataLoader.__file_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def count_rows(self):
+        """
+        Count the data rows of the CSV file without parsing it.
+
+        The file is scanned in binary blocks and the line breaks that end a row are counted (see
+        _find_row_breaks), so this is much cheaper than reading the file with pandas. It is used to report
+        progress of streaming loads and to split the file into partitions.
+
+        :return: Number of rows in the CSV file, excluding the header.
+        """
+        cache = self._get_cache()
+        if cache is not None and cache.is_valid():
+            return cache.get_row_count()
+
+        rows = 0
+        quoted = False
+        with open(DataLoader.__file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                breaks, quoted = self._find_row_breaks(block, quoted)
+                rows += len(breaks)
+        return max(rows - 1, 0)
+
+    @staticmethod
+    def _find_row_breaks(block, quoted):
+        """
+        Find the line breaks of a binary block of the CSV file that end a row.
+
+        A line break inside a quoted field belongs to the field. Quotes inside a field are escaped by doubling
+        them, so a byte is inside a quoted field exactly when an odd number of quotes precede it in the file.
+
+        :param block: Bytes of the file.
+        :param quoted: Whether the block starts inside a quoted field.
+        :return: Tuple of the array of the offsets of the row breaks in the block, and whether the block ends
+                 inside a quoted field.
+        """
+        data = np.frombuffer(block, dtype=np.uint8)
+        if not quoted and b'"' not in block:
+            return np.flatnonzero(data == ord('\n')), False
+        # The parity of the running count of quotes survives the overflow of uint8
+        inside = (np.cumsum(data == ord('"'), dtype=np.uint8) & 1).astype(bool) ^ quoted
+        return np.flatnonzero((data == ord('\n')) & ~inside), bool(inside[-1])
+
+    def _get_cache(self):
+        """
+        Get the columnar cache of the CSV file.
+
+        :return: ColumnarCache object, or None if the cache is disabled.
+        """
+        if not ingest_config['columnar_cache']:
+            return None
+        directory, file_name = os.path.split(DataLoader.__file_path)
+        cache_dir = os.path.join(directory, '.cache', os.path.splitext(file_name)[0])
+        return ColumnarCache(cache_dir, self.get_source_signature())
+
+    def is_cached(self):
+        """
+        Check whether the CSV file has a valid columnar cache.
+
+        :return: True if the data will be read from the cache, False if the CSV file will be parsed.
+        """
+        cache = self._get_cache()
+        return cache is not None and cache.is_valid()
+
+    def iter_chunks(self, chunksize=10000, skip_rows=0, max_rows=None):
+        """
+        Stream data from the CSV file as a sequence of typed DataFrames.
 
+        Only one chunk is held in memory at a time, so peak memory does not depend on the size of the
+        file. Every chunk has the same dtypes: numeric columns use the dtypes in COLUMN_DTYPES, the
+        columns in DATETIME_FORMATS are parsed to datetimes, the columns in CATEGORY_COLUMNS are read as
+        categoricals and all other columns are read as strings. Missing values are kept as NaN/NA; they are
+        converted to None when the rows are written. The index of each chunk holds the position of its
+        rows in the file, counting from 0.
+
+        When the columnar cache is valid the chunks are read from it. Otherwise the CSV file is parsed, and
+        a complete pass from the first row also builds the cache.
+
+        :param chunksize: Number of rows in each chunk, or a function returning the number of rows of the next
+                          chunk, which lets the caller adapt the size while streaming. Defaults to 10000.
+        :param skip_rows: Number of data rows to skip at the start of the file. Defaults to 0.
+        :param max_rows: Maximum number of data rows to read after the skipped ones. Defaults to all rows.
+        :return: Generator of DataFrames containing consecutive rows of the CSV file.
+        """
+        cache = self._get_cache()
+        if cache is not None and cache.is_valid():
+            yield from cache.iter_chunks(chunksize, skip_rows, max_rows)
+            return
+
+        writer = cache.writer() if cache is not None and skip_rows == 0 and max_rows is None else None
+        try:
+            for chunk in self._iter_csv_chunks(chunksize, skip_rows, max_rows):
+                if writer is not None:
+                    writer.append(chunk)
+                yield chunk
+            if writer is not None:
+                writer.commit()
+        finally:
+            if writer is not None:
+                writer.discard()
+
+    def load_frame(self, columns=None):
+        """
+        Load the typed data of the CSV file as one DataFrame.
+
+        This method is meant for in-process analytics. With the columnar cache the columns are memory-mapped,
+        so loading is cheap and only touches the requested columns.
+
+        :param columns: List of column names to load. Defaults to all columns.
         :return: DataFrame containing the data from the CSV file.
         """
-        df = pd.read_csv(DataLoader.__file_path)
-        df.columns = df.columns.str.replace(' ', '_').str.lower()
-        return df.where(pd.notnull(df), None)
+        cache = self._get_cache()
+        if cache is None:
+            df = self._concat_chunks(list(self._iter_csv_chunks(chunksize=100000)))
+            return df if columns is None else df[columns]
+
+        if not cache.is_valid():
+            writer = cache.writer()
+            try:
+                for chunk in self._iter_csv_chunks(chunksize=100000):
+                    writer.append(chunk)
+                writer.commit()
+            finally:
+                writer.discard()
+        return cache.load_frame(columns)
+
+    @staticmethod
+    def _concat_chunks(chunks):
+        """
+        Concatenate typed chunks into one DataFrame, keeping the categorical columns categorical.
+
+        Every chunk read from the CSV file has its own categories, and pandas concatenates categoricals with
+        different categories as objects, so the categories of each column are unified first.
+
+        :param chunks: List of DataFrames returned by _iter_csv_chunks.
+        :return: DataFrame containing the rows of all chunks.
+        """
+        for column in CATEGORY_COLUMNS:
+            if chunks and column in chunks[0].columns:
+                categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+                for chunk in chunks:
+                    chunk[column] = chunk[column].cat.set_categories(categories)
+        return pd.concat(chunks, ignore_index=True)
+
+    def _iter_csv_chunks(self, chunksize=10000, skip_rows=0, max_rows=None):
+        """
+        Parse the CSV file as a sequence of typed DataFrames.
+
+        :param chunksize: Number of rows in each chunk, or a function returning the number of rows of the next
+                          chunk. Defaults to 10000.
+        :param skip_rows: Number of data rows to skip at the start of the file. Defaults to 0.
+        :param max_rows: Maximum number of data rows to read after the skipped ones. Defaults to all rows.
+        :return: Generator of DataFrames containing consecutive rows of the CSV file.
+        """
+        header = pd.read_csv(DataLoader.__file_path, nrows=0).columns
+        columns = self._normalize_columns(header)
+        dtypes = {column: COLUMN_DTYPES.get(column, 'category' if column in CATEGORY_COLUMNS else 'object')
+                  for column in columns}
+
+        next_size = chunksize if callable(chunksize) else lambda: chunksize
+        with open(DataLoader.__file_path, 'rb') as file:
+            if not self._seek_data_row(file, skip_rows):
+                return
+            with pd.read_csv(file, header=None, names=columns, dtype=dtypes, nrows=max_rows,
+                             iterator=True) as reader:
+                while True:
+                    try:
+                        chunk = reader.get_chunk(next_size())
+                    except StopIteration:
+                        return
+                    chunk.index += skip_rows
+                    for column, datetime_format in DATETIME_FORMATS.items():
+                        if column in chunk.columns:
+                            chunk[column] = pd.to_datetime(chunk[column], format=datetime_format)
+                    yield chunk
+
+    @staticmethod
+    def _seek_data_row(file, row):
+        """
+        Move a binary handle of the CSV file to the start of a data row.
+
+        The header and the rows before are skipped by counting the line breaks that end a row in binary blocks,
+        as in count_rows, so skipping rows costs a scan of the file instead of parsing them, and line breaks
+        inside quoted fields do not shift the position.
+
+        :param file: Buffered binary file handle at the start of the file.
+        :param row: Number of data rows to skip.
+        :return: True if the handle is at the start of a data row, False if the file has no more rows.
+        """
+        remaining = row + 1
+        quoted = False
+        while remaining:
+            position = file.tell()
+            block = file.read(1 << 20)
+            if not block:
+                return False
+            breaks, quoted = DataLoader._find_row_breaks(block, quoted)
+            if len(breaks) < remaining:
+                remaining -= len(breaks)
+                continue
+            file.seek(position + int(breaks[remaining - 1]) + 1)
+            remaining = 0
+        return bool(file.peek(1))
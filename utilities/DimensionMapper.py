@@ -1,7 +1,16 @@
+import os
+import time
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import insert
+from sqlalchemy import and_, column, select, table, text
+from sqlalchemy.dialects.postgresql import insert
 
+from config.ingest_config import ingest_config
 from model.SQLAlchemy import Dimension
+from utilities.CopyWriter import CopyWriter
+from utilities.IngestMetrics import IngestMetrics
+from utilities.KeyCache import KeyCache
 
 
 class DimensionMapper:
@@ -9,19 +18,33 @@ class DimensionMapper:
     A mapper class to map data from a DataFrame to a Dimension model.
 
     This class helps to create mappings from a DataFrame to a SQLAlchemy Dimension model. It collects
-    all dimension classes from the provided key-name mapping, creates a mapping for each dimension class
-    using the data from the DataFrame, and provides a method to get the keys for each row of the DataFrame.
+    all dimension classes from the provided key-name mapping and resolves the keys of a whole DataFrame at once.
+    Value tuples whose keys are not cached are resolved in the database: they are copied into a staging table,
+    inserted into the dimension unless its unique natural key index already has them, and joined back to their
+    keys, so only the records the data refers to are ever loaded.
+
+    Resolved keys are kept in a KeyCache bounded by the configured memory budget; keys evicted from it are
+    resolved in the database again when they are needed. Unless disabled in the ingest configuration, the
+    cache starts from the snapshot saved by the last load (see save_key_cache) and is only cold after the
+    tables are recreated. Mappers can share a cache instead, such as the partitions loaded by one worker
+    process. The keys used by this mapper, whether cached or resolved in the database, are also collected, so
+    they can be added to another cache (see get_used_entries).
 
     :param session: SQLAlchemy Session object, used to query and insert data to the database.
-    :param df: pandas DataFrame, the source of the data.
     :param key_name_mapping: a dictionary that maps dimension classes to key names.
+    :param key_cache: KeyCache to use. Defaults to None (a new cache, loaded from the snapshot).
     """
-    def __init__(self, session, df, key_name_mapping):
+    def __init__(self, session, key_name_mapping, key_cache=None):
         self.session = session
-        self.df = df
         self.key_name_mapping = key_name_mapping
+        self.metrics = IngestMetrics.get_instance()
         self.dimension_classes = self._collect_dimension_classes()
-        self.mappings = self._create_mappings()
+        self._used_entries = {}
+        self.key_cache = key_cache
+        if self.key_cache is None:
+            self.key_cache = KeyCache(ingest_config['key_cache_max_mb'] * 2 ** 20)
+            if ingest_config['key_cache_persist']:
+                self.key_cache.load(self._get_snapshot_path(), self._get_database(), self._get_table_oids())
 
     def _collect_dimension_classes(self):
         """
@@ -35,86 +58,144 @@ class DimensionMapper:
         return [dimension_class for dimension_class, _ in self.key_name_mapping.items()
                 if issubclass(dimension_class, Dimension)]
 
-    def _get_mappings(self, DimensionClass):
+    @staticmethod
+    def _get_snapshot_path():
         """
-        Get a mapping for a Dimension class.
+        Get the path of the key cache snapshot.
 
-        This method queries all existing records for the provided Dimension class, creates a mapping
-        from the existing records, gets all new records from the DataFrame, and creates a mapping from
-        the new records.
+        :return: Absolute path, resolved against the utilities directory.
+        """
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), ingest_config['key_cache_path'])
 
-        :param DimensionClass: a Dimension class to create a mapping for.
-        :return: a dictionary that maps tuples of record values to keys.
+    def _get_database(self):
         """
-        existing_records = self.session.query(DimensionClass).all()
-        existing_mapping = {
-            tuple(getattr(record, col) for col in DimensionClass.get_columns()): record.key
-            for record in existing_records
-        }
-        new_records = self._get_new_records(DimensionClass, existing_mapping)
-        new_mapping = self._get_new_mapping(DimensionClass, new_records)
-        return {**existing_mapping, **new_mapping}
+        Get an identifier of the database the keys belong to.
 
-    def _get_new_records(self, DimensionClass, existing_mapping):
+        :return: URL of the database, without the password.
         """
-        Get new records for a Dimension class.
+        return str(self.session.get_bind().url)
 
-        This method filters unique rows from the DataFrame based on the columns of the provided
-        Dimension class and returns all rows that are not already in the existing mapping and not all null.
+    def _get_table_oids(self):
+        """
+        Get the OIDs of the dimension tables, which change when the tables are recreated.
 
-        :param DimensionClass: a Dimension class to get new records for.
-        :param existing_mapping: a dictionary that maps tuples of existing record values to keys.
-        :return: a list of dictionaries, each representing a new record.
+        :return: a dictionary that maps table names to OIDs.
         """
-        unique_df_rows = self.df[DimensionClass.get_columns()].drop_duplicates().values
-        return [
-            dict(zip(DimensionClass.get_columns(), row))
-            for row in unique_df_rows
-            if tuple(row) not in existing_mapping and not pd.isnull(row).all()
-        ]
+        query = text("SELECT relname, CAST(oid AS BIGINT) FROM pg_class "
+                     "WHERE relnamespace = CAST(current_schema() AS regnamespace) AND relname = ANY(:names)")
+        names = [DimensionClass.__tablename__ for DimensionClass in self.dimension_classes]
+        return dict(self.session.execute(query, {'names': names}).all())
 
-    def _get_new_mapping(self, DimensionClass, new_records):
+    def save_key_cache(self):
         """
-        Get a mapping from new records for a Dimension class.
+        Save a snapshot of the key cache for the next load.
 
-        This method inserts the new records to the database and creates a mapping from the inserted
-        records. If there are no new records, it returns an empty dictionary.
+        Call this only once the dimension rows of all resolved keys are committed.
+        """
+        if ingest_config['key_cache_persist']:
+            self.key_cache.save(self._get_snapshot_path(), self._get_database(), self._get_table_oids())
 
-        :param DimensionClass: a Dimension class to create a mapping for.
-        :param new_records: a list of dictionaries, each representing a new record.
-        :return: a dictionary that maps tuples of new record values to generated keys.
+    @staticmethod
+    def _factorize(DimensionClass, df):
         """
-        if not new_records:
-            return {}
+        Factorize the rows of a DataFrame on the columns of a Dimension class.
 
-        stmt = insert(DimensionClass).values(new_records).returning(DimensionClass.key)
-        result = self.session.execute(stmt)
-        return {tuple(record.values()): generated_key[0] for record, generated_key in zip(new_records, result)}
+        This method assigns a code to every row, so that rows with equal dimension values share a code,
+        and collects the distinct value tuples in code order. Missing values are converted to None, so that
+        they match the NULLs loaded from the database.
 
-    def _create_mappings(self):
+        :param DimensionClass: a Dimension class to factorize the DataFrame for.
+        :param df: pandas DataFrame, the source of the data.
+        :return: a tuple of a NumPy array of codes (one per row) and a list of distinct value tuples.
+        """
+        columns = DimensionClass.get_columns()
+        groups = df.groupby(columns, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+        _, first_rows, codes = np.unique(groups, return_index=True, return_inverse=True)
+        unique_df = df[columns].iloc[first_rows]
+        unique_rows = [tuple(row) for row in unique_df.astype(object).where(unique_df.notnull(), None).values]
+        return codes, unique_rows
+
+    def _resolve_keys(self, DimensionClass, rows):
         """
-        Create mappings for all Dimension classes.
+        Resolve the keys of value tuples in the database, inserting the records that do not exist yet.
 
-        This method iterates over all collected Dimension classes and creates a mapping for each
-        Dimension class.
+        The tuples are copied into a staging table. One statement inserts those missing from the dimension,
+        skipping conflicts on the natural key index, which also covers records inserted concurrently by
+        another load; a second statement, which sees the inserted records, joins the staging table with
+        the dimension to read back every key. The records are inserted in natural key order, so concurrent
+        loads, such as the workers of a partitioned load, lock them in the same order and do not deadlock.
 
-        :return: a dictionary that maps Dimension classes to mappings.
+        :param DimensionClass: a Dimension class to resolve keys for.
+        :param rows: a list of distinct value tuples.
+        :return: a tuple of a dictionary that maps the value tuples to keys, and the number of records inserted.
         """
-        return {DimensionClass: self._get_mappings(DimensionClass) for DimensionClass in self.dimension_classes}
+        if not rows:
+            return {}, 0
+
+        columns = DimensionClass.get_columns()
+        staging_name = CopyWriter(self.session).stage(DimensionClass, pd.DataFrame(rows, columns=columns))
+        staging_table = table(staging_name, *[column(name) for name in columns])
+        dimension_table = DimensionClass.__table__
+
+        stmt = insert(dimension_table).from_select(
+            columns, select(*staging_table.c).order_by(*DimensionClass.get_natural_key(staging_table)))
+        stmt = stmt.on_conflict_do_nothing(index_elements=DimensionClass.get_natural_key())
+        inserted = self.session.execute(stmt).rowcount
+
+        natural_key_pairs = zip(DimensionClass.get_natural_key(), DimensionClass.get_natural_key(staging_table))
+        query = select(dimension_table.c.key, *[dimension_table.c[name] for name in columns]).join_from(
+            dimension_table, staging_table, and_(*[left == right for left, right in natural_key_pairs]))
+        mapping = {tuple(record[1:]): record[0] for record in self.session.execute(query)}
+        self.session.execute(text(f"DROP TABLE {staging_name}"))
+        return mapping, inserted
+
+    def get_used_entries(self):
+        """
+        Get the keys used by this mapper, in the order they were first used.
+
+        :return: List of tuples of the table name, the natural key values and the key.
+        """
+        return [(table_name, values, key) for (table_name, values), key in self._used_entries.items()]
 
-    def get_keys(self, row):
+    def get_key_arrays(self, df):
         """
-        Get the keys for a row of the DataFrame.
+        Get the keys for all rows of a DataFrame.
+
+        This method resolves the keys of every collected Dimension class for the whole DataFrame at once.
+        The rows are factorized, so the key cache is only consulted once per distinct value tuple, the keys of
+        tuples that are not cached are resolved in the database, and the keys are broadcast back to the rows.
+        Rows whose dimension values are all null get a missing key.
 
-        This method iterates over all collected Dimension classes and gets the key for each Dimension
-        class based on the values of the row.
+        The database round trips are recorded per dimension in the ingest metrics, the rest of the time as
+        map_dimensions.
 
-        :param row: a Series representing a row of the DataFrame.
-        :return: a dictionary that maps key names to keys.
+        :param df: pandas DataFrame, the source of the data.
+        :return: a dictionary that maps key names to nullable integer arrays with one key per row.
         """
-        return {
-            self.key_name_mapping[dimension_class]: self.mappings[dimension_class].get(
-                tuple(getattr(row, col) for col in dimension_class.get_columns())
-            )
-            for dimension_class in self.dimension_classes
-        }
+        started = time.perf_counter()
+        insert_seconds = 0.0
+        key_arrays = {}
+        for DimensionClass in self.dimension_classes:
+            table_name = DimensionClass.__tablename__
+            codes, unique_rows = self._factorize(DimensionClass, df)
+            keys = [None if all(value is None for value in row) else self.key_cache.get(table_name, row)
+                    for row in unique_rows]
+            missing = [index for index, (row, key) in enumerate(zip(unique_rows, keys))
+                       if key is None and not all(value is None for value in row)]
+            self.metrics.record_key_cache(sum(key is not None for key in keys), len(missing))
+            if missing:
+                insert_started = time.perf_counter()
+                resolved, inserted = self._resolve_keys(DimensionClass, [unique_rows[index] for index in missing])
+                seconds = time.perf_counter() - insert_started
+                self.metrics.record_dimension_insert(table_name, inserted, seconds)
+                insert_seconds += seconds
+                for index in missing:
+                    keys[index] = resolved.get(unique_rows[index])
+                    if keys[index] is not None:
+                        self.key_cache.put(table_name, unique_rows[index], keys[index])
+            self._used_entries.update(((table_name, row), key) for row, key in zip(unique_rows, keys)
+                                      if key is not None)
+            unique_keys = pd.array(keys, dtype='Int64')
+            key_arrays[self.key_name_mapping[DimensionClass]] = unique_keys[codes]
+        self.metrics.add_stage_time('map_dimensions', time.perf_counter() - started - insert_seconds)
+        return key_arrays
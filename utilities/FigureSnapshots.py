@@ -0,0 +1,105 @@
+import gzip
+import hashlib
+
+from config.app_config import app_config
+from utilities.QueryPlotter import QueryPlotter, GRAPH_CONFIG
+from utilities.ResultCache import ResultCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content codings of the snapshots, in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+class FigureSnapshot:
+    """
+    A figure serialized to JSON, along with its compressed encodings and entity tag.
+
+    :param body: JSON of the figure, as bytes.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.encodings = {'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body)
+
+    def get_body(self, encoding=None):
+        """
+        Get the snapshot in a content coding.
+
+        :param encoding: 'br', 'gzip' or None for the uncompressed JSON. Defaults to None.
+        :return: Bytes of the snapshot.
+        """
+        return self.encodings[encoding] if encoding else self.body
+
+
+class FigureSnapshots:
+    """
+    A singleton class holding a serialized snapshot of the figure of every graph in GRAPH_CONFIG.
+
+    The snapshots are rendered after each load by render_all, or on the first request for a graph, and kept
+    in a ResultCache, so they are dropped along with the query results when the data changes. Serving a
+    snapshot costs neither a query nor a serialization, and a client holding its entity tag gets a 304.
+    Brotli is used when the Brotli package of the requirements is installed, gzip otherwise.
+    """
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        """
+        Get the singleton instance of this class.
+
+        :return: The singleton instance of this class.
+        """
+        if FigureSnapshots.__instance is None:
+            FigureSnapshots()
+        return FigureSnapshots.__instance
+
+    def __init__(self):
+        """
+        Virtually private constructor.
+
+        :raises Exception: If the instance has already been created.
+        """
+        if FigureSnapshots.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            FigureSnapshots.__instance = self
+            self.cache = ResultCache('figure_snapshot', app_config['result_cache_max_entries'],
+                                     app_config['result_cache_ttl_seconds'])
+
+    @staticmethod
+    def render(graph_type, **query_params):
+        """
+        Plot a graph and serialize its figure.
+
+        :param graph_type: Key of the graph in GRAPH_CONFIG.
+        :param query_params: Keyword arguments of the query of the graph.
+        :return: FigureSnapshot of the graph.
+        """
+        figure = QueryPlotter(graph_type).plot_graph(**query_params)
+        return FigureSnapshot(figure.to_json().encode('utf-8'))
+
+    def get(self, graph_type, **query_params):
+        """
+        Get the snapshot of a graph, rendering it if it is missing.
+
+        :param graph_type: Key of the graph in GRAPH_CONFIG.
+        :param query_params: Keyword arguments of the query of the graph, such as the zoom level and bounds
+                             of a zoomable graph. Defaults to none, the view rendered by render_all.
+        :return: FigureSnapshot of the graph.
+        """
+        key = (graph_type, tuple(sorted(query_params.items())))
+        return self.cache.get_or_compute(key, lambda: self.render(graph_type, **query_params))
+
+    def render_all(self):
+        """
+        Render the snapshots of all graphs, after the data has changed.
+        """
+        for graph_type in GRAPH_CONFIG:
+            self.get(graph_type)
@@ -0,0 +1,169 @@
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import time
+
+from config.ingest_config import ingest_config
+from utilities.BatchInserter import InsertTask, LOAD_MODES
+from utilities.DataGenerator import DataGenerator
+from utilities.DataLoader import DataLoader
+from utilities.PostgreSQLManager import PostgreSQLManager
+
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'benchmark')
+RESULTS_PATH = os.path.join(BENCHMARK_DIRECTORY, 'results.jsonl')
+
+# Settings that must match for two results to be comparable
+COMPARED_SETTINGS = ['rows', 'seed', 'load_mode', 'workers', 'bulk_load', 'cached_source']
+
+
+def get_revision():
+    """
+    Get the git revision of the working tree, so results can be traced back to a version of the code.
+
+    :return: Short commit hash, or None if it cannot be determined.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_source(rows, seed):
+    """
+    Get a synthetic source file with the given number of rows, generating it on first use.
+
+    :param rows: Number of incidents.
+    :param seed: Seed of the generator.
+    :return: Path of the CSV file.
+    """
+    path = os.path.join(BENCHMARK_DIRECTORY, f'crime_sf_{rows}_{seed}.csv')
+    if not os.path.exists(path):
+        os.makedirs(BENCHMARK_DIRECTORY, exist_ok=True)
+        DataGenerator(seed).generate(f'{path}.tmp', rows)
+        os.replace(f'{path}.tmp', path)
+    return path
+
+
+def load_results(results_path):
+    """
+    Load the saved benchmark results.
+
+    :param results_path: Path of the results file.
+    :return: List of result dictionaries, oldest first.
+    """
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def save_result(result, results_path):
+    """
+    Append a benchmark result to the results file.
+
+    :param result: Result dictionary.
+    :param results_path: Path of the results file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, 'a') as file:
+        file.write(json.dumps(result) + '\n')
+
+
+def run_benchmark(rows, load_mode, workers=1, bulk_load=False, seed=0):
+    """
+    Run InsertTask end to end on a synthetic source and measure it.
+
+    The tables of the configured database are recreated first, so point DB_NAME to a scratch database.
+    A source file is only parsed from CSV on its first run; later runs read its columnar cache, which is
+    recorded in the result as cached_source.
+
+    :param rows: Number of incidents in the source.
+    :param load_mode: How rows are written, one of LOAD_MODES.
+    :param workers: Number of worker processes. Defaults to 1.
+    :param bulk_load: Whether to load without constraints and indexes on the incidents table. Defaults to False.
+    :param seed: Seed of the generator. Defaults to 0.
+    :return: Result dictionary with the throughput, the time of each stage and the peak memory.
+    """
+    source_path = get_source(rows, seed)
+    # Worker processes read the source path from the environment
+    os.environ['INGEST_SOURCE_PATH'] = source_path
+    ingest_config['source_path'] = source_path
+
+    db_manager = PostgreSQLManager.get_instance()
+    db_manager.recreate_tables(bulk_load)
+
+    result = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': get_revision(),
+        'rows': rows,
+        'seed': seed,
+        'load_mode': load_mode,
+        'workers': workers,
+        'bulk_load': bulk_load,
+        'cached_source': DataLoader.get_instance().is_cached()
+    }
+
+    task = InsertTask()
+    started = time.perf_counter()
+    task.run(load_mode, workers=workers, bulk_load=bulk_load)
+    elapsed = time.perf_counter() - started
+
+    result.update({
+        'rows_added': task.total_rows_added,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(task.total_rows_added / elapsed, 1),
+        'stage_seconds': {stage: round(seconds, 3) for stage, seconds in task.stage_times.items()},
+        # ru_maxrss is in kilobytes on Linux; for workers it is at least the size of the parent when they started
+        'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_worker_memory_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+        if workers > 1 else None
+    })
+    return result
+
+
+def compare(result, previous_results):
+    """
+    Compare a result with the last saved result of the same settings.
+
+    :param result: Result dictionary.
+    :param previous_results: List of saved result dictionaries, oldest first.
+    :return: Text describing the change in throughput, or None if there is no comparable result.
+    """
+    comparable = [previous for previous in previous_results
+                  if all(previous.get(setting) == result[setting] for setting in COMPARED_SETTINGS)]
+    if not comparable:
+        return None
+    previous = comparable[-1]
+    change = (result['rows_per_second'] / previous['rows_per_second'] - 1) * 100
+    return (f"{change:+.1f}% rows/s compared to {previous['rows_per_second']} rows/s "
+            f"at revision {previous['revision']} ({previous['timestamp']})")
+
+
+def main():
+    """
+    Run the ingest benchmark from the command line, print and save the result.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the ingest of a synthetic source into PostgreSQL.')
+    parser.add_argument('--rows', type=int, default=100000, help='number of incidents in the source')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data generator')
+    parser.add_argument('--mode', choices=LOAD_MODES, default=ingest_config['load_mode'], help='load mode')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--bulk', action='store_true', help='build constraints and indexes after the load')
+    parser.add_argument('--results', default=RESULTS_PATH, help='file the results are appended to')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.rows, args.mode, args.workers, args.bulk, args.seed)
+    print(json.dumps(result, indent=2))
+    comparison = compare(result, load_results(args.results))
+    if comparison is not None:
+        print(comparison)
+    save_result(result, args.results)
+
+
+if __name__ == "__main__":
+    # Benchmark the ingest
+    main()
@@ -0,0 +1,308 @@
+import bisect
+import contextlib
+import resource
+import threading
+import time
+
+# Upper bounds of the batch latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Stages of the ingest hot path, in the order they are reported
+STAGES = ('read_source', 'map_dimensions', 'insert_dimensions', 'insert_facts', 'commit')
+
+METRIC_PREFIX = 'sfcrime_ingest'
+
+
+class IngestMetrics:
+    """
+    A singleton class collecting timings and counters of the ingest hot path.
+
+    The time spent in every stage of a load is accumulated: reading the source (the CSV file or its cache),
+    mapping rows to dimension keys, inserting the rows of each dimension, inserting the fact rows and committing.
+    Each batch adds the latency of its dimension and fact writes to a histogram, and the rows it added to the
+    counters. The stages of a pipelined load overlap, so their times may add up to more than the elapsed time.
+
+    The metrics are reset when a load starts and kept after it ends. They are exposed in the Prometheus text
+    format by render, which Prometheus reads as a counter reset on every load, and summarized by get_summary.
+    Worker processes collect their own metrics and send a snapshot back to be merged. All methods are
+    thread-safe, so the stages of an IngestPipeline record concurrently.
+    """
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        """
+        Get the singleton instance of this class.
+
+        :return: The singleton instance of this class.
+        """
+        if IngestMetrics.__instance is None:
+            IngestMetrics()
+        return IngestMetrics.__instance
+
+    def __init__(self):
+        """
+        Virtually private constructor.
+
+        :raises Exception: If the instance has already been created.
+        """
+        if IngestMetrics.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            IngestMetrics.__instance = self
+            self._lock = threading.Lock()
+            self.reset()
+
+    def reset(self):
+        """
+        Clear all metrics, at the start of a load.
+        """
+        with self._lock:
+            self.started_at = time.time()
+            self.finished_at = None
+            self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+            self.dimension_seconds = {}
+            self.dimension_rows = {}
+            self.batch_latency = {}
+            self.key_cache_hits = 0
+            self.key_cache_misses = 0
+            self.rows_added = 0
+            self.source_rows = 0
+            self.batch_size = None
+            self.worker_peak_rss_bytes = 0
+
+    def finish(self):
+        """
+        Mark the end of the current load, which stops the clock of its throughput.
+        """
+        with self._lock:
+            self.finished_at = time.time()
+
+    def add_stage_time(self, stage, seconds):
+        """
+        Add time spent in a stage of the ingest.
+
+        :param stage: Name of the stage, one of STAGES.
+        :param seconds: Time spent.
+        """
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+
+    @contextlib.contextmanager
+    def time_stage(self, stage):
+        """
+        Measure the time spent in a block of code as time of a stage.
+
+        :param stage: Name of the stage, one of STAGES.
+        :return: Context manager.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - started)
+
+    def record_dimension_insert(self, table_name, rows, seconds):
+        """
+        Record an insert of new rows into a dimension table.
+
+        The time is also added to the insert_dimensions stage.
+
+        :param table_name: Name of the dimension table.
+        :param rows: Number of rows inserted.
+        :param seconds: Time taken by the insert.
+        """
+        with self._lock:
+            self.stage_seconds['insert_dimensions'] += seconds
+            self.dimension_seconds[table_name] = self.dimension_seconds.get(table_name, 0) + seconds
+            self.dimension_rows[table_name] = self.dimension_rows.get(table_name, 0) + rows
+
+    def record_key_cache(self, hits, misses):
+        """
+        Record lookups of dimension keys in the key cache.
+
+        :param hits: Number of keys found in the cache.
+        :param misses: Number of keys resolved in the database.
+        """
+        with self._lock:
+            self.key_cache_hits += hits
+            self.key_cache_misses += misses
+
+    def record_batch(self, stage, seconds):
+        """
+        Record the latency of one batch in a stage, from the start of its writes to its commit.
+
+        :param stage: 'dimensions' or 'facts'.
+        :param seconds: Latency of the batch.
+        """
+        with self._lock:
+            counts = self.batch_latency.setdefault(stage, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                                                           'count': 0})
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                counts['buckets'][index] += 1
+            counts['sum'] += seconds
+            counts['count'] += 1
+
+    def record_rows(self, rows_added, source_rows):
+        """
+        Record the rows of a committed batch or partition.
+
+        :param rows_added: Number of rows added.
+        :param source_rows: Number of source rows processed.
+        """
+        with self._lock:
+            self.rows_added += rows_added
+            self.source_rows += source_rows
+
+    def set_batch_size(self, batch_size):
+        """
+        Record the current number of rows per batch.
+
+        :param batch_size: Number of rows.
+        """
+        self.batch_size = batch_size
+
+    def snapshot(self):
+        """
+        Get the metrics that a worker process sends back to be merged, see merge.
+
+        :return: Dictionary of plain values.
+        """
+        with self._lock:
+            return {
+                'stage_seconds': dict(self.stage_seconds),
+                'dimension_seconds': dict(self.dimension_seconds),
+                'dimension_rows': dict(self.dimension_rows),
+                'batch_latency': {stage: {'buckets': list(counts['buckets']), 'sum': counts['sum'],
+                                          'count': counts['count']}
+                                  for stage, counts in self.batch_latency.items()},
+                'key_cache_hits': self.key_cache_hits,
+                'key_cache_misses': self.key_cache_misses,
+                'peak_rss_bytes': get_peak_rss_bytes()
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the metrics of a worker process to the metrics of the load.
+
+        Rows are not merged, they are recorded by the caller along with the progress of the load.
+
+        :param snapshot: Dictionary returned by snapshot.
+        """
+        with self._lock:
+            for stage, seconds in snapshot['stage_seconds'].items():
+                self.stage_seconds[stage] += seconds
+            for table_name, seconds in snapshot['dimension_seconds'].items():
+                self.dimension_seconds[table_name] = self.dimension_seconds.get(table_name, 0) + seconds
+            for table_name, rows in snapshot['dimension_rows'].items():
+                self.dimension_rows[table_name] = self.dimension_rows.get(table_name, 0) + rows
+            for stage, worker_counts in snapshot['batch_latency'].items():
+                counts = self.batch_latency.setdefault(stage, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                                                               'count': 0})
+                counts['buckets'] = [a + b for a, b in zip(counts['buckets'], worker_counts['buckets'])]
+                counts['sum'] += worker_counts['sum']
+                counts['count'] += worker_counts['count']
+            self.key_cache_hits += snapshot['key_cache_hits']
+            self.key_cache_misses += snapshot['key_cache_misses']
+            self.worker_peak_rss_bytes = max(self.worker_peak_rss_bytes, snapshot['peak_rss_bytes'])
+
+    def get_elapsed_seconds(self):
+        """
+        Get the duration of the current or last load.
+
+        :return: Seconds since the load started, or until it finished.
+        """
+        return (self.finished_at or time.time()) - self.started_at
+
+    def get_rows_per_second(self):
+        """
+        Get the throughput of the current or last load.
+
+        :return: Source rows processed per second.
+        """
+        elapsed = self.get_elapsed_seconds()
+        return self.source_rows / elapsed if elapsed > 0 else 0.0
+
+    def get_summary(self):
+        """
+        Summarize the metrics of the current or last load, for progress updates.
+
+        :return: Dictionary with the throughput, the time of each stage, the batch latencies and the peak memory.
+        """
+        with self._lock:
+            facts = self.batch_latency.get('facts', {'sum': 0.0, 'count': 0})
+            return {
+                'elapsed_seconds': round(self.get_elapsed_seconds(), 1),
+                'rows_per_second': round(self.get_rows_per_second(), 1),
+                'stage_seconds': {stage: round(seconds, 2) for stage, seconds in self.stage_seconds.items()},
+                'batches': facts['count'],
+                'mean_batch_seconds': round(facts['sum'] / facts['count'], 3) if facts['count'] else None,
+                'batch_size': self.batch_size,
+                'peak_rss_mb': round(max(get_peak_rss_bytes(), self.worker_peak_rss_bytes) / 2 ** 20, 1)
+            }
+
+    def render(self, running=False, progress=0):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        :param running: Whether a load is running. Defaults to False.
+        :param progress: Progress of the load in percent. Defaults to 0.
+        :return: Text of the metrics.
+        """
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{METRIC_PREFIX}_{name}{suffix}{{{label_text}}} {value}' if label_text
+                             else f'{METRIC_PREFIX}_{name}{suffix} {value}')
+
+        with self._lock:
+            add('running', 'gauge', 'Whether a load is running.', [('', {}, int(running))])
+            add('progress_percent', 'gauge', 'Share of the source rows processed by the current or last load.',
+                [('', {}, round(progress, 2))])
+            add('start_time_seconds', 'gauge', 'Unix time the current or last load started.',
+                [('', {}, round(self.started_at, 3))])
+            add('rows_added_total', 'counter', 'Rows added to the incidents table.', [('', {}, self.rows_added)])
+            add('source_rows_total', 'counter', 'Source rows processed.', [('', {}, self.source_rows)])
+            add('rows_per_second', 'gauge', 'Source rows processed per second by the current or last load.',
+                [('', {}, round(self.get_rows_per_second(), 1))])
+            add('stage_seconds_total', 'counter', 'Time spent in each stage of the ingest.',
+                [('', {'stage': stage}, round(seconds, 6)) for stage, seconds in self.stage_seconds.items()])
+            add('dimension_insert_seconds_total', 'counter', 'Time spent inserting new rows into each dimension.',
+                [('', {'dimension': name}, round(seconds, 6)) for name, seconds in self.dimension_seconds.items()])
+            add('dimension_rows_inserted_total', 'counter', 'New rows inserted into each dimension.',
+                [('', {'dimension': name}, rows) for name, rows in self.dimension_rows.items()])
+
+            samples = []
+            for stage, counts in self.batch_latency.items():
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, counts['buckets']):
+                    cumulative += count
+                    samples.append(('_bucket', {'stage': stage, 'le': bound}, cumulative))
+                samples.append(('_bucket', {'stage': stage, 'le': '+Inf'}, counts['count']))
+                samples.append(('_sum', {'stage': stage}, round(counts['sum'], 6)))
+                samples.append(('_count', {'stage': stage}, counts['count']))
+            add('batch_duration_seconds', 'histogram', 'Time to write and commit one batch.', samples)
+            add('key_cache_lookups_total', 'counter', 'Lookups of dimension keys in the key cache.',
+                [('', {'result': 'hit'}, self.key_cache_hits), ('', {'result': 'miss'}, self.key_cache_misses)])
+
+            if self.batch_size is not None:
+                add('batch_size_rows', 'gauge', 'Current number of rows per batch.', [('', {}, self.batch_size)])
+            add('peak_rss_bytes', 'gauge', 'Peak resident memory of the server process.',
+                [('', {}, get_peak_rss_bytes())])
+            add('worker_peak_rss_bytes', 'gauge', 'Peak resident memory of the worker processes of the last load.',
+                [('', {}, self.worker_peak_rss_bytes)])
+        return '\n'.join(lines) + '\n'
+
+
+def get_peak_rss_bytes():
+    """
+    Get the peak resident memory of the current process.
+
+    :return: Number of bytes; ru_maxrss is in kilobytes on Linux.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+
+_END_OF_STREAM = object()
+
+
+class IngestPipeline:
+    """
+    Runs the ingest of a BatchInserter as three concurrent stages.
+
+    The read stage parses batches from the source, the dimension stage writes dimension rows and resolves
+    the keys of each batch, and the fact stage writes the fact rows. The stages run in their own threads
+    and are joined by bounded queues: when a downstream stage falls behind, the queue in front of it fills
+    up and the upstream stage blocks, so at most a few batches are in flight at any time. Parsing and
+    pandas work of one batch overlaps with the database round trips of the previous ones.
+
+    The dimension and fact stages use the inserter's two sessions, so each commits on its own connection.
+    A batch is handed to the fact stage only after its dimension rows are committed, which keeps the
+    foreign keys of the fact rows valid.
+
+    After a run, stage_times holds the seconds each stage spent working, excluding the time it was blocked
+    on a queue, so the slowest stage is the one with the largest time.
+
+    :param inserter: A BatchInserter whose dimension and fact sessions are not shared with other threads.
+    :param queue_size: Maximum number of batches waiting between two stages. Defaults to 2.
+    """
+
+    def __init__(self, inserter, queue_size=2):
+        self.inserter = inserter
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+        self._errors = []
+        self._blocked = {}
+        self.stage_times = {}
+
+    def _record_blocked(self, started):
+        """
+        Add the time since started to the time the current stage was blocked on queues.
+
+        :param started: Value of time.perf_counter when the stage started waiting.
+        """
+        name = threading.current_thread().name
+        self._blocked[name] = self._blocked.get(name, 0) + time.perf_counter() - started
+
+    def _put(self, outbox, item):
+        """
+        Put an item into a queue, blocking while it is full.
+
+        :param outbox: Queue to put the item into.
+        :param item: Item to put.
+        :return: True if the item was queued, False if the pipeline was stopped meanwhile.
+        """
+        started = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    outbox.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self._record_blocked(started)
+
+    def _get(self, inbox):
+        """
+        Get an item from a queue, blocking while it is empty.
+
+        :param inbox: Queue to get the item from.
+        :return: The next item, or the end-of-stream marker if the pipeline was stopped meanwhile.
+        """
+        started = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return inbox.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END_OF_STREAM
+        finally:
+            self._record_blocked(started)
+
+    def _run_stage(self, items, process, outbox=None):
+        """
+        Run one stage until its input is exhausted or the pipeline is stopped.
+
+        Any exception stops the whole pipeline and is re-raised by run. The end-of-stream marker is
+        always forwarded, so the downstream stage terminates as well.
+
+        :param items: Iterable of input items of the stage.
+        :param process: Function called with each input item, returning the item for the next stage.
+        :param outbox: Queue of the next stage, or None for the last stage.
+        """
+        name = threading.current_thread().name
+        started = time.perf_counter()
+        try:
+            for item in items:
+                result = process(item)
+                if outbox is not None and not self._put(outbox, result):
+                    break
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            if outbox is not None:
+                self._put(outbox, _END_OF_STREAM)
+            self.stage_times[name.removeprefix('ingest-')] = \
+                time.perf_counter() - started - self._blocked.get(name, 0)
+
+    def _drain(self, inbox):
+        """
+        Iterate over the items of a queue until the end-of-stream marker is received.
+
+        :param inbox: Queue to read from.
+        :return: Generator of queued items.
+        """
+        while True:
+            item = self._get(inbox)
+            if item is _END_OF_STREAM:
+                return
+            yield item
+
+    def run(self, on_batch=None):
+        """
+        Run all stages and wait until every batch is written.
+
+        :param on_batch: Function called from the fact stage with the number of rows added by each batch and
+                         the number of source rows it was built from.
+        :raises Exception: The first error raised by any stage; uncommitted work is rolled back.
+        """
+        batches = queue.Queue(maxsize=self.queue_size)
+        fact_frames = queue.Queue(maxsize=self.queue_size)
+
+        def resolve_dimensions(batch_df):
+            # Incremental filtering may drop rows, so the size and end of the batch in the source are passed along
+            return self.inserter.insert_dimensions(batch_df), len(batch_df), self.inserter.get_rows_done(batch_df)
+
+        def write_facts(item):
+            fact_df, source_rows, rows_done = item
+            rows_added = self.inserter.insert_facts(fact_df, source_rows=source_rows, rows_done=rows_done)
+            if on_batch is not None:
+                on_batch(rows_added, source_rows)
+
+        stages = [
+            threading.Thread(target=self._run_stage, args=(self.inserter.batches, lambda batch_df: batch_df, batches),
+                             name='ingest-read'),
+            threading.Thread(target=self._run_stage, args=(self._drain(batches), resolve_dimensions, fact_frames),
+                             name='ingest-dimensions'),
+            threading.Thread(target=self._run_stage, args=(self._drain(fact_frames), write_facts),
+                             name='ingest-facts')
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        if self._errors:
+            self.inserter.session.rollback()
+            self.inserter.fact_session.rollback()
+            raise self._errors[0]
@@ -0,0 +1,152 @@
+import os
+import pickle
+import sys
+from collections import OrderedDict
+
+# Bump when the layout of the snapshot files changes
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Approximate memory used by an entry of an OrderedDict, on top of its key and value
+ENTRY_OVERHEAD_BYTES = 100
+
+
+class KeyCache:
+    """
+    A least recently used cache of dimension keys with a memory budget.
+
+    Entries map a dimension table name and a tuple of natural key values to the surrogate key of the record.
+    The memory used by every entry is estimated when it is added, and the least recently used entries are
+    evicted while the estimate exceeds the budget, so the cache stays bounded however many distinct records
+    a load refers to. A miss is not an error: the caller resolves the keys in the database and adds them.
+
+    The cache can be saved as a snapshot and loaded by a later run. A snapshot records the OID of every
+    dimension table, which changes when the tables are recreated, and only the entries of tables whose OID
+    is unchanged are loaded. Keys are only valid once committed, so save a snapshot after a successful load.
+
+    :param max_bytes: Memory budget of the cache, in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _estimate_bytes(cache_key, key):
+        """
+        Estimate the memory used by an entry.
+
+        Values shared with other entries, such as repeated strings, are counted for every entry, so the
+        estimate errs on the high side.
+
+        :param cache_key: Tuple of the table name and the natural key values.
+        :param key: Surrogate key.
+        :return: Number of bytes.
+        """
+        values = cache_key[1]
+        return (sys.getsizeof(cache_key) + sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+                + sys.getsizeof(key) + ENTRY_OVERHEAD_BYTES)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, table_name, values):
+        """
+        Get the key of a record and mark it as recently used.
+
+        :param table_name: Name of the dimension table.
+        :param values: Tuple of natural key values.
+        :return: The key, or None if it is not cached.
+        """
+        key = self._entries.get((table_name, values))
+        if key is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((table_name, values))
+        self.hits += 1
+        return key
+
+    def put(self, table_name, values, key):
+        """
+        Add the key of a record, evicting the least recently used entries if the budget is exceeded.
+
+        :param table_name: Name of the dimension table.
+        :param values: Tuple of natural key values.
+        :param key: Surrogate key.
+        """
+        cache_key = (table_name, values)
+        if cache_key in self._entries:
+            self._entries.move_to_end(cache_key)
+            self._entries[cache_key] = key
+            return
+        self._entries[cache_key] = key
+        self.size_bytes += self._estimate_bytes(cache_key, key)
+        while self.size_bytes > self.max_bytes and self._entries:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= self._estimate_bytes(evicted_key, evicted)
+            self.evictions += 1
+
+    def put_entries(self, entries):
+        """
+        Add entries resolved elsewhere, such as by the workers of a partitioned load.
+
+        :param entries: List of tuples of the table name, the natural key values and the key.
+        """
+        for table_name, values, key in entries:
+            self.put(table_name, values, key)
+
+    def save(self, path, database, table_oids):
+        """
+        Save the entries as a snapshot, least recently used first.
+
+        The snapshot stores the values and keys of every table as two lists, and is written to a temporary
+        file first, so a reader never sees a partial snapshot.
+
+        :param path: Path of the snapshot file.
+        :param database: Identifier of the database the keys belong to.
+        :param table_oids: Dictionary that maps the dimension table names to their current OIDs.
+        """
+        tables = {table_name: {'oid': oid, 'values': [], 'keys': []} for table_name, oid in table_oids.items()}
+        for (table_name, values), key in self._entries.items():
+            if table_name in tables:
+                tables[table_name]['values'].append(values)
+                tables[table_name]['keys'].append(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            pickle.dump({'version': SNAPSHOT_FORMAT_VERSION, 'database': database, 'tables': tables}, file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    def load(self, path, database, table_oids):
+        """
+        Load the entries of a snapshot that are still valid.
+
+        Entries of tables that were recreated since the snapshot was saved, or that belong to another
+        database, are skipped. A missing or unreadable snapshot leaves the cache empty.
+
+        :param path: Path of the snapshot file.
+        :param database: Identifier of the current database.
+        :param table_oids: Dictionary that maps the dimension table names to their current OIDs.
+        :return: Number of entries loaded.
+        """
+        try:
+            with open(path, 'rb') as file:
+                snapshot = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return 0
+        if snapshot.get('version') != SNAPSHOT_FORMAT_VERSION or snapshot.get('database') != database:
+            return 0
+
+        loaded = 0
+        for table_name, table in snapshot['tables'].items():
+            if table_oids.get(table_name) != table['oid']:
+                continue
+            for values, key in zip(table['values'], table['keys']):
+                self.put(table_name, values, key)
+                loaded += 1
+        return loaded
@@ -0,0 +1,17 @@
+from utilities.PostgreSQLManager import PostgreSQLManager
+
+
+def migrate_schema():
+    """
+    Migrate the PostgreSQL database from the per-incident date and incident details dimensions to the current model.
+    """
+    db_manager = PostgreSQLManager.get_instance()
+    if db_manager.migrate_star_schema():
+        print("Database migrated to the current model")
+    else:
+        print("Database already uses the current model")
+
+
+if __name__ == "__main__":
+    # Migrate the database
+    migrate_schema()
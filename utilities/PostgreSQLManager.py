@@ -1,10 +1,35 @@
 import datetime
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-from sqlalchemy import create_engine, text, func, desc
+from sqlalchemy import create_engine, text, func, desc, inspect, select, delete, and_, or_, cast, case, literal, \
+    tuple_, union_all, BigInteger
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.schema import CreateIndex
+from config.app_config import app_config
 from config.db_config import db_config
-from model.SQLAlchemy import CategoryDimension, Incidents, ResolutionDimension, Base, LocationDimension, DateDimension, DistrictDimension, IncidentDetailsDimension
+from config.ingest_config import ingest_config
+from utilities.ResultCache import ResultCache
+from utilities.SQL_Loader import getQuery
+from model.SQLAlchemy import CategoryDimension, Incidents, ResolutionDimension, Base, LocationDimension, CalendarDimension, \
+    TimeOfDayDimension, DistrictDimension, DescriptionDimension, AGGREGATE_CLASSES, AggregateRefresh, \
+    OBSOLETE_INDEXES, LEGACY_TABLES, CategoryAggregate, CategoryResolutionAggregate, CalendarCategoryAggregate, LocationAggregate, \
+    HourWeekdayMonthCategoryAggregate, DistrictCategoryAggregate, DescriptionAggregate, OBSOLETE_AGGREGATES, \
+    IncidentRevision, INCIDENT_REVISION_DDL, INCIDENT_REVISION_TRIGGER, coalesce_null
+
+# Key of the advisory lock that serializes refreshes of the aggregates
+AGGREGATE_REFRESH_LOCK = 7410001
+
+# Label of the row that sums the counts of the rows ranked below the top N
+OTHER_LABEL = '(Other)'
+
+# Zoom level of the hotspot map when it is first shown, which shows the whole city
+HOTSPOT_DEFAULT_ZOOM = 10
+# Latitude of San Francisco, which sets the height of the hotspot grid cells when no bounds are given
+HOTSPOT_REFERENCE_LATITUDE = 37.7749
 
 
 class PostgreSQLManager:
@@ -42,6 +67,8 @@ class PostgreSQLManager:
             self.dbname = db_config['dbname']
             self.engine = None
             self.Session = scoped_session(sessionmaker())
+            self._aggregate_tables_created = False
+            self._aggregates_ensured = False
             self.connect()
 
     def connect(self, dbname=None, default_db=False):
@@ -98,31 +125,494 @@ class PostgreSQLManager:
             self.Session.execute(query)
         # Reconnect to the newly created database or already existing one
         self.connect()
+        self._aggregate_tables_created = False
+        self._aggregates_ensured = False
+        ResultCache.invalidate_all()
 
-    def recreate_tables(self):
+    def recreate_tables(self, bulk_load=False):
         """
         Create tables in the database based on the declarative base model.
-        Existing tables will be dropped before creating new ones.
+        Existing tables will be dropped before creating new ones, including the dimensions of the schema
+        before the star schema migration, which are not part of the model.
+
+        :param bulk_load: If True, the incidents table is left without its foreign keys, unique constraints and
+                          secondary indexes until restore_fact_constraints is called (see defer_fact_constraints).
         """
+        with self.engine.begin() as connection:
+            # CASCADE drops the foreign keys of an old incidents table, which drop_all removes next
+            connection.execute(text(f"DROP TABLE IF EXISTS {', '.join(LEGACY_TABLES)} CASCADE"))
         Base.metadata.drop_all(self.engine)
         Base.metadata.create_all(self.engine)
+        self._aggregates_ensured = False
+        if bulk_load:
+            self.defer_fact_constraints(ingest_config['bulk_load_unlogged'])
+        ResultCache.invalidate_all()
+
+    def has_incidents(self):
+        """
+        Check whether the incidents table holds any rows.
+
+        :return: True if at least one incident is loaded, False otherwise, also if the table does not exist.
+        """
+        if not inspect(self.engine).has_table(Incidents.__tablename__):
+            return False
+        with self.engine.connect() as connection:
+            return connection.execute(select(Incidents.incident_id).limit(1)).first() is not None
+
+    def has_unkeyed_incidents(self):
+        """
+        Check whether the incidents table holds rows without a row_id, such as the incidents migrated from the
+        schema before the star schema migration, which did not keep the Row ID of the source.
+
+        Incremental loads match the records of the source to the loaded incidents on their row_id, so they
+        cannot update these incidents.
+
+        :return: True if at least one incident has no row_id, False otherwise, also if the table does not exist.
+        """
+        if not inspect(self.engine).has_table(Incidents.__tablename__):
+            return False
+        with self.engine.connect() as connection:
+            return connection.execute(select(Incidents.incident_id).where(Incidents.row_id.is_(None))
+                                      .limit(1)).first() is not None
+
+    def create_indexes(self):
+        """
+        Create the indexes of the model that are missing from the database, and drop the obsolete ones.
+
+        Tables created before an index was added to the model get it here. Creating the unique natural key
+        index of a dimension fails if the dimension holds duplicate records. The indexes of the incidents table
+        are left to restore_fact_constraints, which builds them in parallel unless a bulk load deferred them.
+
+        :return: List of the names of the created indexes.
+        """
+        created = []
+        with self.engine.begin() as connection:
+            # Expression indexes are not reflected by the inspector, so they are looked up in the catalog
+            query = text("SELECT tablename, indexname FROM pg_indexes WHERE schemaname = current_schema()")
+            existing = {tuple(row) for row in connection.execute(query)}
+            tables = {table_name for table_name, _ in existing}
+            for table_name, index_name in existing:
+                if index_name in OBSOLETE_INDEXES:
+                    connection.execute(text(f"DROP INDEX {index_name}"))
+            for table in Base.metadata.sorted_tables:
+                if table.name == Incidents.__tablename__ or table.name not in tables:
+                    continue
+                for index in table.indexes:
+                    if (table.name, index.name) not in existing:
+                        index.create(connection)
+                        created.append(index.name)
+        return created
+
+    def defer_fact_constraints(self, unlogged=False):
+        """
+        Prepare the incidents table for a bulk load.
+
+        Drops the foreign keys, unique constraints and secondary indexes of the incidents table, so rows are
+        loaded without checking and indexing every row; only the primary key is kept.
+        restore_fact_constraints builds them again from the model once the load is done.
+
+        :param unlogged: If True, the table is also made UNLOGGED, which skips the write-ahead log during the
+                         load. An unlogged table is truncated after a crash, so only use it for loads that can
+                         be repeated.
+        """
+        with self.engine.begin() as connection:
+            inspector = inspect(connection)
+            foreign_keys = inspector.get_foreign_keys(Incidents.__tablename__)
+            unique_constraints = inspector.get_unique_constraints(Incidents.__tablename__)
+            indexes = [index for index in inspector.get_indexes(Incidents.__tablename__)
+                       if 'duplicates_constraint' not in index]
+
+            for constraint in foreign_keys + unique_constraints:
+                connection.execute(text(f"ALTER TABLE {Incidents.__tablename__} DROP CONSTRAINT {constraint['name']}"))
+            for index in indexes:
+                connection.execute(text(f"DROP INDEX {index['name']}"))
+            if unlogged:
+                connection.execute(text(f"ALTER TABLE {Incidents.__tablename__} SET UNLOGGED"))
+
+    @staticmethod
+    def _get_fact_constraints():
+        """
+        Get the foreign keys, unique constraints and secondary indexes of the incidents table from the model.
+
+        Constraints are named the way PostgreSQL names them when the table is created from the model.
+
+        :return: Tuple of dictionaries that map names to the CREATE INDEX statements of the secondary indexes,
+                 to the columns of the unique constraints and to the definitions of the foreign keys.
+        """
+        table = Incidents.__table__
+        indexes = {index.name: str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+                   for index in table.indexes}
+        unique_constraints = {f"{table.name}_{column.name}_key": column.name
+                              for column in table.columns if column.unique}
+        foreign_keys = {
+            f"{table.name}_{foreign_key.parent.name}_fkey":
+                f"FOREIGN KEY ({foreign_key.parent.name}) "
+                f"REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})"
+            for foreign_key in table.foreign_keys
+        }
+        return indexes, unique_constraints, foreign_keys
+
+    def _execute_maintenance(self, statement):
+        """
+        Execute a maintenance statement, such as an index build, in its own transaction.
+
+        :param statement: SQL statement to execute.
+        """
+        with self.engine.begin() as connection:
+            maintenance_work_mem = ingest_config['bulk_load_maintenance_work_mem']
+            connection.execute(text(f"SET LOCAL maintenance_work_mem = '{maintenance_work_mem}'"))
+            connection.execute(text(statement))
+
+    def restore_fact_constraints(self):
+        """
+        Restore the constraints and indexes of the incidents table that were dropped for a bulk load.
+
+        Only the constraints and indexes missing from the database are created, so this is a no-op on a table
+        that was not prepared for a bulk load. An unlogged table is made logged again first. The indexes,
+        including those backing the unique constraints, are built in parallel on separate connections. The
+        foreign keys are added as NOT VALID and then validated one after the other, since validation takes a
+        lock that conflicts with itself. The star schema is analyzed at the end.
+
+        :return: True if anything was restored, False otherwise.
+        """
+        table_name = Incidents.__tablename__
+        indexes, unique_constraints, foreign_keys = self._get_fact_constraints()
+        inspector = inspect(self.engine)
+        existing = {index['name'] for index in inspector.get_indexes(table_name)}
+        existing |= {constraint['name'] for constraint in inspector.get_unique_constraints(table_name)}
+        existing |= {foreign_key['name'] for foreign_key in inspector.get_foreign_keys(table_name)}
+
+        with self.engine.connect() as connection:
+            query = text("SELECT relpersistence = 'u' FROM pg_class WHERE oid = CAST(:table AS regclass)")
+            unlogged = connection.execute(query, {"table": table_name}).scalar()
+
+        index_builds = [statement for name, statement in indexes.items() if name not in existing]
+        index_builds += [f"CREATE UNIQUE INDEX {name} ON {table_name} ({column})"
+                         for name, column in unique_constraints.items() if name not in existing]
+        missing_foreign_keys = [name for name in foreign_keys if name not in existing]
+        if not unlogged and not index_builds and not missing_foreign_keys:
+            return False
+
+        if unlogged:
+            self._execute_maintenance(f"ALTER TABLE {table_name} SET LOGGED")
+
+        with ThreadPoolExecutor(max_workers=ingest_config['bulk_load_index_workers']) as executor:
+            list(executor.map(self._execute_maintenance, index_builds))
+
+        with self.engine.begin() as connection:
+            for name in unique_constraints:
+                if name not in existing:
+                    connection.execute(text(f"ALTER TABLE {table_name} "
+                                            f"ADD CONSTRAINT {name} UNIQUE USING INDEX {name}"))
+            for name in missing_foreign_keys:
+                connection.execute(text(f"ALTER TABLE {table_name} "
+                                        f"ADD CONSTRAINT {name} {foreign_keys[name]} NOT VALID"))
+        for name in missing_foreign_keys:
+            self._execute_maintenance(f"ALTER TABLE {table_name} VALIDATE CONSTRAINT {name}")
+
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                connection.execute(text(f"ANALYZE {table.name}"))
+        return True
+
+    def migrate_star_schema(self):
+        """
+        Migrate a database created with the per-incident date and incident details dimensions to the current model.
+
+        The calendar, time-of-day and description dimensions are created and populated from the old dimension
+        tables, the incident number and datetimes move onto the incidents, and the old tables are dropped.
+        The new tables are created and the data migrated in a single transaction, so a failure leaves the old
+        schema untouched.
+
+        The old schema did not keep the Row ID of the source, so the migrated incidents have no row_id, and
+        incremental loads, which match records on it, are refused until the tables are recreated and loaded in
+        full (see has_unkeyed_incidents).
+
+        :return: True if the database was migrated, False if it does not use the old schema.
+        """
+        if LEGACY_TABLES[0] not in inspect(self.engine).get_table_names():
+            return False
+
+        with self.engine.begin() as connection:
+            # Creates the new dimension tables; incidents already exists and is left as it is
+            Base.metadata.create_all(connection)
+            connection.execute(text(getQuery('migrate_star_schema')))
+            for index in Incidents.__table__.indexes:
+                index.create(connection)
+        self._aggregate_tables_created = False
+        self._aggregates_ensured = False
+        return True
+
+    @staticmethod
+    def _select_aggregate_keys(AggregateClass, incidents):
+        """
+        Get the primary key columns of an aggregate for the rows of a table of incidents.
+
+        :param AggregateClass: Aggregate class.
+        :param incidents: Table with the columns of the incidents table, such as the incidents or their revisions.
+        :return: Tuple of the list of column expressions, in the order of the primary key of the aggregate, and
+                 the FROM clause that joins the dimensions they come from.
+        """
+        dimensions = [(CalendarDimension.__table__, incidents.c.calendar_key),
+                      (TimeOfDayDimension.__table__, incidents.c.time_key)]
+        sources = [incidents.c[column.name] if column.name in incidents.c
+                   else next(dimension.c[column.name] for dimension, _ in dimensions if column.name in dimension.c)
+                   for column in AggregateClass.__table__.primary_key.columns]
+
+        source = incidents
+        for dimension, foreign_key in dimensions:
+            if any(column.table is dimension for column in sources):
+                source = source.join(dimension, dimension.c.key == foreign_key)
+        return sources, source
+
+    @staticmethod
+    def _add_to_aggregate(AggregateClass, query):
+        """
+        Build the statement that adds counts to an aggregate.
 
-    def fetch_category_counts(self):
+        :param AggregateClass: Aggregate class.
+        :param query: Select statement with the primary key columns of the aggregate and the counts to add.
+        :return: INSERT ... ON CONFLICT statement.
+        """
+        table = AggregateClass.__table__
+        names = [column.name for column in table.primary_key.columns]
+        stmt = insert(table).from_select(names + ['num_of_incidents'], query)
+        return stmt.on_conflict_do_update(
+            index_elements=names,
+            set_={'num_of_incidents': table.c.num_of_incidents + stmt.excluded.num_of_incidents}
+        )
+
+    def _build_aggregate_insert(self, AggregateClass, since, until):
+        """
+        Build the statement that adds the incidents in a range of incident IDs to an aggregate.
+
+        The incidents are grouped on the primary key columns of the aggregate and their counts are added to
+        the counts already in the aggregate.
+
+        :param AggregateClass: Aggregate class to add the incidents to.
+        :param since: Highest incident_id already counted in the aggregate.
+        :param until: Highest incident_id to count.
+        :return: INSERT ... ON CONFLICT statement.
+        """
+        incidents = Incidents.__table__
+        sources, source = self._select_aggregate_keys(AggregateClass, incidents)
+        query = select(*sources, func.count().label('num_of_incidents')).select_from(source) \
+            .where(and_(incidents.c.incident_id > since, incidents.c.incident_id <= until,
+                        *[column.isnot(None) for column in sources])) \
+            .group_by(*sources)
+        return self._add_to_aggregate(AggregateClass, query)
+
+    def _build_aggregate_revision(self, AggregateClass, since):
+        """
+        Build the statement that moves the incidents updated in place from the counts of their old versions to
+        the counts of their current versions.
+
+        Only incidents already counted in the aggregate are moved; incidents added since are counted with their
+        current version when they are added. Counts that do not change are left out.
+
+        :param AggregateClass: Aggregate class to update.
+        :param since: Highest incident_id counted in the aggregate.
+        :return: INSERT ... ON CONFLICT statement.
+        """
+        revisions = IncidentRevision.__table__
+        incidents = Incidents.__table__
+        old_sources, old_source = self._select_aggregate_keys(AggregateClass, revisions)
+        new_sources, new_source = self._select_aggregate_keys(AggregateClass, incidents)
+        names = [column.name for column in AggregateClass.__table__.primary_key.columns]
+
+        old_counts = select(*[column.label(name) for column, name in zip(old_sources, names)],
+                            literal(-1).label('change')).select_from(old_source) \
+            .where(revisions.c.incident_id <= since, *[column.isnot(None) for column in old_sources])
+        new_counts = select(*[column.label(name) for column, name in zip(new_sources, names)],
+                            literal(1).label('change')) \
+            .select_from(new_source.join(revisions, revisions.c.incident_id == incidents.c.incident_id)) \
+            .where(revisions.c.incident_id <= since, *[column.isnot(None) for column in new_sources])
+        changes = union_all(old_counts, new_counts).subquery()
+        query = select(*[changes.c[name] for name in names], func.sum(changes.c.change)) \
+            .group_by(*[changes.c[name] for name in names]) \
+            .having(func.sum(changes.c.change) != 0)
+        return self._add_to_aggregate(AggregateClass, query)
+
+    def refresh_aggregates(self, full=False):
+        """
+        Bring the aggregates of the dashboard queries up to date with the incidents table.
+
+        The fetch methods of the dashboard read the incident counts from the aggregates instead of grouping the
+        incidents table, so their latency does not depend on the number of incidents.
+
+        Each aggregate remembers the highest incident_id it counts, and only the incidents added since are
+        grouped and added to it, so refreshing after a load costs in proportion to the rows loaded. Rows that
+        were updated in place, as by an incremental load, left their old version in the revisions table (see
+        IncidentRevision); its counts are moved to the current version, and the revisions are removed.
+        Aggregates that were never refreshed are always rebuilt.
+
+        The refresh runs in one transaction, so the dashboard reads either the old or the new counts, and
+        concurrent refreshes are serialized by an advisory lock.
+
+        :param full: If True, all aggregates are rebuilt. Defaults to False.
+        :return: Number of aggregates that were rebuilt.
+        """
+        self.create_aggregate_tables()
+        rebuilt = 0
+        with self.engine.begin() as connection:
+            connection.execute(select(func.pg_advisory_xact_lock(AGGREGATE_REFRESH_LOCK)))
+            until = connection.execute(select(func.coalesce(func.max(Incidents.incident_id), 0))).scalar()
+            last_incident_ids = dict(connection.execute(
+                select(AggregateRefresh.aggregate, AggregateRefresh.last_incident_id)).all())
+            revised = connection.execute(select(IncidentRevision.incident_id)
+                                         .where(IncidentRevision.incident_id <= until).limit(1)).first() is not None
+
+            for AggregateClass in AGGREGATE_CLASSES:
+                name = AggregateClass.__tablename__
+                since = last_incident_ids.get(name)
+                if full or since is None or since > until:
+                    connection.execute(delete(AggregateClass.__table__))
+                    since = 0
+                    rebuilt += 1
+                elif revised:
+                    connection.execute(self._build_aggregate_revision(AggregateClass, since))
+                    connection.execute(delete(AggregateClass.__table__)
+                                       .where(AggregateClass.__table__.c.num_of_incidents == 0))
+                if since < until:
+                    connection.execute(self._build_aggregate_insert(AggregateClass, since, until))
+
+                stmt = insert(AggregateRefresh).values(aggregate=name, last_incident_id=until, refreshed_at=func.now())
+                connection.execute(stmt.on_conflict_do_update(
+                    index_elements=[AggregateRefresh.aggregate],
+                    set_={'last_incident_id': stmt.excluded.last_incident_id,
+                          'refreshed_at': stmt.excluded.refreshed_at}
+                ))
+            if revised:
+                connection.execute(delete(IncidentRevision).where(IncidentRevision.incident_id <= until))
+        self._aggregates_ensured = True
+        return rebuilt
+
+    def create_aggregate_tables(self):
+        """
+        Create the aggregate tables, the revisions table and its trigger missing from a database created before
+        they were added to the model, drop the obsolete aggregates and the sequences of aggregate keys created
+        as serial columns.
+        """
+        if not self._aggregate_tables_created:
+            Base.metadata.create_all(self.engine, tables=[AggregateClass.__table__ for AggregateClass
+                                                          in AGGREGATE_CLASSES] + [AggregateRefresh.__table__,
+                                                                                   IncidentRevision.__table__])
+            with self.engine.begin() as connection:
+                for name in OBSOLETE_AGGREGATES:
+                    connection.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                connection.execute(delete(AggregateRefresh).where(AggregateRefresh.aggregate.in_(OBSOLETE_AGGREGATES)))
+                # Keys copied from the dimensions were created as serial columns before they were declared without
+                # autoincrement; CASCADE drops the default of the column with its sequence
+                for AggregateClass in AGGREGATE_CLASSES:
+                    for column in AggregateClass.__table__.primary_key.columns:
+                        if column.autoincrement is False:
+                            connection.execute(text(f"DROP SEQUENCE IF EXISTS "
+                                                    f"{AggregateClass.__tablename__}_{column.name}_seq CASCADE"))
+                query = text("SELECT to_regclass(:table) IS NOT NULL AND NOT EXISTS "
+                             "(SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass(:table) AND tgname = :trigger)")
+                if connection.execute(query, {"table": Incidents.__tablename__,
+                                              "trigger": INCIDENT_REVISION_TRIGGER}).scalar():
+                    for statement in INCIDENT_REVISION_DDL:
+                        connection.execute(statement)
+            self._aggregate_tables_created = True
+
+    def ensure_aggregates(self):
+        """
+        Build the aggregates that were never refreshed, such as after the tables were recreated.
+
+        Aggregates that were refreshed before are left as they are; they are refreshed by the next load. The
+        check is made once per process, and again after the tables are recreated by this process.
+        """
+        if self._aggregates_ensured:
+            return
+        self.create_aggregate_tables()
+        with self.engine.connect() as connection:
+            refreshed = set(connection.execute(select(AggregateRefresh.aggregate)).scalars())
+        if any(AggregateClass.__tablename__ not in refreshed for AggregateClass in AGGREGATE_CLASSES):
+            self.refresh_aggregates()
+        self._aggregates_ensured = True
+
+    @staticmethod
+    def _sum_incidents(AggregateClass):
+        """
+        Get the total number of incidents counted by the rows of an aggregate.
+
+        :param AggregateClass: Aggregate class.
+        :return: Labeled column expression.
+        """
+        return cast(func.sum(AggregateClass.num_of_incidents), BigInteger).label('num_of_incidents')
+
+    @staticmethod
+    def _limit_counts(query, top_n=None, after=None, limit=None):
+        """
+        Bound the number of rows of a count query, with a top-N rollup or with keyset pagination.
+
+        The rows are ranked by count, highest first, then by their label columns. With top_n, the rows ranked
+        below top_n among the rows with the same values in all label columns but the last are summed into one
+        row labeled OTHER_LABEL, which comes after the others. The ranks are computed by a window function in
+        the database. With limit, the rows ranked after the row 'after' are returned instead, which pages
+        through all rows, the tail included, without the cost of an offset. Labels are ranked and compared with
+        NULL replaced by its sentinel, as in the natural keys of the dimensions, so rows with a missing label
+        are paged like the others.
+
+        :param query: Query with the label columns and 'num_of_incidents', one row per combination of labels.
+        :param top_n: Number of rows to keep in each group. Defaults to None (all).
+        :param after: Tuple of the count and the labels of the last row of the previous page. Defaults to None
+                      (the first page).
+        :param limit: Number of rows per page. Defaults to None (no pagination).
+        :return: Select statement, or the statement of the query if neither top_n nor limit is given.
+        :raises ValueError: If 'after' does not hold an integer count and a string or None for each label column.
+        """
+        if top_n is None and limit is None:
+            return query.statement
+        counts = query.order_by(None).subquery()
+        labels = [column for column in counts.c if column.name != 'num_of_incidents']
+        count = counts.c.num_of_incidents
+
+        if limit is not None:
+            sort_keys = [coalesce_null(label, label) for label in labels]
+            stmt = select(counts).order_by(count.desc(), *sort_keys).limit(limit)
+            if after is not None:
+                if len(after) != len(labels) + 1 or type(after[0]) is not int \
+                        or not all(value is None or isinstance(value, str) for value in after[1:]):
+                    raise ValueError("'after' must hold a count and a value for each label column")
+                after_count, *after_labels = after
+                after_keys = [coalesce_null(literal(value, label.type), label)
+                              for value, label in zip(after_labels, labels)]
+                stmt = stmt.where(or_(count < after_count,
+                                      and_(count == after_count, tuple_(*sort_keys) > tuple_(*after_keys))))
+            return stmt
+
+        rank = func.row_number().over(partition_by=labels[:-1], order_by=[count.desc(), labels[-1]])
+        ranked = select(counts, rank.label('rank')).subquery()
+        groups = [ranked.c[column.name] for column in labels[:-1]]
+        is_other = ranked.c.rank > top_n
+        label = case((is_other, literal(OTHER_LABEL)), else_=ranked.c[labels[-1].name])
+        return select(*groups, label.label(labels[-1].name),
+                      cast(func.sum(ranked.c.num_of_incidents), BigInteger).label('num_of_incidents')) \
+            .group_by(*groups, is_other, label) \
+            .order_by(is_other, desc('num_of_incidents'), *groups, label)
+
+    def fetch_category_counts(self, top_n=None, after=None, limit=None):
         """
         Fetch data for plotting category counts.
 
         This method executes a SQL query that groups incidents by category and counts
         the number of incidents for each category. The result is returned as a DataFrame.
 
+        :param top_n: Number of categories to keep, the others are summed up. Defaults to None (all).
+        :param after: Tuple of the count and category of the last row of the previous page. Defaults to None.
+        :param limit: Number of rows per page. Defaults to None (no pagination). See _limit_counts.
         :return: DataFrame containing the result of the query, which includes 'incident_category'
                  and 'num_of_incidents' (the count of incidents for each category).
         """
+        self.ensure_aggregates()
         query = self.Session.query(CategoryDimension.incident_category,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.category_key == CategoryDimension.key) \
+                                   self._sum_incidents(CategoryAggregate)) \
+            .join(CategoryAggregate, CategoryAggregate.category_key == CategoryDimension.key) \
             .group_by(CategoryDimension.incident_category)
 
-        return pd.read_sql(query.statement, self.Session.bind)
+        return pd.read_sql(self._limit_counts(query, top_n, after, limit), self.Session.bind)
 
     def fetch_category_resolution_counts(self):
         """
@@ -134,16 +624,17 @@ class PostgreSQLManager:
            :return: DataFrame containing the result of the query, which includes 'incident_category', 'resolution',
                     and 'num_of_incidents' (the count of incidents for each category and resolution).
            """
+        self.ensure_aggregates()
         query = self.Session.query(CategoryDimension.incident_category,
                                    ResolutionDimension.resolution,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.category_key == CategoryDimension.key) \
-            .join(ResolutionDimension, ResolutionDimension.key == Incidents.resolution_key) \
+                                   self._sum_incidents(CategoryResolutionAggregate)) \
+            .join(CategoryResolutionAggregate, CategoryResolutionAggregate.category_key == CategoryDimension.key) \
+            .join(ResolutionDimension, ResolutionDimension.key == CategoryResolutionAggregate.resolution_key) \
             .group_by(CategoryDimension.incident_category, ResolutionDimension.resolution)
 
         return pd.read_sql(query.statement, self.Session.bind)
 
-    def fetch_most_frequent_crimes(self, past_days=365):
+    def fetch_most_frequent_crimes(self, past_days=365, top_n=None, after=None, limit=None):
         """
             Fetch data for the most frequently occurring types of crimes for the past specified days.
 
@@ -153,62 +644,140 @@ class PostgreSQLManager:
             descending order and returned as a DataFrame.
 
             :param past_days: The number of past days to consider for the query. Defaults to 365.
+            :param top_n: Number of categories to keep, the others are summed up. Defaults to None (all).
+            :param after: Tuple of the count and category of the last row of the previous page. Defaults to None.
+            :param limit: Number of rows per page. Defaults to None (no pagination). See _limit_counts.
             :return: DataFrame containing the result of the query, which includes 'incident_category'
                      and 'num_of_incidents' (the count of incidents for each category).
             """
         # Calculate the date for 'past_days' ago
         date_past_days = datetime.datetime.now() - datetime.timedelta(days=past_days)
+        # Calendar keys are YYYYMMDD integers, so the date filter needs no join with the calendar dimension
+        calendar_key_past_days = int(date_past_days.strftime('%Y%m%d'))
 
+        self.ensure_aggregates()
         query = self.Session.query(CategoryDimension.incident_category,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.category_key == CategoryDimension.key) \
-            .join(DateDimension, DateDimension.key == Incidents.date_key) \
-            .filter(DateDimension.incident_date >= date_past_days) \
+                                   self._sum_incidents(CalendarCategoryAggregate)) \
+            .join(CalendarCategoryAggregate, CalendarCategoryAggregate.category_key == CategoryDimension.key) \
+            .filter(CalendarCategoryAggregate.calendar_key >= calendar_key_past_days) \
             .group_by(CategoryDimension.incident_category) \
             .order_by(desc('num_of_incidents'))
-        return pd.read_sql(query.statement, self.Session.bind)
+        return pd.read_sql(self._limit_counts(query, top_n, after, limit), self.Session.bind)
 
-    def fetch_crime_hotspots(self):
+    @staticmethod
+    def get_hotspot_cell_size(zoom, bounds=None):
         """
-           Fetch data for identifying crime hotspots.
+        Get the size of the cells of the hotspot grid at a zoom level.
 
-           This method executes a SQL query that groups incidents by location and counts
-           the number of incidents for each location. The result is sorted by the count of incidents in
-           descending order and returned as a DataFrame.
+        A cell spans hotspot_cell_pixels pixels of a Web Mercator map at the zoom level, and is as high as it is
+        wide on screen at the latitude of the bounds. Cells are made larger until the bounds hold at most
+        hotspot_max_cells of them.
 
-           :return: DataFrame containing the result of the query, which includes 'latitude', 'longitude',
-                    and 'num_of_incidents' (the count of incidents for each location).
-           """
-        query = self.Session.query(LocationDimension.latitude, LocationDimension.longitude,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.location_key == LocationDimension.key) \
-            .group_by(LocationDimension.latitude, LocationDimension.longitude) \
-            .order_by(desc('num_of_incidents'))
-        return pd.read_sql(query.statement, self.Session.bind)
+        :param zoom: Zoom level of the map.
+        :param bounds: Tuple (west, south, east, north) of the visible area, in degrees. Defaults to None.
+        :return: Tuple of the height and width of a cell, in degrees of latitude and longitude.
+        """
+        latitude = (bounds[1] + bounds[3]) / 2 if bounds is not None else HOTSPOT_REFERENCE_LATITUDE
+        # A 256 pixel tile spans 360 degrees of longitude at zoom level 0
+        width = 360 / (256 * 2 ** zoom) * app_config['hotspot_cell_pixels']
+        height = width * math.cos(math.radians(latitude))
+        if bounds is not None:
+            west, south, east, north = bounds
+            while math.ceil((east - west) / width) * math.ceil((north - south) / height) \
+                    > app_config['hotspot_max_cells']:
+                width, height = width * 1.25, height * 1.25
+        return height, width
+
+    def fetch_crime_hotspots(self, zoom=HOTSPOT_DEFAULT_ZOOM, bounds=None):
+        """
+        Fetch data for identifying crime hotspots.
+
+        This method counts the incidents in the cells of a grid whose resolution follows the zoom level of the
+        map, see get_hotspot_cell_size. The grid is aligned on multiples of the cell size, so a cell covers the
+        same area whatever the bounds, and is computed in the database. At most hotspot_max_cells cells are
+        returned, the ones with the most incidents, so the size of the result does not grow with the data.
+
+        :param zoom: Zoom level of the map. Defaults to HOTSPOT_DEFAULT_ZOOM.
+        :param bounds: Tuple (west, south, east, north) of the visible area, in degrees, outside which incidents
+                       are not counted. Defaults to None (everywhere).
+        :return: DataFrame containing the result of the query, which includes 'latitude', 'longitude' (the center
+                 of each cell) and 'num_of_incidents' (the count of incidents in each cell).
+        """
+        height, width = self.get_hotspot_cell_size(zoom, bounds)
+        self.ensure_aggregates()
+        cells = select(func.floor(LocationDimension.latitude / height).label('row'),
+                       func.floor(LocationDimension.longitude / width).label('column'),
+                       LocationAggregate.num_of_incidents) \
+            .join_from(LocationAggregate, LocationDimension, LocationDimension.key == LocationAggregate.location_key) \
+            .where(LocationDimension.latitude.isnot(None), LocationDimension.longitude.isnot(None))
+        if bounds is not None:
+            west, south, east, north = bounds
+            cells = cells.where(LocationDimension.longitude.between(west, east),
+                                LocationDimension.latitude.between(south, north))
+        cells = cells.subquery()
+        query = select(((cells.c.row + 0.5) * height).label('latitude'),
+                       ((cells.c.column + 0.5) * width).label('longitude'),
+                       cast(func.sum(cells.c.num_of_incidents), BigInteger).label('num_of_incidents')) \
+            .group_by(cells.c.row, cells.c.column) \
+            .order_by(desc('num_of_incidents')) \
+            .limit(app_config['hotspot_max_cells'])
+        return pd.read_sql(query, self.Session.bind)
+
+    def fetch_location_counts(self):
+        """
+        Fetch the number of incidents at every location, for rasterizing their density.
+
+        :return: DataFrame containing 'latitude', 'longitude' and 'num_of_incidents', one row per location.
+        """
+        self.ensure_aggregates()
+        query = select(LocationDimension.latitude, LocationDimension.longitude, LocationAggregate.num_of_incidents) \
+            .join_from(LocationAggregate, LocationDimension, LocationDimension.key == LocationAggregate.location_key) \
+            .where(LocationDimension.latitude.isnot(None), LocationDimension.longitude.isnot(None))
+        return pd.read_sql(query, self.Session.bind)
+
+    def get_aggregate_version(self, AggregateClass):
+        """
+        Get an identifier of the content of an aggregate, which changes whenever the aggregate is refreshed.
+
+        :param AggregateClass: Aggregate class.
+        :return: Text made of the highest incident_id counted and the time of the refresh, or None if the
+                 aggregate was never refreshed.
+        """
+        with self.engine.connect() as connection:
+            refresh = connection.execute(select(AggregateRefresh.last_incident_id, AggregateRefresh.refreshed_at)
+                                         .where(AggregateRefresh.aggregate == AggregateClass.__tablename__)).first()
+        return f"{refresh.last_incident_id}-{refresh.refreshed_at:%Y%m%d%H%M%S%f}" if refresh is not None else None
 
-    def fetch_crime_trends(self):
+    def fetch_crime_trends(self, by_weekday=False, by_month=False):
         """
            Fetch data for identifying temporal crime trends.
 
-           This method executes a SQL query that groups incidents by time, day of the week,
-           and category, and counts the number of incidents for each combination. The result is sorted by
-           the time and day of the week and returned as a DataFrame.
+           This method executes a SQL query that groups incidents by hour of the day and category, and optionally
+           by day of the week and month, and counts the number of incidents for each combination. The result is
+           sorted by hour and returned as a DataFrame, with at most one row per category, hour, day of the week
+           and month.
 
-           :return: DataFrame containing the result of the query, which includes 'incident_time',
-                    'incident_day_of_week', 'incident_category', and 'num_of_incidents'
-                    (the count of incidents for each combination of time, day, and category).
+           :param by_weekday: Whether to count the incidents of each day of the week apart. Defaults to False.
+           :param by_month: Whether to count the incidents of each month apart. Defaults to False.
+           :return: DataFrame containing the result of the query, which includes 'incident_hour',
+                    'incident_day_of_week' and 'incident_month' if requested, 'incident_category' and
+                    'num_of_incidents' (the count of incidents for each combination).
            """
-        query = self.Session.query(DateDimension.incident_time, DateDimension.incident_day_of_week,
-                                   CategoryDimension.incident_category,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.date_key == DateDimension.key) \
-            .join(CategoryDimension, CategoryDimension.key == Incidents.category_key) \
-            .group_by(DateDimension.incident_time, DateDimension.incident_day_of_week,
-                      CategoryDimension.incident_category) \
-            .order_by(DateDimension.incident_time, DateDimension.incident_day_of_week)
+        self.ensure_aggregates()
+        aggregate = HourWeekdayMonthCategoryAggregate
+        columns = [aggregate.incident_hour]
+        if by_weekday:
+            columns.append(aggregate.incident_day_of_week)
+        if by_month:
+            columns.append(aggregate.incident_month)
+        columns.append(CategoryDimension.incident_category)
+        query = self.Session.query(*columns, self._sum_incidents(aggregate)) \
+            .join(CategoryDimension, CategoryDimension.key == aggregate.category_key) \
+            .group_by(*columns) \
+            .order_by(*columns)
         return pd.read_sql(query.statement, self.Session.bind)
 
-    def fetch_district_crimes(self):
+    def fetch_district_crimes(self, top_n=None, after=None, limit=None):
         """
            Fetch data for identifying crimes in all districts.
 
@@ -216,20 +785,26 @@ class PostgreSQLManager:
            the number of incidents for each combination. The result is sorted by the count of incidents
            in descending order and returned as a DataFrame.
 
+           :param top_n: Number of categories to keep in each district, the others are summed up.
+                         Defaults to None (all).
+           :param after: Tuple of the count, district and category of the last row of the previous page.
+                         Defaults to None.
+           :param limit: Number of rows per page. Defaults to None (no pagination). See _limit_counts.
            :return: DataFrame containing the result of the query, which includes 'police_district',
                     'incident_category', and 'num_of_incidents' (the count of incidents for each combination
                     of district and category).
            """
+        self.ensure_aggregates()
         query = self.Session.query(DistrictDimension.police_district,
                                    CategoryDimension.incident_category,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.district_key == DistrictDimension.key) \
-            .join(CategoryDimension, CategoryDimension.key == Incidents.category_key) \
+                                   self._sum_incidents(DistrictCategoryAggregate)) \
+            .join(DistrictCategoryAggregate, DistrictCategoryAggregate.district_key == DistrictDimension.key) \
+            .join(CategoryDimension, CategoryDimension.key == DistrictCategoryAggregate.category_key) \
             .group_by(DistrictDimension.police_district, CategoryDimension.incident_category) \
             .order_by(desc('num_of_incidents'))
-        return pd.read_sql(query.statement, self.Session.bind)
+        return pd.read_sql(self._limit_counts(query, top_n, after, limit), self.Session.bind)
 
-    def fetch_incident_details(self):
+    def fetch_incident_details(self, top_n=None, after=None, limit=None):
         """
         Fetch data for analyzing incident details.
 
@@ -237,12 +812,16 @@ class PostgreSQLManager:
         the number of incidents for each description. The result is sorted by the count of incidents
         in descending order and returned as a DataFrame.
 
+        :param top_n: Number of descriptions to keep, the others are summed up. Defaults to None (all).
+        :param after: Tuple of the count and description of the last row of the previous page. Defaults to None.
+        :param limit: Number of rows per page. Defaults to None (no pagination). See _limit_counts.
         :return: DataFrame containing the result of the query, which includes 'incident_description'
                  and 'num_of_incidents' (the count of incidents for each description).
         """
-        query = self.Session.query(IncidentDetailsDimension.incident_description,
-                                   func.count(Incidents.incident_id).label('num_of_incidents')) \
-            .join(Incidents, Incidents.incident_details_key == IncidentDetailsDimension.key) \
-            .group_by(IncidentDetailsDimension.incident_description) \
+        self.ensure_aggregates()
+        query = self.Session.query(DescriptionDimension.incident_description,
+                                   self._sum_incidents(DescriptionAggregate)) \
+            .join(DescriptionAggregate, DescriptionAggregate.description_key == DescriptionDimension.key) \
+            .group_by(DescriptionDimension.incident_description) \
             .order_by(desc('num_of_incidents'))
-        return pd.read_sql(query.statement, self.Session.bind)
+        return pd.read_sql(self._limit_counts(query, top_n, after, limit), self.Session.bind)
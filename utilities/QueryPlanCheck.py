@@ -0,0 +1,181 @@
+import argparse
+import json
+import sys
+
+from sqlalchemy import event, text
+
+from model.SQLAlchemy import Incidents
+from utilities.PostgreSQLManager import PostgreSQLManager
+from utilities.QueryPlotter import GRAPH_CONFIG
+
+# Intended plan of the query of every graph: the only relations it may read, and the indexes it must use
+INTENDED_PLANS = {
+    'crime_hotspots': {'relations': {'agg_location', 'location_dimension'}},
+    'incident_analysis': {'relations': {'agg_category', 'category_dimension'}},
+    'resolution_status': {'relations': {'agg_category_resolution', 'category_dimension', 'resolution_dimension'}},
+    'most_frequent_crimes': {'relations': {'agg_calendar_category', 'category_dimension'},
+                             'indexes': {'idx_agg_calendar_category_covering'}},
+    'crime_trends': {'relations': {'agg_hour_weekday_month_category', 'category_dimension'}},
+    'district_crimes': {'relations': {'agg_district_category', 'district_dimension', 'category_dimension'}},
+    'incident_details': {'relations': {'agg_description', 'description_dimension'}},
+}
+
+# Lowest correlation between the physical order of the incidents and a column for a BRIN index to pay off
+BRIN_MIN_CORRELATION = 0.9
+
+
+def capture_query(db_manager, query_func, **query_params):
+    """
+    Run a fetch method of PostgreSQLManager and capture the statement of its query.
+
+    :param db_manager: PostgreSQLManager instance.
+    :param query_func: Name of the fetch method.
+    :param query_params: Keyword arguments of the fetch method.
+    :return: Tuple of the SQL statement and its parameters, as passed to the driver.
+    """
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db_manager.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        getattr(db_manager, query_func)(**query_params)
+    finally:
+        event.remove(db_manager.engine, 'before_cursor_execute', before_cursor_execute)
+    # The fetch methods may bring the aggregates up to date first; the query of the graph runs last
+    return next((statement, parameters) for statement, parameters in reversed(statements)
+                if statement.lstrip().upper().startswith('SELECT'))
+
+
+def explain(db_manager, statement, parameters):
+    """
+    Execute a statement with EXPLAIN ANALYZE.
+
+    :param db_manager: PostgreSQLManager instance.
+    :param statement: SQL statement.
+    :param parameters: Parameters of the statement.
+    :return: Dictionary of the plan, in the JSON format of EXPLAIN.
+    """
+    with db_manager.engine.connect() as connection:
+        result = connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+        return result.scalar()[0]
+
+
+def get_plan_nodes(plan):
+    """
+    Flatten a plan tree.
+
+    :param plan: Plan node, in the JSON format of EXPLAIN.
+    :return: List of the node and all nodes below it.
+    """
+    nodes = [plan]
+    for child in plan.get('Plans', []):
+        nodes += get_plan_nodes(child)
+    return nodes
+
+
+def describe_node(node):
+    """
+    Describe a node that reads a relation, in the words of the text format of EXPLAIN.
+
+    :param node: Plan node.
+    :return: Text such as 'Index Only Scan using <index> on <relation>'.
+    """
+    using = f" using {node['Index Name']}" if 'Index Name' in node else ''
+    return f"{node['Node Type']}{using} on {node['Relation Name']}"
+
+
+def check_graph(db_manager, graph_type):
+    """
+    Check that the query of a graph runs with its intended plan.
+
+    :param db_manager: PostgreSQLManager instance.
+    :param graph_type: Key of the graph in GRAPH_CONFIG.
+    :return: Dictionary with the scans of the plan, its execution time and the problems found.
+    """
+    graph_config = GRAPH_CONFIG[graph_type]
+    statement, parameters = capture_query(db_manager, graph_config['query_func'],
+                                          **graph_config.get('query_params', {}))
+    explained = explain(db_manager, statement, parameters)
+    nodes = get_plan_nodes(explained['Plan'])
+    scans = [node for node in nodes if 'Relation Name' in node]
+
+    problems = []
+    intended = INTENDED_PLANS.get(graph_type)
+    if intended is None:
+        problems.append('no intended plan')
+    else:
+        for relation in sorted({node['Relation Name'] for node in scans} - intended['relations']):
+            problems.append(f'reads {relation}')
+        for index in sorted(intended.get('indexes', set()) - {node.get('Index Name') for node in scans}):
+            problems.append(f'does not use {index}')
+    return {
+        'graph': graph_type,
+        'scans': [describe_node(node) for node in scans],
+        'execution_ms': round(explained['Execution Time'], 2),
+        'problems': problems
+    }
+
+
+def check_brin_indexes(db_manager):
+    """
+    Check that the columns of the BRIN indexes of the incidents table follow the physical order of its rows.
+
+    The correlation comes from the statistics of the last ANALYZE.
+
+    :param db_manager: PostgreSQLManager instance.
+    :return: List of dictionaries with the index, its column, the correlation and the problems found.
+    """
+    indexes = [index for index in Incidents.__table__.indexes
+               if index.dialect_options['postgresql']['using'] == 'brin']
+    query = text("SELECT correlation FROM pg_stats "
+                 "WHERE schemaname = current_schema() AND tablename = :table AND attname = :column")
+    results = []
+    with db_manager.engine.connect() as connection:
+        for index in indexes:
+            column = index.columns[0].name
+            correlation = connection.execute(query, {"table": Incidents.__tablename__, "column": column}).scalar()
+            problems = []
+            if correlation is None:
+                problems.append('no statistics, run ANALYZE')
+            elif abs(correlation) < BRIN_MIN_CORRELATION:
+                problems.append(f'rows are not in {column} order, the index cannot skip blocks')
+            results.append({'index': index.name, 'column': column, 'correlation': correlation,
+                            'problems': problems})
+    return results
+
+
+def main():
+    """
+    Check the query plans of all graphs from the command line, and exit with status 1 if any is not as intended.
+
+    BRIN indexes on columns that do not follow the order of the rows are reported, but do not fail the check.
+    """
+    parser = argparse.ArgumentParser(description='Check that the dashboard queries use their intended plans.')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    db_manager = PostgreSQLManager.get_instance()
+    graphs = [check_graph(db_manager, graph_type) for graph_type in GRAPH_CONFIG]
+    brin_indexes = check_brin_indexes(db_manager)
+
+    if args.json:
+        print(json.dumps({'graphs': graphs, 'brin_indexes': brin_indexes}, indent=2))
+    else:
+        for graph in graphs:
+            status = 'FAIL' if graph['problems'] else 'OK'
+            print(f"{status:4} {graph['graph']} ({graph['execution_ms']} ms): {'; '.join(graph['scans'])}")
+            for problem in graph['problems']:
+                print(f"     {problem}")
+        for brin_index in brin_indexes:
+            status = 'WARN' if brin_index['problems'] else 'OK'
+            print(f"{status:4} {brin_index['index']} (correlation {brin_index['correlation']})")
+            for problem in brin_index['problems']:
+                print(f"     {problem}")
+    sys.exit(1 if any(graph['problems'] for graph in graphs) else 0)
+
+
+if __name__ == "__main__":
+    # Check the query plans
+    main()
@@ -1,27 +1,48 @@
-import pandas as pd
 from plotly import express as px
 import plotly.graph_objects as go
-from utilities.PostgreSQLManager import PostgreSQLManager
-from datetime import datetime, date
+from config.app_config import app_config
+from utilities.PostgreSQLManager import PostgreSQLManager, HOTSPOT_DEFAULT_ZOOM
+from utilities.ResultCache import ResultCache
 
 
 class QueryPlotter:
+    # Query results and figures of all plotters, cleared when the data changes (see ResultCache.invalidate_all)
+    cache = ResultCache('graph', app_config['result_cache_max_entries'], app_config['result_cache_ttl_seconds'])
+
     def __init__(self, graph_type):
         """
         Initialize the QueryPlotter object with graph_type.
 
         :param graph_type: Type of graph ('bar' or 'stacked_bar').
         """
+        self.graph_type = graph_type
         self.graph_config = GRAPH_CONFIG[graph_type]
         self.db_manager = PostgreSQLManager.get_instance()
 
-    def plot_graph(self):
+    def plot_graph(self, **query_params):
         """
         Plot the graph based on the data provided.
 
+        The figure is cached, so it is only plotted again once the cache has been invalidated or has expired.
+
+        :param query_params: Keyword arguments of the query, such as the zoom and bounds of a zoomable graph.
+        :return: Plotly figure object.
+        """
+        key = ('figure', self.graph_type, tuple(sorted(query_params.items())))
+        return self.cache.get_or_compute(key, lambda: self._plot_graph(**query_params))
+
+    def _plot_graph(self, **query_params):
+        """
+        Query the data and plot the graph.
+
+        :param query_params: Keyword arguments of the query, on top of the query_params of the graph configuration.
         :return: Plotly figure object.
         """
-        df = self.get_data()
+        if self.graph_config.get('raster_tiles', False) and app_config['hotspot_raster_tiles']:
+            # The density tiles draw the data, the figure only sets up the map
+            df = None
+        else:
+            df = self.get_data(**{**self.graph_config.get('query_params', {}), **query_params})
         fig = getattr(self, self.graph_config['plot_func'])(df, **self.graph_config.get('plot_params', {}))
         if self.graph_config.get('is_logarithmic', False):
             fig.add_annotation(
@@ -39,9 +60,14 @@ class QueryPlotter:
         """
         Fetch data from the database.
 
+        Results are cached by graph type and arguments. A copy is returned, so plotting may modify it.
+
         :return: DataFrame containing the result of the query.
         """
-        return getattr(self.db_manager, self.graph_config['query_func'])(*args, **kwargs)
+        key = ('data', self.graph_type, args, tuple(sorted(kwargs.items())))
+        df = self.cache.get_or_compute(
+            key, lambda: getattr(self.db_manager, self.graph_config['query_func'])(*args, **kwargs))
+        return df.copy()
 
     def plot_bar_graph(self, df, x, y, color, title, labels):
         """
@@ -85,19 +111,30 @@ class QueryPlotter:
         """
         Plot a heat map on a map of San Francisco.
 
-        :param df: DataFrame containing data for the graph.
+        With hotspot_raster_tiles the heat map is a layer of the density tiles served on /tiles, and the
+        data is neither queried nor sent to the browser.
+
+        :param df: DataFrame containing data for the graph, one row per cell of the hotspot grid, or None with
+                   hotspot_raster_tiles.
         :return: Plotly figure object.
         """
-        fig = go.Figure(go.Densitymapbox(
-            lat=df['latitude'],
-            lon=df['longitude'],
-            z=df['num_of_incidents'],
-            radius=20,
-            colorscale='Hot',
-            colorbar=dict(thickness=20, ticklen=3),
-            hoverinfo='text',
-            hovertext=df['num_of_incidents'].astype(str) + ' incidents'
-        ))
+        layers = []
+        if app_config['hotspot_raster_tiles']:
+            # The density is drawn by the tiles, the empty trace only sets up the map
+            fig = go.Figure(go.Scattermapbox(lat=[], lon=[]))
+            layers.append(dict(sourcetype='raster', source=['/tiles/{z}/{x}/{y}.png'], below='traces'))
+        else:
+            fig = go.Figure(go.Densitymapbox(
+                lat=df['latitude'],
+                lon=df['longitude'],
+                z=df['num_of_incidents'],
+                # Blends neighbouring cells of the grid, which are hotspot_cell_pixels apart at every zoom level
+                radius=app_config['hotspot_cell_pixels'] * 2.5,
+                colorscale='Hot',
+                colorbar=dict(thickness=20, ticklen=3),
+                hoverinfo='text',
+                hovertext=df['num_of_incidents'].astype(str) + ' incidents'
+            ))
 
         fig.update_layout(
             autosize=True,
@@ -111,7 +148,8 @@ class QueryPlotter:
                     lon=-122.4194  # longitude of San Francisco
                 ),
                 pitch=0,
-                zoom=10
+                zoom=HOTSPOT_DEFAULT_ZOOM,
+                layers=layers
             ),
             height=800,  # adjust the height of the map here
         )
@@ -139,26 +177,25 @@ class QueryPlotter:
 
     def plot_line_graph(self, df):
         """
-        Plot a line graph connecting dots of the same category, grouped by 60 minutes.
+        Plot a line graph connecting dots of the same category, one dot per hour of the day.
+
+        The incidents are counted by hour in the database. If they are also counted by day of the week or month,
+        each combination with the category gets its own line.
 
         :param df: DataFrame containing data for the graph.
         :return: Plotly figure object.
         """
-
-        # Convert incident_time to datetime and set it as the index
-        df['incident_time'] = pd.to_datetime(df['incident_time'].apply(lambda x: datetime.combine(date.today(), x)))
-        df.set_index('incident_time', inplace=True)
-        grouped_df = df.groupby(['incident_category', pd.Grouper(freq='60T')]).sum().reset_index()
-
+        series = [column for column in ('incident_category', 'incident_day_of_week', 'incident_month')
+                  if column in df.columns]
         fig = go.Figure()
 
         # Iterate over each category and add a line trace
-        for category, group in grouped_df.groupby('incident_category'):
+        for name, group in df.groupby(series):
             fig.add_trace(go.Scatter(
-                x=group['incident_time'],
+                x=group['incident_hour'],
                 y=group['num_of_incidents'],
                 mode='lines',
-                name=category,
+                name=' / '.join(str(value) for value in name) if isinstance(name, tuple) else name,
                 line=dict(shape='spline'),
                 marker=dict(size=6),
             ))
@@ -168,9 +205,8 @@ class QueryPlotter:
             xaxis=dict(
                 title='Time of the Day',
                 tickmode='array',
-                tickvals=pd.date_range(start=date.today(), periods=24, freq='H').tolist(),
-                ticktext=[t.strftime('%H:%M') for t in pd.date_range(start=date.today(), periods=24, freq='H')],
-                tickformat='%H:%M',
+                tickvals=list(range(24)),
+                ticktext=[f'{hour:02d}:00' for hour in range(24)],
             ),
             yaxis_title='Number of Incidents',
             template='plotly_white',
@@ -204,6 +240,10 @@ GRAPH_CONFIG = {
         'label': 'Crime Hotspots',
         'query_func': 'fetch_crime_hotspots',
         'plot_func': 'plot_scatter_graph',
+        # The query takes the zoom level and bounds of the map
+        'zoomable': True,
+        # Drawn by the density tiles instead of the query with hotspot_raster_tiles
+        'raster_tiles': True,
     },
     'incident_analysis': {
         'label': 'Incident Analysis',
@@ -253,11 +293,17 @@ GRAPH_CONFIG = {
             'color': 'num_of_incidents',
             'title': 'Crimes in Specific Districts',
             'labels': {'police_district': 'Police District', 'num_of_incidents': 'Number of Incidents', 'incident_category': 'Incident Category'}
-        }
+        },
+        # The most frequent categories of each district, the others are summed up
+        'query_params': {'top_n': 10},
+        'pageable': True
     },
     'incident_details': {
         'label': 'Incident Details Analysis',
         'query_func': 'fetch_incident_details',
         'plot_func': 'plot_incident_details',
+        # The most frequent descriptions, the others are summed up; the tail can be paged through on /counts
+        'query_params': {'top_n': 40},
+        'pageable': True
     }
 }
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    A thread-safe cache of query results with a time to live and a size bound.
+
+    Entries expire after the time to live, which bounds how stale a result can get when the data is changed by
+    another process, and the least recently used entries are evicted when the cache is full. Every cache is
+    registered, so invalidate_all clears all of them when the data changes, as after a load or when the tables
+    are recreated. A result computed while the cache is invalidated is not stored, since it may predate the change.
+
+    Hits and misses are counted and exposed in the Prometheus text format by render_metrics.
+
+    :param name: Name of the cache in the metrics.
+    :param max_entries: Maximum number of cached results.
+    :param ttl_seconds: Number of seconds a result stays valid.
+    """
+    _caches = []
+    _registry_lock = threading.Lock()
+
+    def __init__(self, name, max_entries, ttl_seconds):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        with ResultCache._registry_lock:
+            ResultCache._caches.append(self)
+
+    def get(self, key):
+        """
+        Get a cached result and mark it as recently used.
+
+        :param key: Hashable key of the result.
+        :return: Tuple of a boolean indicating whether the result was found, and the result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation=None):
+        """
+        Store a result, evicting the least recently used results if the cache is full.
+
+        :param key: Hashable key of the result.
+        :param value: Result to store.
+        :param generation: Generation the result was computed in, see get_generation. The result is dropped
+                           if the cache was invalidated since. Defaults to None (always stored).
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_generation(self):
+        """
+        Get the number of times the cache was invalidated, to be passed to put with a result computed afterwards.
+
+        :return: Generation of the cache.
+        """
+        with self._lock:
+            return self._generation
+
+    def get_or_compute(self, key, compute):
+        """
+        Get a cached result, computing and storing it on a miss.
+
+        :param key: Hashable key of the result.
+        :param compute: Function without arguments that computes the result.
+        :return: The result.
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+        generation = self.get_generation()
+        value = compute()
+        self.put(key, value, generation)
+        return value
+
+    def invalidate(self):
+        """
+        Remove all cached results.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    @classmethod
+    def invalidate_all(cls):
+        """
+        Remove the cached results of all caches, after the data they were computed from has changed.
+        """
+        with cls._registry_lock:
+            caches = list(cls._caches)
+        for cache in caches:
+            cache.invalidate()
+
+    @classmethod
+    def render_metrics(cls):
+        """
+        Render the counters of all caches in the Prometheus text exposition format.
+
+        :return: Text of the metrics.
+        """
+        with cls._registry_lock:
+            caches = list(cls._caches)
+        lines = ['# HELP sfcrime_result_cache_requests_total Lookups of query results in the result caches.',
+                 '# TYPE sfcrime_result_cache_requests_total counter']
+        for cache in caches:
+            lines.append(f'sfcrime_result_cache_requests_total{{cache="{cache.name}",result="hit"}} {cache.hits}')
+            lines.append(f'sfcrime_result_cache_requests_total{{cache="{cache.name}",result="miss"}} {cache.misses}')
+        lines += ['# HELP sfcrime_result_cache_evictions_total Results evicted from the result caches when full.',
+                  '# TYPE sfcrime_result_cache_evictions_total counter']
+        lines += [f'sfcrime_result_cache_evictions_total{{cache="{cache.name}"}} {cache.evictions}' for cache in caches]
+        lines += ['# HELP sfcrime_result_cache_entries Results held by the result caches.',
+                  '# TYPE sfcrime_result_cache_entries gauge']
+        lines += [f'sfcrime_result_cache_entries{{cache="{cache.name}"}} {len(cache._entries)}' for cache in caches]
+        return '\n'.join(lines) + '\n'
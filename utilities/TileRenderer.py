@@ -0,0 +1,286 @@
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from config.app_config import app_config
+from model.SQLAlchemy import LocationAggregate
+from utilities.PostgreSQLManager import PostgreSQLManager
+from utilities.ResultCache import ResultCache
+
+TILE_SIZE = 256
+
+# Latitudes beyond these bounds fall outside the square Web Mercator world
+MAX_LATITUDE = 85.0511287798
+
+# Color scale of the density, the 'Hot' scale of the Plotly density map, as (position, (red, green, blue))
+COLOR_STOPS = [(0.0, (0, 0, 0)), (0.3, (230, 0, 0)), (0.6, (255, 210, 0)), (1.0, (255, 255, 255))]
+
+# Ratio of the density of the densest area to the lowest density the logarithmic color scale tells apart
+DENSITY_RANGE = 100
+
+# Largest opacity of a pixel, so the densest areas do not hide the map below them
+MAX_ALPHA = 220
+
+
+def encode_png(pixels):
+    """
+    Encode an RGBA image as PNG.
+
+    The rows are stored unfiltered and compressed with zlib, which needs no imaging library.
+
+    :param pixels: Array of unsigned bytes of shape (height, width, 4).
+    :return: Bytes of the PNG file.
+    """
+    height, width, _ = pixels.shape
+    # Every row starts with the byte of its filter type, 0 for none
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 4)
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    # Width, height, bit depth, color type 6 (RGBA), compression, filter and interlace methods
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def project(latitudes, longitudes):
+    """
+    Project coordinates to the Web Mercator world of zoom level 0, whose pixel coordinates are multiplied by
+    2 ** zoom at other zoom levels.
+
+    :param latitudes: Array of latitudes, in degrees.
+    :param longitudes: Array of longitudes, in degrees.
+    :return: Tuple of arrays of the horizontal and vertical pixel coordinates, from 0 to TILE_SIZE.
+    """
+    sine = np.sin(np.radians(np.clip(latitudes, -MAX_LATITUDE, MAX_LATITUDE)))
+    x = (longitudes + 180) / 360 * TILE_SIZE
+    y = (0.5 - np.log((1 + sine) / (1 - sine)) / (4 * np.pi)) * TILE_SIZE
+    return x, y
+
+
+def blur(image, radius):
+    """
+    Blur an image with two passes of a box filter along each axis, which approximates a Gaussian blur.
+
+    Every pass averages the 2 * radius + 1 pixels around each pixel, computed from cumulative sums. Pixels
+    within 2 * radius of the edges are averaged with zeros.
+
+    :param image: 2D array.
+    :param radius: Radius of the box filter, in pixels.
+    :return: Blurred array of the same shape.
+    """
+    width = 2 * radius + 1
+    # The image is transposed after every pass, so the passes alternate between the axes and the image ends
+    # up in its original orientation
+    for _ in range(4):
+        cumulative = np.cumsum(np.pad(image, ((radius + 1, radius), (0, 0))), axis=0)
+        image = ((cumulative[width:] - cumulative[:-width]) / width).T
+    return image
+
+
+def get_color_table():
+    """
+    Get the colors of the 256 levels of density.
+
+    :return: Array of unsigned bytes of shape (256, 3).
+    """
+    levels = np.linspace(0, 1, 256)
+    positions = [position for position, _ in COLOR_STOPS]
+    return np.stack([np.interp(levels, positions, [color[channel] for _, color in COLOR_STOPS])
+                     for channel in range(3)], axis=1).astype(np.uint8)
+
+
+class TileRenderer:
+    """
+    A singleton class rendering the incident density as Web Mercator raster tiles.
+
+    The incidents of every location are binned into the pixels of a tile with NumPy, blurred and colored on a
+    logarithmic scale. The scale of a zoom level is set by the densest area of the whole city at that zoom,
+    so neighbouring tiles match. The locations are kept in memory, in a ResultCache that is cleared along
+    with the query results when the data changes.
+
+    Rendered tiles are cached on disk, in a directory named after the version of the location aggregate.
+    A load refreshes the aggregate, which changes its version, so the tiles of the old data are never
+    served again; their directory is removed once the new locations are loaded.
+    """
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        """
+        Get the singleton instance of this class.
+
+        :return: The singleton instance of this class.
+        """
+        if TileRenderer.__instance is None:
+            TileRenderer()
+        return TileRenderer.__instance
+
+    def __init__(self):
+        """
+        Virtually private constructor.
+
+        :raises Exception: If the instance has already been created.
+        """
+        if TileRenderer.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            TileRenderer.__instance = self
+            self.cache = ResultCache('tile_locations', 1, app_config['result_cache_ttl_seconds'])
+            self.colors = get_color_table()
+            self.empty_tile = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+    @staticmethod
+    def _get_cache_path():
+        """
+        Get the path of the tile cache directory.
+
+        :return: Absolute path, resolved against the utilities directory.
+        """
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), app_config['tile_cache_path'])
+
+    def _load_locations(self):
+        """
+        Load the locations and their number of incidents, and remove the tiles of older versions of the data.
+
+        :return: Dictionary with the version of the data, the projected coordinates of the locations, their
+                 number of incidents and an empty dictionary for the density scales of the zoom levels.
+        """
+        db_manager = PostgreSQLManager.get_instance()
+        db_manager.ensure_aggregates()
+        # Read before the locations, so a refresh in between leaves the tiles under an outdated version
+        version = db_manager.get_aggregate_version(LocationAggregate)
+        df = db_manager.fetch_location_counts()
+        x, y = project(df['latitude'].to_numpy(), df['longitude'].to_numpy())
+
+        cache_path = self._get_cache_path()
+        if os.path.isdir(cache_path):
+            for name in os.listdir(cache_path):
+                if name != version:
+                    shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
+        return {'version': version, 'x': x, 'y': y, 'counts': df['num_of_incidents'].to_numpy(dtype=np.float64),
+                'scales': {}}
+
+    def get_locations(self):
+        """
+        Get the locations, loading them if they are not cached.
+
+        :return: Dictionary returned by _load_locations.
+        """
+        return self.cache.get_or_compute('locations', self._load_locations)
+
+    def get_version(self):
+        """
+        Get the version of the data the tiles are rendered from.
+
+        :return: Version of the location aggregate.
+        """
+        return self.get_locations()['version']
+
+    def _get_scale(self, locations, zoom):
+        """
+        Get the density of the densest area at a zoom level, which is drawn with the brightest color.
+
+        The incidents are counted in blocks as wide as the blur, whose average per pixel is about the
+        largest value the blur produces.
+
+        :param locations: Dictionary returned by _load_locations.
+        :param zoom: Zoom level.
+        :return: Density, in incidents per pixel.
+        """
+        scale = locations['scales'].get(zoom)
+        if scale is None:
+            block = 2 * app_config['tile_blur_pixels'] + 1
+            columns = np.floor(locations['x'] * 2 ** zoom / block).astype(np.int64)
+            rows = np.floor(locations['y'] * 2 ** zoom / block).astype(np.int64)
+            _, blocks = np.unique(rows * (TILE_SIZE * 2 ** zoom // block + 1) + columns, return_inverse=True)
+            densest = np.bincount(blocks, weights=locations['counts']).max() if len(blocks) else 0
+            scale = locations['scales'][zoom] = max(densest / block ** 2, 1e-9)
+        return scale
+
+    def render_tile(self, zoom, x, y):
+        """
+        Render a tile of the incident density.
+
+        :param zoom: Zoom level.
+        :param x: Column of the tile, from 0 to 2 ** zoom - 1.
+        :param y: Row of the tile, from 0 to 2 ** zoom - 1.
+        :return: Bytes of the PNG image.
+        """
+        locations = self.get_locations()
+        radius = app_config['tile_blur_pixels']
+        # Locations near the tile are blurred into it, up to twice the radius away
+        margin = 2 * radius
+        size = TILE_SIZE + 2 * margin
+        columns = locations['x'] * 2 ** zoom - (x * TILE_SIZE - margin)
+        rows = locations['y'] * 2 ** zoom - (y * TILE_SIZE - margin)
+        inside = (columns >= 0) & (columns < size) & (rows >= 0) & (rows < size)
+        if not inside.any():
+            return self.empty_tile
+
+        pixels = rows[inside].astype(np.int64) * size + columns[inside].astype(np.int64)
+        image = np.bincount(pixels, weights=locations['counts'][inside], minlength=size * size).reshape(size, size)
+        image = blur(image, radius)[margin:margin + TILE_SIZE, margin:margin + TILE_SIZE]
+
+        scale = self._get_scale(locations, zoom)
+        levels = np.clip(np.log1p(image / scale * (DENSITY_RANGE - 1)) / np.log(DENSITY_RANGE), 0, 1)
+        rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        rgba[..., :3] = self.colors[(levels * 255).astype(np.uint8)]
+        rgba[..., 3] = np.where(image > 0, np.sqrt(levels) * MAX_ALPHA, 0).astype(np.uint8)
+        return encode_png(rgba)
+
+    def get_tile(self, zoom, x, y):
+        """
+        Get a tile of the incident density from the disk cache, rendering and caching it if it is missing.
+
+        :param zoom: Zoom level.
+        :param x: Column of the tile.
+        :param y: Row of the tile.
+        :return: Bytes of the PNG image.
+        """
+        version = self.get_version()
+        path = os.path.join(self._get_cache_path(), str(version), str(zoom), str(x), f'{y}.png')
+        try:
+            with open(path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            pass
+
+        tile = self.render_tile(zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first, so a concurrent request never reads a partial tile
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(tile)
+        os.replace(temporary_path, path)
+        return tile
+
+    def pregenerate(self, max_zoom):
+        """
+        Render the tiles covering the city at every zoom level up to max_zoom, so they are served from the cache.
+
+        The area is the extent of the locations, without the outermost 0.1 percent on each side, which is
+        often made of misplaced records.
+
+        :param max_zoom: Deepest zoom level to render.
+        :return: Number of tiles rendered or found in the cache.
+        """
+        locations = self.get_locations()
+        if not len(locations['x']):
+            return 0
+        left, right = np.percentile(locations['x'], [0.1, 99.9])
+        top, bottom = np.percentile(locations['y'], [0.1, 99.9])
+        tiles = 0
+        for zoom in range(max_zoom + 1):
+            scale = 2 ** zoom / TILE_SIZE
+            for x in range(int(left * scale), min(int(right * scale), 2 ** zoom - 1) + 1):
+                for y in range(int(top * scale), min(int(bottom * scale), 2 ** zoom - 1) + 1):
+                    self.get_tile(zoom, x, y)
+                    tiles += 1
+        return tiles